@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+
+import sys
+import signal
+import json
+import os.path
+import logging
+
+from gpioEventMonitor import GPIOEventMonitor
+from gpioEventProcessor import GPIOEventProcessor
+from actions import Actions
+from gpioBackend import makeBackend
+from stateMachine import StateMachineEngine
+from stateSnapshot import StateSnapshot
+from outputSequencer import beep
+
+logger = logging.getLogger("FSMEventProc")
+
+class FSMEventProcessor(GPIOEventProcessor):
+    """
+        Event processor driven by declarative state machines (see
+        stateMachine.py) instead of hand-written handlers, so one process
+        can follow any number of doors, zones or sensors.
+
+        Every monitor event some machine is bound to gets a handler that
+        fires it through the StateMachineEngine.  The machines' actions
+        are strings, compiled once:
+
+          action:<name>            run the action <name> of the action defs
+          output:<output>=<level>  set a GPIO output (by its name in the GPIO settings) to 0 or 1
+          beep:<output>=<times>    beep an output in the background
+          data_log:<entry>         queue a data log entry
+          log:<message>            log a message
+          call:<name>              call a function registered with registerAction()
+
+        Guards are "in:<machine>.<state>" (see StateMachineEngine) or the
+        name of a function registered with registerGuard().  Functions
+        are called with the StateMachine, and have to be registered
+        before the machines are loaded: pass machine_config=None, register
+        them and call loadMachines().
+
+        The machines start on syncOutputs(), before the monitor starts,
+        which after a warm start (see restoreSnapshot()) also runs the
+        entry actions of the restored states, to put the devices back as
+        they were.
+    """
+
+    def __init__(self, gpio_settings, sim_mode, data_log_uri, action_defs, backend=None,
+                 data_log_spill_file=None, clock=None, data_logger=None, actions=None, machine_config=None):
+        super(FSMEventProcessor, self).__init__(gpio_settings, sim_mode, data_log_uri, action_defs, backend,
+                                                data_log_spill_file, clock, data_logger)
+        self.guards = {}
+        self.calls = {}
+        self.required_actions = []
+        self.engine = None
+        self.restored = False
+        self.actions = actions
+        if machine_config is not None:
+            self.loadMachines(machine_config)
+
+    def registerGuard(self, name, func):
+        self.guards[name] = func
+
+    def registerAction(self, name, func):
+        self.calls[name] = func
+
+    def loadMachines(self, machine_config):
+        ''' compiles the machines and registers a handler for every event they're bound to '''
+        self.engine = StateMachineEngine(machine_config, self.compileAction, self.compileGuard, self.clock)
+        for event in self.engine.events():
+            self.registerHandler(event, self.makeHandler(event))
+        if self.actions is None:
+            self.actions = Actions(self.signal_defs, required_actions=self.required_actions)
+            self.actions.startHealthProber()
+        logger.info("Loaded %d state machines" % (len(self.engine.machines)))
+
+    def makeHandler(self, event):
+        fire = self.engine.fire
+        # summary events come with an info dict, which the machines don't use
+        return lambda info=None: fire(event)
+
+    def compileAction(self, action_str):
+        kind, _, arg = action_str.partition(':')
+        if kind == 'action':
+            if arg not in self.signal_defs:
+                raise KeyError("Missing action definition: %s" % (arg))
+            if arg not in self.required_actions:
+                self.required_actions.append(arg)
+            return lambda machine: self.actions.processActionAsync(arg)
+        if kind == 'output':
+            pin, level = self.outputArg(action_str, arg)
+            return lambda machine: self.backend.output(pin, level)
+        if kind == 'beep':
+            pin, times = self.outputArg(action_str, arg)
+            return lambda machine: self.sequencer.play(pin, beep(0.4, 0.4), times)
+        if kind == 'data_log':
+            return lambda machine: self.dataLog(arg)
+        if kind == 'log':
+            return lambda machine: logger.info("%s: %s" % (machine.name, arg))
+        if kind == 'call':
+            if arg not in self.calls:
+                raise ValueError("No function registered for action: %s" % (action_str))
+            return self.calls[arg]
+        raise ValueError("Invalid state machine action: %s" % (action_str))
+
+    def outputArg(self, action_str, arg):
+        name, _, value = arg.partition('=')
+        if name not in self.gpio_settings['outputs'] or not value.isdigit():
+            raise ValueError("Invalid state machine action: %s" % (action_str))
+        return self.gpio_settings['outputs'][name], int(value)
+
+    def compileGuard(self, guard_str):
+        if guard_str not in self.guards:
+            raise ValueError("No function registered for guard: %s" % (guard_str))
+        return self.guards[guard_str]
+
+    def syncOutputs(self):
+        self.engine.start(rerun_entry=self.restored)
+
+    def getSnapshot(self):
+        return {"machines": self.engine.getSnapshot()}
+
+    def restoreSnapshot(self, state):
+        self.engine.restoreSnapshot(state.get('machines', {}))
+        self.restored = True
+
+    def unhandledEvent(self, event):
+        logger.debug('Event not bound to any machine: %s' % (event))
+
+if __name__ == '__main__':
+    import argparse
+
+    def sigint_handler(signal, frame):
+        logger.info("Caught Ctrl-c...")
+        eventMonitor.stop()
+    signal.signal(signal.SIGINT, sigint_handler)
+
+    parser = argparse.ArgumentParser(description='State machine event monitor system for Raspberry Pi')
+    parser.add_argument('-g', '--gpio_setup', type=str, help='JSON file defining GPIO setup', required=True)
+    parser.add_argument('-e', '--events', type=str, help='JSON file defining the events to monitor', required=True)
+    parser.add_argument('-a', '--actions', type=str, help='JSON file defining the actions', required=True)
+    parser.add_argument('-f', '--machines', type=str, help='JSON file defining the state machines', required=True)
+    parser.add_argument('-l', '--log_file', type=str, default='~/fsmEventLog.txt', help='log file path for processor (optional)', required=False)
+    parser.add_argument('-u', '--data_log_uri', type=str, default='', help='uri for logging data to data.sparkfun.com, or collector://host:port/site (optional)', required=False)
+    parser.add_argument('-s', '--data_log_spill', type=str, default=None, help='file to keep unsent data log entries in (optional)', required=False)
+    parser.add_argument('-p', '--poll_time', type=float, default=2.0, help='seconds between input polls (optional)', required=False)
+    parser.add_argument('-E', '--edge_detect', action='store_true', help='react to input edges instead of waiting for the next poll (optional)')
+    parser.add_argument('-m', '--mmap_gpio', action='store_true', help='read all inputs at once through /dev/gpiomem (optional)')
+    parser.add_argument('-b', '--bouncetime', type=int, default=50, help='debounce time in ms for edge detection (optional)', required=False)
+    parser.add_argument('-S', '--state_file', type=str, default=None, help='file to keep a snapshot of the machine states in, for warm restarts (optional)', required=False)
+    parser.add_argument('-i', '--snapshot_interval', type=float, default=30.0, help='seconds between state snapshots (optional)', required=False)
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.DEBUG,
+        format='%(asctime)s.%(msecs)03d (%(name)10s) [%(levelname)7s]: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S',
+        handlers=[
+            logging.StreamHandler(),
+            logging.FileHandler(os.path.expanduser(args.log_file), mode='a')
+        ])
+    logger = logging.getLogger()
+
+    gpio_settings = json.load(open(args.gpio_setup, 'r'))
+    event_triggers = json.load(open(args.events, 'r'))
+    action_defs = json.load(open(args.actions, 'r'))
+    machine_config = json.load(open(args.machines, 'r'))
+
+    try:
+        import RPi.GPIO
+        sim_mode = False
+    except ImportError:
+        sim_mode = True
+
+    eventMonitor = GPIOEventMonitor(gpio_settings, event_triggers, sim_mode, args.poll_time,
+                                    backend=makeBackend(sim_mode, args.mmap_gpio),
+                                    edge_detect=args.edge_detect, bouncetime_ms=args.bouncetime)
+    try:
+        eventProcessor = FSMEventProcessor(gpio_settings, sim_mode, args.data_log_uri, action_defs,
+                                           eventMonitor.backend, args.data_log_spill, machine_config=machine_config)
+    except (KeyError, ValueError) as e:
+        logger.error("Invalid state machines: %s" % (e))
+        sys.exit(1)
+
+    eventProcessor.bindEventIds(eventMonitor.event_names)
+    eventMonitor.addCallback(eventProcessor.eventIdCB, by_id=True, name='fsm')
+
+    if args.state_file:
+        snapshot = StateSnapshot(args.state_file, eventProcessor.clock, args.snapshot_interval)
+        snapshot.add('monitor', eventMonitor)
+        snapshot.add('processor', eventProcessor)
+        snapshot.load()
+        snapshot.start()
+    eventProcessor.syncOutputs()
+    eventMonitor.start()
+    eventProcessor.startup()
+    signal.pause()
+    eventMonitor.join()
+    eventProcessor.stop()
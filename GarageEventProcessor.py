@@ -1,16 +1,18 @@
 #!/usr/bin/env python
 
+import sys
 import signal
 import json
 import os.path
-import argparse
-import time
 import logging
-from threading import Timer
 
 from gpioEventMonitor import GPIOEventMonitor
 from gpioEventProcessor import GPIOEventProcessor
 from actions import Actions
+from gpioBackend import LOW, HIGH, makeBackend
+from configReload import ConfigReloader
+from stateSnapshot import StateSnapshot
+from outputSequencer import beep, pulse
 
 try:
     import RPi.GPIO as io
@@ -18,7 +20,7 @@ try:
     io.setmode(io.BCM)
     sim_mode = False
 except ImportError:
-    print(" --------- Running in RPi Simulation mode (input values are random, outputs are skipped) ----------")
+    print(" --------- Running in RPi Simulation mode (input values are random, outputs go to the fake backend) ----------")
     from random import randint
     sim_mode = True
 
@@ -30,12 +32,21 @@ logger = logging.getLogger("GarEventProc")
 class GarageEventProcessor(GPIOEventProcessor):
     """ garage Event Processor object"""
 
-    def __init__(self, gpio_settings, sim_mode, data_log_uri, action_defs):
-        super(GarageEventProcessor, self).__init__(gpio_settings, sim_mode, data_log_uri, action_defs)
+    # actions that must be defined in the action defs file
+    required_actions = ['garage_light_on', 'garage_light_off', 'sig_tower_all_off',
+                        'sig_tower_red_flash', 'sig_tower_red_off',
+                        'sig_tower_amber_on', 'sig_tower_amber_off',
+                        'sig_tower_green_on', 'sig_tower_green_flash', 'sig_tower_green_off']
+
+    def __init__(self, gpio_settings, sim_mode, data_log_uri, action_defs, backend=None,
+                 data_log_spill_file=None, clock=None, data_logger=None, actions=None):
+        super(GarageEventProcessor, self).__init__(gpio_settings, sim_mode, data_log_uri, action_defs, backend,
+                                                   data_log_spill_file, clock, data_logger)
         self.garageDoor_state = S_UNKNOWN
         self.lastOpenedTime = 0
         self.lastClosedTime = 0
         self.MotionCtr = 0
+        self.motion_coalesced = False
         self.heartbeat_state = 0
         self.garage_PIR_active_state = 0
         self.lights_state = S_OFF
@@ -43,70 +54,116 @@ class GarageEventProcessor(GPIOEventProcessor):
         self.opened_threshold_1 = 60 * 180   # if garage door opened > 180m
         self.opened_threshold_2 = 60 * 360  # if garage door opened > 240m
         self.reset_limit = 60 * 60
-        self.reset_timestamp = time.time() - self.reset_limit
+        self.reset_timestamp = self.clock.time() - self.reset_limit
         self.alert_active = False
         self.alert_time = 0
         self.alert_duration = 60 * 5   # 5m max alert duration
+        self.alert_timer = None
         self.garage_light_on_duration = 60 * 5   # 5m max 
         self.garageLights_state = S_OFF
         self.setLights(S_OFF)
-        self.horn_on(True)
-        time.sleep(0.200)
-        self.horn_on(False)
-
-        self.actions = Actions(action_defs)
-        self.actions.processAction('sig_tower_all_off')
+        self.restored = False
+
+        if actions is None:
+            actions = Actions(action_defs, required_actions=self.required_actions)
+            actions.startHealthProber()
+        self.actions = actions
+
+        self.registerHandler('heartbeat', self.heartbeat)
+        self.registerHandler('garage_PIR_active', lambda: self.garage_PIR_active(True))
+        self.registerHandler('garage_PIR_inactive', lambda: self.garage_PIR_active(False))
+        self.registerHandler('reset_button_pressed', self.reset_button_pressed)
+        self.registerHandler('Garage_closed', self.garage_close_event)
+        self.registerHandler('motion_detected', self.motion_detected)
+        self.registerHandler('motion_detected_alert', self.motion_detected_alert)
+        self.registerHandler('motion_summary', self.process_cumulative_motion)
+        self.registerHandler('Garage_open_normal', self.garage_open_normal_event)
+        self.registerHandler('Garage_open_alert', self.garage_open_alert_event)
         
-    def eventCB(self, event):
-        if event == 'heartbeat':
-            self.heartbeat()
-        elif event == 'garage_PIR_active':
-            self.garage_PIR_active(True)
-        elif event == 'garage_PIR_inactive':
-            self.garage_PIR_active(False)
-        elif event == 'reset_button_pressed':
-            self.reset_button_pressed()
-        elif event == 'Garage_closed':
-            self.garage_close_event()
-        elif event == 'motion_detected':
-            self.motion_detected()
-        elif event == 'motion_detected_alert':
-            self.motion_detected_alert()
-        elif event == 'Garage_open_normal':
-            self.garage_open_normal_event()
-        elif event == 'Garage_open_alert':
-            self.garage_open_alert_event()
-        else:
-            logger.error('Unhandled event: %s' % (event))
-
+    def syncOutputs(self):
+        if not self.restored:
+            # cold start: clear the signal tower
+            self.actions.processActionAsync('sig_tower_all_off')
+            return
+        # warm start: put the signal tower back in the restored state
+        self.actions.processActionAsync('sig_tower_green_on' if self.garageDoor_state == S_OPEN else 'sig_tower_green_off')
+        self.actions.processActionAsync('sig_tower_amber_on' if self.garage_PIR_active_state else 'sig_tower_amber_off')
+        self.actions.processActionAsync('sig_tower_red_flash' if self.alert_active else 'sig_tower_red_off')
+
+    def startup(self):
+        if not self.restored:
+            # cold start: announce it
+            self.horn_pulse(0.200)
+
+    def getSnapshot(self):
+        return {
+            "garageDoor_state": self.garageDoor_state,
+            "lastOpenedTime": self.lastOpenedTime,
+            "lastClosedTime": self.lastClosedTime,
+            "lights_state": self.lights_state,
+            "garageLights_state": self.garageLights_state,
+            "garageLightOnTime": getattr(self, 'garageLightOnTime', 0),
+            "garage_PIR_active_state": self.garage_PIR_active_state,
+            "reset_timestamp": self.reset_timestamp,
+            "alert_active": self.alert_active,
+            "alert_time": self.alert_time,
+        }
+
+    def restoreSnapshot(self, state):
+        # the open durations keep counting from when the door was opened
+        # before the restart, rather than from the first poll
+        self.garageDoor_state = state.get('garageDoor_state', S_UNKNOWN)
+        self.lastOpenedTime = state.get('lastOpenedTime', 0)
+        self.lastClosedTime = state.get('lastClosedTime', 0)
+        self.lights_state = state.get('lights_state', S_OFF)
+        self.garageLights_state = state.get('garageLights_state', S_OFF)
+        self.garageLightOnTime = state.get('garageLightOnTime', 0)
+        self.garage_PIR_active_state = state.get('garage_PIR_active_state', 0)
+        self.reset_timestamp = state.get('reset_timestamp', self.reset_timestamp)
+        if state.get('alert_active'):
+            # an alert still running goes on for the rest of its duration
+            self.alert_time = state.get('alert_time', 0)
+            remaining = self.alert_time + self.alert_duration - self.clock.time()
+            if remaining > 0:
+                self.alert_active = True
+                self.alert_timer = self.clock.callLater(remaining, self.cancel_alert)
+                self.horn_on(True)
+        self.setLights(S_ON if self.alert_active else self.lights_state)
+        self.restored = True
+
+    def unhandledEvent(self, event):
+        logger.error('Unhandled event: %s' % (event))
+
+    def cancel_alert(self):
         if self.alert_active:
-            if time.time() - self.alert_time > self.alert_duration:
-                logger.info("Cancelling alert: duration exceded")
-                self.alert_active = False
-                self.horn_on(False)
-                self.setLights(S_OFF)
-                self.actions.processAction('sig_tower_red_off')
+            logger.info("Cancelling alert: duration exceded")
+            self.alert_active = False
+            self.horn_on(False)
+            self.setLights(S_OFF)
+            self.actions.processActionAsync('sig_tower_red_off')
 
     def reset_button_pressed(self):
-        self.reset_timestamp = time.time()
+        self.reset_timestamp = self.clock.time()
         logger.info("Reset button pressed...")
         self.buzzer(1)
 
     def motion_detected_alert(self):
         if not self.alert_active:
-            self.alert_time = time.time()
+            self.alert_time = self.clock.time()
             self.alert_active = True
+            self.alert_timer = self.clock.callLater(self.alert_duration, self.cancel_alert)
             self.horn_on(True)
             self.setLights(S_ON)
-            self.actions.processAction('sig_tower_red_flash')
+            self.actions.processActionAsync('sig_tower_red_flash')
         logger.warn("Intruder alert!")
         self.log_motion()
 
     def motion_detected(self):
+        logger.info(">>>>>>>>>>> Motion detected")
         self.log_motion()
 
     def garage_open_normal_event(self):
-        current_ts = time.time()
+        current_ts = self.clock.time()
         if self.garageDoor_state == S_OPEN:
             how_long_opened = current_ts - self.lastOpenedTime
             if how_long_opened > self.opened_threshold_2:
@@ -114,11 +171,8 @@ class GarageEventProcessor(GPIOEventProcessor):
                 #self.buzzer(1)
                 #self.setLights(S_ON)
                 self.lights_state = S_ON
-                self.actions.processAction('sig_tower_green_flash')
+                self.actions.processActionAsync('sig_tower_green_flash')
             elif how_long_opened > self.opened_threshold_1:
-                #self.setLights(S_OFF)
-                time.sleep(0.5)
-                #self.setLights(S_ON)
                 self.lights_state = S_ON
             else:
                 print("Opened for %ds" % (how_long_opened))
@@ -130,7 +184,7 @@ class GarageEventProcessor(GPIOEventProcessor):
                 self.lastOpenedTime = current_ts
                 self.lights_state = S_ON
                 self.setLights(self.lights_state)
-                self.actions.processAction('sig_tower_green_on')
+                self.actions.processActionAsync('sig_tower_green_on')
                 self.buzzer(2)
             if self.garageLights_state == S_OFF:
                 self.toggleGarageLight(S_ON)
@@ -139,17 +193,11 @@ class GarageEventProcessor(GPIOEventProcessor):
         logger.info("Processing garage_open_alert_event...")
         if self.garageDoor_state == S_CLOSED or self.garageDoor_state == S_UNKNOWN:
             self.garageDoor_state = S_OPEN
-            self.lastOpenedTime = time.time()
+            self.lastOpenedTime = self.clock.time()
             self.dataLog(self.build_data_log_entry(S_OPEN, False))
-        #self.setLights(S_OFF)
-        self.buzzer(2)
-        #self.setLights(S_ON)
-        self.buzzer(2)
-        #self.setLights(S_OFF)
-        self.buzzer(2)
-        #self.setLights(S_ON)
+        self.buzzer(6)
         self.lights_state = S_ON
-        self.actions.processAction('sig_tower_green_flash')
+        self.actions.processActionAsync('sig_tower_green_flash')
         if self.garageDoor_state != S_OPEN:        
             if self.garageLights_state == S_OFF:
                 self.toggleGarageLight(S_ON)
@@ -157,7 +205,7 @@ class GarageEventProcessor(GPIOEventProcessor):
     def garage_close_event(self):
         if self.garageDoor_state != S_CLOSED:
             if self.garageDoor_state == S_OPEN:
-                amount_time_opened = time.time() - self.lastOpenedTime
+                amount_time_opened = self.clock.time() - self.lastOpenedTime
                 logger.info("Processing garage_close_event...was open for %ds" % (amount_time_opened))
                 self.dataLog(self.build_data_log_entry(S_CLOSED, False))
                 if self.garageLights_state == S_OFF:
@@ -168,78 +216,81 @@ class GarageEventProcessor(GPIOEventProcessor):
             self.lastOpenedTime = 0
             self.lights_state = S_OFF
             self.setLights(self.lights_state)
-            self.actions.processAction('sig_tower_green_off')
+            self.actions.processActionAsync('sig_tower_green_off')
             self.buzzer(3)
 
     def heartbeat(self):
         # flip the state...
         self.heartbeat_state = self.heartbeat_state^1
-        if not sim_mode:
-            heartbeat_led = self.gpio_settings['outputs']['heartbeat_led']
-            if self.heartbeat_state == 0:
-                io.output(heartbeat_led, io.LOW)
-            else:
-                io.output(heartbeat_led, io.HIGH)
-        else:
+        heartbeat_led = self.gpio_settings['outputs']['heartbeat_led']
+        self.backend.output(heartbeat_led, HIGH if self.heartbeat_state else LOW)
+        if sim_mode:
             logger.info("Heartbeat action received. State = %d" % self.heartbeat_state)
         if self.garageLights_state == S_ON:
-            if time.time() - self.garageLightOnTime > self.garage_light_on_duration:
+            if self.clock.time() - self.garageLightOnTime > self.garage_light_on_duration:
                 self.toggleGarageLight(S_OFF)
 
     def garage_PIR_active(self, state):
         if state:
             if self.garage_PIR_active_state == 0:
                 self.garage_PIR_active_state = 1
-                self.actions.processAction('sig_tower_amber_on')
+                self.actions.processActionAsync('sig_tower_amber_on')
         else:
             if self.garage_PIR_active_state == 1:
                 self.garage_PIR_active_state = 0
-                self.actions.processAction('sig_tower_amber_off')
+                self.actions.processActionAsync('sig_tower_amber_off')
 
     def setLights(self, on):
-        if not sim_mode:
-            lights_relay = self.gpio_settings['outputs']['lights_relay']
-            if on:
-                io.output(lights_relay, io.LOW)
-            else:
-                io.output(lights_relay, io.HIGH)
-        else:
+        # relay is active low
+        lights_relay = self.gpio_settings['outputs']['lights_relay']
+        self.backend.output(lights_relay, LOW if on else HIGH)
+        if sim_mode:
             logger.info("Lights turned %s" % ("on" if on else "off"))
 
     def buzzer(self, num_of_times):
-        for idx in range(num_of_times):
-            if not sim_mode:
-                buzzer_pin = self.gpio_settings['outputs']['buzzer']
-                io.output(buzzer_pin, io.HIGH)
-                time.sleep(0.4)
-                io.output(buzzer_pin, io.LOW)
-                time.sleep(0.4)
-            else:
-                logger.info("Buzzer: %d of %d..." % (idx+1, num_of_times))
+        # beeps in the background; replaces any beeping still going on
+        buzzer_pin = self.gpio_settings['outputs']['buzzer']
+        self.sequencer.play(buzzer_pin, beep(0.4, 0.4), num_of_times)
+        if sim_mode:
+            logger.info("Buzzer: %d times..." % (num_of_times))
 
     def horn_on(self, on):
-        if not sim_mode:
-            horn_pin = self.gpio_settings['outputs']['horn_relay']
-            if on:
-                io.output(horn_pin, io.LOW)
-            else:
-                io.output(horn_pin, io.HIGH)
-        else:
+        # relay is active low
+        horn_pin = self.gpio_settings['outputs']['horn_relay']
+        self.sequencer.cancel(horn_pin, LOW if on else HIGH)
+        if sim_mode:
             logger.info("Horn: %s" % ("on" if on else "off"))
 
+    def horn_pulse(self, duration):
+        horn_pin = self.gpio_settings['outputs']['horn_relay']
+        self.sequencer.play(horn_pin, pulse(duration, LOW))
+        if sim_mode:
+            logger.info("Horn: pulse for %0.1fs" % (duration))
+
+    def bindEventIds(self, event_names):
+        super(GarageEventProcessor, self).bindEventIds(event_names)
+        # with 'coalesce' settings in the triggers file, the monitor
+        # counts the motion events and sends motion_summary events
+        self.motion_coalesced = 'motion_summary' in event_names
+
     def log_motion(self):
+        ''' counts motion over 10s and logs it, unless the monitor coalesces it '''
+        if self.motion_coalesced:
+            return
         if self.MotionCtr == 0:
-            self.motion_log_timer = Timer(10, self.process_cumulative_motion)
-            self.motion_log_timer.start()
+            self.motion_log_timer = self.clock.callLater(10, self.log_counted_motion)
         self.MotionCtr += 1
-        logger.info(">>>>>>>>>>> Motion detected: %d" % (self.MotionCtr))
 
-    def process_cumulative_motion(self):
-        self.motion_log_timer.cancel()
+    def log_counted_motion(self):
+        count, self.MotionCtr = self.MotionCtr, 0
+        self.process_cumulative_motion({'count': count})
+
+    def process_cumulative_motion(self, info):
+        # a burst of motion events: a motion_summary event from the
+        # monitor, or counted by log_motion()
         self.dataLog(self.build_data_log_entry(self.garageDoor_state, True))
         self.dataLog(self.build_data_log_entry(self.garageDoor_state, False))
-        self.MotionCtr = 0
-        logger.info(">>>>>>>>> logging motion")
+        logger.info(">>>>>>>>> logging motion: %d detected" % (info['count']))
 
     def build_data_log_entry(self, door_state, motion_detected):
         garageDoor_open = 1 if door_state == S_OPEN else 0
@@ -248,21 +299,24 @@ class GarageEventProcessor(GPIOEventProcessor):
     def toggleGarageLight(self, garageLightState):
         if garageLightState == S_ON:
             self.garageLights_state = S_ON
-            if self.actions.processAction('garage_light_on'):
-                logger.info("turned garage light on")
-            else:
-                logger.warn("Error turning garage light on")
-            self.garageLightOnTime = time.time()
+            self.actions.processActionAsync('garage_light_on').add_done_callback(
+                lambda f: self.logActionResult(f, "turned garage light on", "Error turning garage light on"))
+            self.garageLightOnTime = self.clock.time()
 
         else:
             self.garageLights_state = S_OFF
-            if self.actions.processAction('garage_light_off'):
-                logger.info("turned garage light off")
-            else:
-                logger.warn("Error turning garage light off")
+            self.actions.processActionAsync('garage_light_off').add_done_callback(
+                lambda f: self.logActionResult(f, "turned garage light off", "Error turning garage light off"))
             logger.info("turning garage light off")
 
+    def logActionResult(self, future, ok_msg, err_msg):
+        if not future.cancelled() and future.exception() is None and future.result():
+            logger.info(ok_msg)
+        else:
+            logger.warn(err_msg)
+
 if __name__ == '__main__':
+    import argparse
 
     def sigint_handler(signal, frame):
         logger.info("Caught Ctrl-c...")
@@ -274,7 +328,18 @@ if __name__ == '__main__':
     parser.add_argument('-e', '--events', type=str, help='JSON file defining the events to monitor', required=True)
     parser.add_argument('-a', '--actions', type=str, help='JSON file defining the actions', required=True)
     parser.add_argument('-l', '--log_file', type=str, default='~/garageDoorLog.txt', help='log file path for processor (optional)', required=False)
-    parser.add_argument('-u', '--data_log_uri', type=str, default='', help='uri for logging data to data.sparkfun.com (optional)', required=False)
+    parser.add_argument('-u', '--data_log_uri', type=str, default='', help='uri for logging data to data.sparkfun.com, or collector://host:port/site (optional)', required=False)
+    parser.add_argument('-s', '--data_log_spill', type=str, default=None, help='file to keep unsent data log entries in (optional)', required=False)
+    parser.add_argument('-j', '--journal_dir', type=str, default=None, help='directory for the binary event journal (optional)', required=False)
+    parser.add_argument('-M', '--metrics_port', type=int, default=0, help='serve metrics on this local port (optional)', required=False)
+    parser.add_argument('-p', '--poll_time', type=float, default=2.0, help='seconds between input polls (optional)', required=False)
+    parser.add_argument('-E', '--edge_detect', action='store_true', help='react to input edges instead of waiting for the next poll (optional)')
+    parser.add_argument('-m', '--mmap_gpio', action='store_true', help='read all inputs at once through /dev/gpiomem (optional)')
+    parser.add_argument('-b', '--bouncetime', type=int, default=50, help='debounce time in ms for edge detection (optional)', required=False)
+    parser.add_argument('-w', '--watch_config', type=float, default=0, help='check the config files for changes every so many seconds (optional, SIGHUP always reloads)', required=False)
+    parser.add_argument('-S', '--state_file', type=str, default=None, help='file to keep a snapshot of the state in, for warm restarts (optional)', required=False)
+    parser.add_argument('-i', '--snapshot_interval', type=float, default=30.0, help='seconds between state snapshots (optional)', required=False)
+    parser.add_argument('-A', '--asyncio', action='store_true', help='run everything on one asyncio event loop (optional, Python 3)')
     args = parser.parse_args()
 
     logging.basicConfig(
@@ -291,11 +356,58 @@ if __name__ == '__main__':
     event_triggers = json.load(open(args.events, 'r'))
     action_defs = json.load(open(args.actions, 'r'))
 
-    eventMonitor = GPIOEventMonitor(gpio_settings, event_triggers, sim_mode, 2.0)
-    eventProcessor = GarageEventProcessor(gpio_settings, sim_mode, args.data_log_uri, action_defs)
-
-    eventMonitor.addCallback(eventProcessor.eventCB)
+    def setup(eventMonitor, eventProcessor):
+        # only what the first poll depends on, the rest waits for started()
+        eventMonitor.addReloadCallback(eventProcessor.reconfigure)
+        reloader = ConfigReloader(args.gpio_setup, args.events, args.actions, eventMonitor,
+                                  eventProcessor.actions, GarageEventProcessor.required_actions)
+        reloader.installSignalHandler()
+        if args.watch_config:
+            reloader.startWatching(args.watch_config)
+        if args.journal_dir:
+            from eventJournal import EventJournalWriter
+            eventMonitor.journal = EventJournalWriter(args.journal_dir, eventMonitor.event_names)
+        if args.state_file:
+            # restored before the first poll, so the first events are
+            # processed against the state from before the restart
+            snapshot = StateSnapshot(args.state_file, eventProcessor.clock, args.snapshot_interval)
+            snapshot.add('monitor', eventMonitor)
+            snapshot.add('processor', eventProcessor)
+            snapshot.load()
+            snapshot.start()
+
+    def started(eventMonitor, eventProcessor):
+        if args.metrics_port:
+            from metrics import MetricsRegistry, MetricsServer
+            registry = MetricsRegistry()
+            eventMonitor.attachMetrics(registry)
+            eventProcessor.attachMetrics(registry)
+            eventProcessor.actions.attachMetrics(registry)
+            MetricsServer(registry, args.metrics_port).start()
+
+    if args.asyncio:
+        from asyncCore import runAsync
+        runAsync(GarageEventProcessor, gpio_settings, event_triggers, action_defs, sim_mode, args.poll_time,
+                 backend=makeBackend(sim_mode, args.mmap_gpio), edge_detect=args.edge_detect,
+                 bouncetime_ms=args.bouncetime, data_log_uri=args.data_log_uri,
+                 data_log_spill_file=args.data_log_spill, setup=setup, started=started)
+        sys.exit(0)
+
+    eventMonitor = GPIOEventMonitor(gpio_settings, event_triggers, sim_mode, args.poll_time,
+                                    backend=makeBackend(sim_mode, args.mmap_gpio),
+                                    edge_detect=args.edge_detect, bouncetime_ms=args.bouncetime)
+    eventProcessor = GarageEventProcessor(gpio_settings, sim_mode, args.data_log_uri, action_defs,
+                                          eventMonitor.backend, args.data_log_spill)
+
+    eventProcessor.bindEventIds(eventMonitor.event_names)
+    eventMonitor.addCallback(eventProcessor.eventIdCB, by_id=True, name='garage')
+
+    setup(eventMonitor, eventProcessor)
+    eventProcessor.syncOutputs()
     eventMonitor.start()
+    eventProcessor.startup()
+    started(eventMonitor, eventProcessor)
     signal.pause()
     eventMonitor.join()
+    eventProcessor.stop()
 
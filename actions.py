@@ -1,71 +1,632 @@
-import requests
 import logging
-import argparse
 import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
 
 logger = logging.getLogger("Actions")
 
+# requests takes longer to import than everything else at startup on a
+# Pi Zero, so it's imported when the first session is made (see loadRequests())
+requests = None
+HTTPAdapter = None
+
+def loadRequests():
+    global requests, HTTPAdapter
+    if requests is None:
+        import requests as requests_module
+        from requests.adapters import HTTPAdapter as adapter_class
+        HTTPAdapter = adapter_class
+        requests = requests_module
+
+class TargetWorker(object):
+    """
+        Sends the actions queued for one target host, in order,
+        on its own thread.  A slow or dead host only backs up its own
+        queue; once the queue is full further actions are rejected.
+    """
+
+    def __init__(self, host, actions, queue_size):
+        self.host = host
+        self.actions = actions
+        self.queue = queue.Queue(queue_size)
+        self.thread = threading.Thread(target=self.run, name="action-%s" % (host))
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def submit(self, action_str):
+        future = Future()
+        try:
+            self.queue.put_nowait((action_str, future))
+        except queue.Full:
+            logger.error("Action queue for %s is full, dropping action: %s" % (self.host, action_str))
+            future.set_result(False)
+        return future
+
+    def run(self):
+        while True:
+            action_str, future = self.queue.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(self.actions.processAction(action_str))
+            except Exception as e:
+                future.set_exception(e)
+
+class HostHealth(object):
+    """ request statistics for one target host """
+
+    def __init__(self, host):
+        self.host = host
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.last_latency = 0.0
+        self.last_success_time = 0
+        self.last_failure_time = 0
+        self.last_error = None
+
+    def recordSuccess(self, latency):
+        self.successes += 1
+        self.consecutive_failures = 0
+        self.last_latency = latency
+        self.last_success_time = time.time()
+
+    def recordFailure(self, latency, error):
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.last_latency = latency
+        self.last_failure_time = time.time()
+        self.last_error = error
+
+    def isHealthy(self):
+        return self.consecutive_failures == 0
+
+    def asDict(self):
+        return dict(self.__dict__)
+
+class DeviceStateCache(object):
+    """
+        Desired and last confirmed state of each device, for the actions
+        whose definition says what state they put devices in, ie,
+        "states": {"sig_tower_green": "flash"}.
+
+        An action is current when every device it sets was confirmed in
+        that state less than refresh_interval secs ago; sending it again
+        wouldn't change anything.  After refresh_interval the state may
+        have drifted (the device rebooted, someone flipped a switch), so
+        it's no longer current and gets sent again.
+    """
+
+    def __init__(self, refresh_interval=300.0):
+        self.refresh_interval = refresh_interval
+        # device -> (state, action name)
+        self.desired = {}
+        # device -> (state, confirmation time)
+        self.confirmed = {}
+        self.lock = threading.Lock()
+
+    def isCurrent(self, states, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for device, state in states.items():
+                confirmed = self.confirmed.get(device)
+                if confirmed is None or confirmed[0] != state or now - confirmed[1] >= self.refresh_interval:
+                    return False
+            return True
+
+    def setDesired(self, states, action_str):
+        with self.lock:
+            for device, state in states.items():
+                self.desired[device] = (state, action_str)
+
+    def confirm(self, states, now=None):
+        if now is None:
+            now = time.time()
+        with self.lock:
+            for device, state in states.items():
+                self.confirmed[device] = (state, now)
+
+    def invalidate(self, states):
+        ''' the action failed, so the devices' states are unknown '''
+        with self.lock:
+            for device in states:
+                self.confirmed.pop(device, None)
+
+    def staleActions(self, action_table, now=None):
+        '''
+        returns the names of the actions to re-send, to bring the devices
+        whose state isn't current back to their desired state.  An action
+        setting several devices is only re-sent if all of them still want
+        the state it sets.
+        '''
+        if now is None:
+            now = time.time()
+        with self.lock:
+            stale = set()
+            for device, (state, action_str) in self.desired.items():
+                confirmed = self.confirmed.get(device)
+                if confirmed is None or confirmed[0] != state or now - confirmed[1] >= self.refresh_interval:
+                    stale.add(action_str)
+            return sorted(action_str for action_str in stale
+                          if all(self.desired.get(d, (None,))[0] == s
+                                 for d, s in action_table[action_str].states.items()))
+
+# circuit breaker states
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+BREAKER_STATE_VALUES = {CLOSED: 0, OPEN: 1, HALF_OPEN: 2}
+
+class CircuitBreaker(object):
+    """
+        Circuit breaker for one target host.
+
+        After failure_threshold consecutive failed requests the breaker
+        opens, and requests to the host are refused without being sent.
+        Once reset_timeout secs have passed, one trial request (or a
+        health probe) is let through (half open): if it succeeds the
+        breaker closes again, otherwise it re-opens for another
+        reset_timeout.
+    """
+
+    def __init__(self, host, failure_threshold=3, reset_timeout=30.0):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_time = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    def allowRequest(self):
+        with self.lock:
+            if self.state == CLOSED:
+                return True
+            # (a half open trial that never reported back is retried too)
+            if time.time() - self.opened_time >= self.reset_timeout:
+                logger.info("Circuit for %s half open, trying a request" % (self.host))
+                self.state = HALF_OPEN
+                self.opened_time = time.time()
+                return True
+            self.rejected += 1
+            return False
+
+    def tryProbe(self):
+        ''' moves an open breaker whose reset timeout has passed to half open '''
+        with self.lock:
+            if self.state != CLOSED and time.time() - self.opened_time >= self.reset_timeout:
+                self.state = HALF_OPEN
+                self.opened_time = time.time()
+                return True
+            return False
+
+    def recordSuccess(self):
+        ''' returns True if this closed the breaker '''
+        with self.lock:
+            reopened = self.state != CLOSED
+            if reopened:
+                logger.info("Circuit for %s closed, target is back" % (self.host))
+            self.state = CLOSED
+            self.failures = 0
+            return reopened
+
+    def recordFailure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+                if self.state == CLOSED:
+                    logger.warning("Circuit for %s open after %d failures" % (self.host, self.failures))
+                self.state = OPEN
+                self.opened_time = time.time()
+
+class HealthProber(object):
+    """
+        Probes the hosts with an open breaker every interval secs, off
+        the action path, and re-sends their deferred actions once they
+        answer.  Any HTTP response counts as the host being back.  Also
+        re-sends the actions whose device states have gone stale.
+    """
+
+    def __init__(self, actions, interval=10.0, timeout=2.0):
+        self.actions = actions
+        self.interval = interval
+        self.timeout = timeout
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="action-prober")
+        self.thread.setDaemon(1)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            for host, breaker in list(self.actions.breakers.items()):
+                if breaker.tryProbe():
+                    self.probe(host, breaker)
+            self.actions.refreshStates()
+
+    def probe(self, host, breaker):
+        url = self.actions.host_urls[host]
+        session, health = self.actions.getSession(url)
+        try:
+            session.get(url, timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            logger.debug("Probe of %s failed: %s" % (host, e))
+            breaker.recordFailure()
+            return
+        if breaker.recordSuccess():
+            self.actions.sendDeferred(host)
+
+class HttpGetAction(object):
+    """
+        Compiled 'http_get' action definition.
+
+        Optional 'timeout', 'retrys' and 'retry_delay' keys in the
+        definition override the Actions defaults for this action.  While
+        the target's breaker is open the action fails at once, unless
+        'deferrable' is true, in which case it's kept and sent once the
+        target is back.  A 'states' dict of device -> state says what the
+        action does, so it can be skipped when the devices are already
+        in that state (see DeviceStateCache).
+    """
+
+    def __init__(self, name, action_def, timeout, retrys):
+        if 'url' not in action_def:
+            raise KeyError("Missing key in action definition: url")
+        self.name = name
+        self.url = action_def['url']
+        self.host = urlparse(self.url).netloc
+        self.timeout = action_def.get('timeout', timeout)
+        self.retrys = action_def.get('retrys', retrys)
+        self.retry_delay = action_def.get('retry_delay', 0.200)
+        self.deferrable = action_def.get('deferrable', False)
+        self.states = action_def.get('states')
+        self.session = None
+        self.health = None
+        self.breaker = None
+        # metrics, see Actions.attachMetrics
+        self.latency = None
+        self.retry_count = None
+        self.failure_count = None
+        self.skip_count = None
+
+    def run(self, actions):
+        if self.session is None:
+            self.session, self.health = actions.getSession(self.url)
+            self.breaker = actions.getBreaker(self.host)
+        start = time.time()
+        try_cnt = 0
+        while try_cnt < self.retrys:
+            if not self.breaker.allowRequest():
+                # (a deferrable action is held even if it was its own
+                # failures that opened the breaker)
+                if try_cnt == 0 or self.deferrable:
+                    return actions.rejectAction(self)
+                break
+            logger.debug("(%d) Sending get request to %s" % (try_cnt+1, self.url))
+            if try_cnt > 0 and self.retry_count is not None:
+                self.retry_count.inc()
+            if actions.doHTML_get(self.url, self.timeout, self.session, self.health):
+                if self.breaker.recordSuccess():
+                    actions.sendDeferred(self.host)
+                if self.latency is not None:
+                    self.latency.observe(time.time() - start)
+                return True
+            self.breaker.recordFailure()
+            try_cnt += 1
+            if try_cnt < self.retrys:
+                time.sleep(self.retry_delay)
+        if self.deferrable and self.breaker.state == OPEN:
+            # the retries opened the breaker: held until the host is back
+            return actions.rejectAction(self)
+        logger.error("Too many attempts (%d), giving up." % (try_cnt))
+        if self.latency is not None:
+            self.latency.observe(time.time() - start)
+            self.failure_count.inc()
+        return False
+
+# action 'type' -> handler class
+ACTION_TYPES = {
+    "http_get": HttpGetAction,
+}
+
 class Actions(object):
     """ 
         Actions class.
 
         Used to wrap the calling to remote IoT devices
         to cause some action, ie, turning on/off a light
+
+        processAction() blocks until the action is done.
+        processActionAsync() queues the action on a worker for the
+        action's target host and returns a Future for the result.
+
+        Actions with 'states' in their definition are skipped while the
+        state cache says their devices are already in those states, and
+        re-sent by the health prober when the states go stale after
+        refresh_interval secs.
+
+        Requests to each host go through their own keep-alive session,
+        holding up to pool_size connections, and the result of every
+        request is tracked in the host's HostHealth and CircuitBreaker,
+        so actions for a host that stopped answering fail fast (or are
+        deferred) instead of waiting out their timeouts.
+        startHealthProber() starts probing such hosts in the background.
+
+        The action definitions are compiled into a table of handlers
+        when constructed.  If required_actions is given, every name in
+        it must have a definition, otherwise a KeyError is raised.
      """
 
-    def __init__(self, action_defs, timeout=5, retrys=3):
+    def __init__(self, action_defs, timeout=5, retrys=3, queue_size=32, pool_size=2,
+                 required_actions=None, failure_threshold=3, reset_timeout=30.0, defer_size=8,
+                 refresh_interval=300.0):
         self.action_defs = action_defs
         self.timeout = timeout
         self.retrys = retrys
+        self.queue_size = queue_size
+        self.pool_size = pool_size
+        self.workers = {}
+        self.workers_lock = threading.Lock()
+        self.sessions = {}
+        self.health = {}
+        self.sessions_lock = threading.Lock()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.defer_size = defer_size
+        self.breakers = {}
+        self.deferred = {}
+        # host -> base url, for the health probes
+        self.host_urls = {}
+        self.prober = None
+        self.state_cache = DeviceStateCache(refresh_interval)
+
+        self.action_table, host_urls = self.compileActions(action_defs, required_actions)
+        self.host_urls.update(host_urls)
 
-        # verify that action defs is okay
-        for k, v in self.action_defs.items():
+    def compileActions(self, action_defs, required_actions=None):
+        '''
+        verifies the action defs and returns a name -> handler dict, and
+        the host -> base url dict of their hosts.  Nothing is changed
+        until they are handed to swapActions().
+        '''
+        action_table = {}
+        host_urls = {}
+        for k, v in action_defs.items():
             if 'type' not in v:
                 raise KeyError("Missing key in action definition: type")
-            if 'url' not in v:
-                raise KeyError("Missing key in action definition: url")
+            if v['type'] not in ACTION_TYPES:
+                raise ValueError("Invalid action type for %s: %s" % (k, v['type']))
+            action_table[k] = ACTION_TYPES[v['type']](k, v, self.timeout, self.retrys)
+        for k in required_actions or []:
+            if k not in action_table:
+                raise KeyError("Missing action definition: %s" % (k))
+        for action in action_table.values():
+            parts = urlparse(action.url)
+            host_urls.setdefault(action.host, "%s://%s/" % (parts.scheme, parts.netloc))
+        return action_table, host_urls
+
+    def swapActions(self, action_defs, action_table, host_urls):
+        '''
+        replaces the actions with ones compiled (and so validated) by
+        compileActions().  Breakers, host health and device states are
+        kept, as they belong to the hosts and devices, so the base urls
+        of hosts no longer used are kept for their breakers' probes.
+        '''
+        for name, action in action_table.items():
+            old = self.action_table.get(name)
+            if old is not None:
+                action.latency = old.latency
+                action.retry_count = old.retry_count
+                action.failure_count = old.failure_count
+                action.skip_count = old.skip_count
+        self.host_urls.update(host_urls)
+        self.action_defs = action_defs
+        self.action_table = action_table
+        logger.info("Swapped in %d reloaded actions" % (len(action_table)))
+
+    def attachMetrics(self, registry):
+        ''' adds per action latency, retry and failure metrics, and queue depths, to a MetricsRegistry '''
+        names = sorted(self.action_table)
+        latency = registry.histogram('action_seconds', 'Time taken by each action, retries included', 'action', names)
+        retries = registry.counter('action_retries_total', 'Retried requests per action', 'action', names)
+        failures = registry.counter('action_failures_total', 'Actions given up on', 'action', names)
+        skipped = registry.counter('action_skipped_total', 'Actions not sent as the devices were already in their states', 'action', names)
+        for idx, name in enumerate(names):
+            action = self.action_table[name]
+            action.latency = latency.children[idx]
+            action.retry_count = retries.children[idx]
+            action.failure_count = failures.children[idx]
+            action.skip_count = skipped.children[idx]
+        registry.callbackGauge('action_queue_depth', 'Actions waiting per target host', 'host',
+                               lambda: [(host, w.queue.qsize()) for host, w in list(self.workers.items())])
+        registry.callbackGauge('action_breaker_state', 'Circuit breaker state per target host (0 closed, 1 open, 2 half open)', 'host',
+                               lambda: [(host, BREAKER_STATE_VALUES[b.state]) for host, b in list(self.breakers.items())])
+        registry.callbackGauge('action_breaker_rejected', 'Requests refused by the circuit breaker per target host', 'host',
+                               lambda: [(host, b.rejected) for host, b in list(self.breakers.items())])
+        registry.callbackGauge('action_deferred', 'Actions waiting for their target host to come back', 'host',
+                               lambda: [(host, len(d)) for host, d in list(self.deferred.items())])
 
     def processAction(self, action_str):
-        try:
-            for k, v in self.action_defs.items():
-                if k == action_str:
-                    # we found a matching action
-                    if v['type'] == "http_get":
-                        try_cnt = 0
-                        while try_cnt < self.retrys:
-                            logger.debug("(%d) Sending get request to %s" % (try_cnt+1, v['url']))
-                            if self.doHTML_get(v['url']):
-                                return True
-                            try_cnt += 1
-                            time.sleep(0.200)
-                        logger.error("Too many attempts (%d), giving up." % (try_cnt))
-                        return False
-                    else:
-                        logger.error("Invalid action type: %s" % (v['type']))
-                        return False
+        action = self.action_table.get(action_str)
+        if action is None:
             logger.error("Could not find matching action definition: %s" % (action_str))
             return False
+        if self.skipAction(action):
+            return True
+        try:
+            ok = action.run(self)
         except Exception as e:
-            logger.error("Error trying to send action: ", action_str)
+            logger.error("Error trying to send action %s: %s" % (action_str, e))
+            ok = False
+        self.settleAction(action, ok)
+        return ok
+
+    def skipAction(self, action):
+        ''' records the states the action asks for, returns True if the devices are already in them '''
+        if action.states is None:
+            return False
+        self.state_cache.setDesired(action.states, action.name)
+        if not self.state_cache.isCurrent(action.states):
+            return False
+        logger.debug("Devices already in the states set by %s, skipping it" % (action.name))
+        if action.skip_count is not None:
+            action.skip_count.inc()
+        return True
+
+    def settleAction(self, action, ok):
+        ''' confirms (or forgets, if it failed) the states set by the action '''
+        if action.states is not None:
+            if ok:
+                self.state_cache.confirm(action.states)
+            else:
+                self.state_cache.invalidate(action.states)
+
+    def refreshStates(self):
+        ''' re-sends the actions whose devices' states have gone stale, returns their names '''
+        stale = [action_str for action_str in self.state_cache.staleActions(self.action_table)
+                 if self.getBreaker(self.action_table[action_str].host).state == CLOSED]
+        for action_str in stale:
+            logger.debug("Refreshing device states with %s" % (action_str))
+            self.processActionAsync(action_str)
+        return stale
+
+    def processActionAsync(self, action_str):
+        '''
+        non-blocking version of processAction.  Returns a Future whose
+        result is what processAction would have returned.
+        '''
+        action = self.action_table.get(action_str)
+        if action is None:
+            logger.error("Could not find matching action definition: %s" % (action_str))
+            future = Future()
+            future.set_result(False)
+            return future
+        with self.workers_lock:
+            worker = self.workers.get(action.host)
+            if worker is None:
+                worker = TargetWorker(action.host, self, self.queue_size)
+                self.workers[action.host] = worker
+        return worker.submit(action_str)
+
+    def getSession(self, url):
+        '''
+        returns the (session, health) pair for the url's host,
+        creating them on first use.
+        '''
+        parts = urlparse(url)
+        base = "%s://%s" % (parts.scheme, parts.netloc)
+        with self.sessions_lock:
+            session = self.sessions.get(base)
+            if session is None:
+                loadRequests()
+                session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, max_retries=0)
+                session.mount(base, adapter)
+                self.sessions[base] = session
+            return session, self.getHealthLocked(parts.netloc)
+
+    def getHealth(self, host):
+        with self.sessions_lock:
+            return self.getHealthLocked(host)
+
+    def getHealthLocked(self, host):
+        health = self.health.get(host)
+        if health is None:
+            health = self.health[host] = HostHealth(host)
+        return health
+
+    def getBreaker(self, host):
+        with self.sessions_lock:
+            breaker = self.breakers.get(host)
+            if breaker is None:
+                breaker = self.breakers[host] = CircuitBreaker(host, self.failure_threshold, self.reset_timeout)
+            return breaker
+
+    def rejectAction(self, action):
+        ''' called instead of sending an action while its host's breaker is open '''
+        if not action.deferrable:
+            logger.warning("Target %s is down, not sending action: %s" % (action.host, action.name))
             return False
+        with self.sessions_lock:
+            deferred = self.deferred.get(action.host)
+            if deferred is None:
+                deferred = self.deferred[action.host] = deque(maxlen=self.defer_size)
+            deferred.append(action.name)
+        logger.warning("Target %s is down, deferring action: %s" % (action.host, action.name))
+        return False
+
+    def sendDeferred(self, host):
+        ''' queues the actions deferred for host, in order '''
+        with self.sessions_lock:
+            deferred = self.deferred.pop(host, None)
+        for action_str in deferred or []:
+            logger.info("Sending deferred action: %s" % (action_str))
+            self.processActionAsync(action_str)
+
+    def startHealthProber(self, interval=10.0, timeout=2.0):
+        ''' starts probing the hosts with an open breaker in the background '''
+        self.prober = HealthProber(self, interval, timeout).start()
+        return self.prober
+
+    def getHostHealth(self):
+        ''' returns a dict of host -> health stats, for all hosts used so far '''
+        with self.sessions_lock:
+            health = dict((host, h.asDict()) for host, h in self.health.items())
+            for host, breaker in self.breakers.items():
+                if host in health:
+                    health[host]['breaker'] = breaker.state
+            return health
+
+    def close(self):
+        if self.prober is not None:
+            self.prober.stop()
+        with self.sessions_lock:
+            for session in self.sessions.values():
+                session.close()
 
-    def doHTML_get(self, url):
+    def doHTML_get(self, url, timeout=None, session=None, health=None):
+        if session is None:
+            session, health = self.getSession(url)
+        if timeout is None:
+            timeout = self.timeout
+        start = time.time()
         try:
-            r = requests.get(url, timeout=self.timeout)
+            r = session.get(url, timeout=timeout)
             r.raise_for_status()
+            health.recordSuccess(time.time() - start)
             return True
         except requests.exceptions.Timeout:
-            logger.error("Timed out after %ds sending action to URL: %s" % (self.timeout, url))
+            logger.error("Timed out after %ds sending action to URL: %s" % (timeout, url))
+            health.recordFailure(time.time() - start, "timeout")
             return False
         except requests.exceptions.ConnectionError:
             logger.error("ConnectionError sending action to URL: %s" % (url))
+            health.recordFailure(time.time() - start, "connection")
             return False
         except requests.exceptions.HTTPError as e:
             logger.error("Client error with URL: %s" % (url))
+            health.recordFailure(time.time() - start, "http %d" % (e.response.status_code))
             return False
 
 def main():
     import json
+    import argparse
 
     logging.basicConfig(
         level=logging.DEBUG,
@@ -0,0 +1,97 @@
+'''
+Local stand-in for the IoT devices targeted by the Actions class, for
+benchmarks.  Like actions_test_server.py, but only needs the standard
+library and can misbehave on purpose:
+
+  healthy - replies right away (404 for actions not in the valid list)
+  slow    - waits 'delay' seconds before replying
+  dead    - accepts the connection but never replies
+
+Use to test:
+
+python actions_stub_server.py -m slow -d 2.0 -p 8080 actionDefs.json
+'''
+
+import argparse
+import json
+import time
+import threading
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+
+(HEALTHY, SLOW, DEAD) = ('healthy', 'slow', 'dead')
+
+class StubHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        stub = self.server.stub
+        stub.request_cnt += 1
+        if stub.mode == DEAD:
+            # hang until the client gives up or the server shuts down
+            stub.shutdown_event.wait()
+            return
+        if stub.mode == SLOW:
+            time.sleep(stub.delay)
+        action_str = self.path.lstrip('/')
+        if stub.valid_actions is not None and action_str not in stub.valid_actions:
+            self.send_response(404)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+class StubServer(object):
+    """ stand-in action target running on a background thread """
+
+    def __init__(self, mode=HEALTHY, delay=1.0, port=0, valid_actions=None):
+        self.mode = mode
+        self.delay = delay
+        self.valid_actions = valid_actions
+        self.request_cnt = 0
+        self.shutdown_event = threading.Event()
+        self.httpd = StubHTTPServer(('127.0.0.1', port), StubRequestHandler)
+        self.httpd.stub = self
+        self.port = self.httpd.server_address[1]
+
+    def url(self, action_str=''):
+        return "http://127.0.0.1:%d/%s" % (self.port, action_str)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever)
+        self.thread.setDaemon(1)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown_event.set()
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in action target for benchmarks.')
+    parser.add_argument("action_file_path", nargs='?', help='Full path to action file (JSON format), to only accept its actions')
+    parser.add_argument('-m', '--mode', default=HEALTHY, choices=[HEALTHY, SLOW, DEAD])
+    parser.add_argument('-d', '--delay', type=float, default=1.0, help='reply delay in slow mode')
+    parser.add_argument('-p', '--port', type=int, default=8080)
+    args = parser.parse_args()
+
+    valid_actions = None
+    if args.action_file_path:
+        with open(args.action_file_path) as action_file:
+            valid_actions = list(json.load(action_file).keys())
+
+    server = StubServer(args.mode, args.delay, args.port, valid_actions)
+    print("Serving in %s mode on %s" % (args.mode, server.url()))
+    server.httpd.serve_forever()
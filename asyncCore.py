@@ -0,0 +1,398 @@
+'''
+Optional asyncio runtime for the monitor, processor and actions
+(Python 3 only).
+
+Everything runs on one event loop: the monitor cycle, the event
+handlers, the output patterns, the timers and the action requests.
+Edges from the GPIO backend's thread are handed to the loop with
+call_soon_threadsafe, and actions are sent with non-blocking HTTP, so
+the state shared by the handlers is only touched from the loop and no
+per-host, consumer, sequencer or timer threads are started.  (The data
+log pipeline, if a data log uri is given, still runs on its own thread.)
+
+Use to test:
+
+python GarageEventProcessor.py -g GPIO.json -e EventTriggers.json -a actionDefs.json --asyncio
+'''
+
+import time
+import signal
+import asyncio
+import datetime
+import logging
+from urllib.parse import urlparse
+
+from gpioEventMonitor import GPIOEventMonitor, RUNNING
+from outputSequencer import OutputSequencer
+from actions import Actions, OPEN
+
+logger = logging.getLogger("AsyncCore")
+
+class LoopClock(object):
+    """ the real clock, with timers running on the event loop """
+
+    virtual = False
+    threaded = False
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def sleep(self, secs):
+        # blocks the loop, only for code that can't await
+        time.sleep(secs)
+
+    def callLater(self, delay, func):
+        ''' calls func on the loop after delay secs, returns a handle with a cancel() method '''
+        return self.loop.call_later(delay, func)
+
+class LoopOutputSequencer(OutputSequencer):
+    """ OutputSequencer playing its steps from loop timers instead of a thread """
+
+    def __init__(self, backend, loop):
+        super(LoopOutputSequencer, self).__init__(backend, time.time)
+        self.loop = loop
+        self.timer = None
+
+    @classmethod
+    def takeOver(cls, sequencer, loop):
+        ''' returns a LoopOutputSequencer carrying on with what 'sequencer' is playing '''
+        new = cls(sequencer.backend, loop)
+        with sequencer.cond:
+            new.heap, new.playing, new.seq = sequencer.heap, sequencer.playing, sequencer.seq
+        sequencer.stop()
+        return new
+
+    def start(self):
+        self.alive = True
+        self.schedule()
+
+    def stop(self):
+        self.alive = False
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def play(self, pin, steps, repeat=1):
+        super(LoopOutputSequencer, self).play(pin, steps, repeat)
+        self.schedule()
+
+    def schedule(self):
+        ''' plays the due steps and sets a timer for the next one '''
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.alive:
+            return
+        due = self.runPending(self.clock())
+        if due is not None:
+            self.timer = self.loop.call_later(max(0, due - self.clock()), self.schedule)
+
+class AsyncGPIOEventMonitor(GPIOEventMonitor):
+    """
+        GPIOEventMonitor running as a task on the event loop.
+
+        Callbacks are called directly from the loop (there are no
+        consumer threads); coroutine functions are run as tasks.
+        start() must be called from the loop and returns the monitor's
+        task, join() is a coroutine waiting for it.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AsyncGPIOEventMonitor, self).__init__(*args, **kwargs)
+        self.loop = None
+        self.wakeup = None
+        self.task = None
+
+    def addCallback(self, callbackFuncion, by_id=False, name=None, **kwargs):
+        if asyncio.iscoroutinefunction(callbackFuncion):
+            coroutine_func = callbackFuncion
+            callbackFuncion = lambda *args: asyncio.ensure_future(coroutine_func(*args))
+        super(AsyncGPIOEventMonitor, self).addCallback(callbackFuncion, by_id, queue_size=0, name=name)
+
+    def edgeCB(self, pin, level):
+        # called from the backend's thread
+        self.loop.call_soon_threadsafe(self.queueEdge, pin, level)
+
+    def queueEdge(self, pin, level):
+        GPIOEventMonitor.edgeCB(self, pin, level)
+        self.wakeup.set()
+
+    def start(self):
+        self.loop = asyncio.get_event_loop()
+        self.wakeup = asyncio.Event()
+        self.alive = True
+        if self.edge_detect:
+            self.addEdgeDetection()
+        self.state = RUNNING
+        self.task = self.loop.create_task(self.monitorEventsAsync())
+        return self.task
+
+    def stop(self):
+        super(AsyncGPIOEventMonitor, self).stop()
+        if self.loop is not None:
+            self.loop.call_soon_threadsafe(self.wakeup.set)
+
+    async def join(self):
+        await self.task
+
+    async def monitorEventsAsync(self):
+        logger.info("Event processing task started.")
+        while self.alive:
+            self.runCycle()
+            # woken up early by edges (and stop())
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.sleep_time)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+        if self.journal is not None:
+            self.journal.close()
+
+def attachProcessor(processor, loop=None):
+    '''
+    moves a GPIOEventProcessor (built with a LoopClock) onto the loop:
+    its output patterns are played from loop timers, and its coroutine
+    handlers are run as tasks.  Call after registering the handlers.
+    '''
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    processor.sequencer = LoopOutputSequencer.takeOver(processor.sequencer, loop)
+    processor.sequencer.start()
+    for event, handler in list(processor.handlers.items()):
+        if asyncio.iscoroutinefunction(handler):
+            processor.handlers[event] = (lambda handler: lambda *args: loop.create_task(handler(*args)))(handler)
+    processor.bindEventIds(processor.event_names)
+    return processor
+
+class HTTPStatusError(Exception):
+    pass
+
+class AsyncActions(Actions):
+    """
+        Actions sent with non-blocking HTTP GETs from the event loop.
+
+        Same action definitions, circuit breakers, deferred actions and
+        device state cache as Actions, but processActionAsync() returns
+        an asyncio Task, and the requests to each host are sent in order
+        over one keep-alive connection per host.  The health prober runs
+        as a task too.  processAction() (blocking) still goes through
+        the requests sessions of Actions.
+    """
+
+    def __init__(self, action_defs, loop=None, **kwargs):
+        super(AsyncActions, self).__init__(action_defs, **kwargs)
+        self.loop = loop if loop is not None else asyncio.get_event_loop()
+        self.host_locks = {}
+        # host -> idle (reader, writer)
+        self.connections = {}
+        self.prober_task = None
+
+    def processActionAsync(self, action_str):
+        action = self.action_table.get(action_str)
+        if action is None:
+            logger.error("Could not find matching action definition: %s" % (action_str))
+            future = self.loop.create_future()
+            future.set_result(False)
+            return future
+        return self.loop.create_task(self.processActionCo(action))
+
+    async def processActionCo(self, action):
+        lock = self.host_locks.get(action.host)
+        if lock is None:
+            lock = self.host_locks[action.host] = asyncio.Lock()
+        async with lock:
+            if self.skipAction(action):
+                return True
+            try:
+                ok = await self.runAction(action)
+            except Exception as e:
+                logger.error("Error trying to send action %s: %s" % (action.name, e))
+                ok = False
+            self.settleAction(action, ok)
+            return ok
+
+    async def runAction(self, action):
+        ''' HttpGetAction.run(), without blocking '''
+        if action.breaker is None:
+            action.health = self.getHealth(action.host)
+            action.breaker = self.getBreaker(action.host)
+        start = time.time()
+        try_cnt = 0
+        while try_cnt < action.retrys:
+            if not action.breaker.allowRequest():
+                # (a deferrable action is held even if it was its own
+                # failures that opened the breaker)
+                if try_cnt == 0 or action.deferrable:
+                    return self.rejectAction(action)
+                break
+            logger.debug("(%d) Sending get request to %s" % (try_cnt+1, action.url))
+            if try_cnt > 0 and action.retry_count is not None:
+                action.retry_count.inc()
+            if await self.httpGet(action.url, action.timeout, action.health):
+                if action.breaker.recordSuccess():
+                    self.sendDeferred(action.host)
+                if action.latency is not None:
+                    action.latency.observe(time.time() - start)
+                return True
+            action.breaker.recordFailure()
+            try_cnt += 1
+            if try_cnt < action.retrys:
+                await asyncio.sleep(action.retry_delay)
+        if action.deferrable and action.breaker.state == OPEN:
+            # the retries opened the breaker: held until the host is back
+            return self.rejectAction(action)
+        logger.error("Too many attempts (%d), giving up." % (try_cnt))
+        if action.latency is not None:
+            action.latency.observe(time.time() - start)
+            action.failure_count.inc()
+        return False
+
+    async def httpGet(self, url, timeout, health):
+        start = time.time()
+        try:
+            status = await asyncio.wait_for(self.request(url), timeout)
+            if status >= 400:
+                raise HTTPStatusError(status)
+        except asyncio.TimeoutError:
+            logger.error("Timed out after %ds sending action to URL: %s" % (timeout, url))
+            health.recordFailure(time.time() - start, "timeout")
+            return False
+        except HTTPStatusError as e:
+            logger.error("Client error with URL: %s" % (url))
+            health.recordFailure(time.time() - start, "http %d" % (e.args[0]))
+            return False
+        except (OSError, EOFError, ValueError, IndexError):
+            logger.error("ConnectionError sending action to URL: %s" % (url))
+            health.recordFailure(time.time() - start, "connection")
+            return False
+        health.recordSuccess(time.time() - start)
+        return True
+
+    async def request(self, url):
+        '''
+        sends a GET over the host's idle connection (or a new one, also
+        if the idle one turns out to be closed) and returns the status
+        '''
+        parts = urlparse(url)
+        path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+        conn = self.connections.pop(parts.netloc, None)
+        if conn is not None:
+            try:
+                return await self.exchange(parts, path, conn)
+            except (OSError, EOFError):
+                pass
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        conn = await asyncio.open_connection(parts.hostname, port, ssl=True if parts.scheme == 'https' else None)
+        return await self.exchange(parts, path, conn)
+
+    async def exchange(self, parts, path, conn):
+        reader, writer = conn
+        try:
+            writer.write(("GET %s HTTP/1.1\r\nHost: %s\r\n\r\n" % (path, parts.netloc)).encode('latin-1'))
+            status_line = await reader.readline()
+            if not status_line:
+                raise EOFError("connection closed")
+            status = int(status_line.split()[1])
+            length = None
+            keep_alive = status_line.startswith(b'HTTP/1.1')
+            while True:
+                line = await reader.readline()
+                if not line:
+                    raise EOFError("connection closed")
+                if line in (b'\r\n', b'\n'):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                name = name.strip().lower()
+                if name == 'content-length':
+                    length = int(value)
+                elif name == 'connection' and value.strip().lower() == 'close':
+                    keep_alive = False
+                elif name == 'transfer-encoding':
+                    keep_alive = False
+            if length is not None:
+                await reader.readexactly(length)
+        except BaseException:
+            writer.close()
+            raise
+        if keep_alive and length is not None:
+            self.connections[parts.netloc] = conn
+        else:
+            writer.close()
+        return status
+
+    def startHealthProber(self, interval=10.0, timeout=2.0):
+        self.prober_task = self.loop.create_task(self.runProber(interval, timeout))
+        return self.prober_task
+
+    async def runProber(self, interval, timeout):
+        ''' HealthProber.run() as a task '''
+        while True:
+            await asyncio.sleep(interval)
+            for host, breaker in list(self.breakers.items()):
+                if breaker.tryProbe():
+                    try:
+                        await asyncio.wait_for(self.request(self.host_urls[host]), timeout)
+                    except (asyncio.TimeoutError, OSError, EOFError, ValueError, IndexError) as e:
+                        logger.debug("Probe of %s failed: %s" % (host, e))
+                        breaker.recordFailure()
+                        continue
+                    if breaker.recordSuccess():
+                        self.sendDeferred(host)
+            self.refreshStates()
+
+    def close(self):
+        if self.prober_task is not None:
+            self.prober_task.cancel()
+        for reader, writer in self.connections.values():
+            writer.close()
+        self.connections = {}
+        super(AsyncActions, self).close()
+
+async def runProcessor(processor_class, gpio_settings, event_triggers, action_defs, sim_mode,
+                       poll_time=2.0, backend=None, edge_detect=False, bouncetime_ms=50,
+                       data_log_uri='', data_log_spill_file=None, setup=None, started=None):
+    '''
+    runs a monitor and a processor_class (taking actions= like
+    GarageEventProcessor) on the running loop until SIGINT or SIGTERM.
+    setup(monitor, processor) and processor.syncOutputs() are called
+    before the monitor starts, processor.startup() and
+    started(monitor, processor) right after.
+    '''
+    loop = asyncio.get_event_loop()
+    clock = LoopClock(loop)
+    monitor = AsyncGPIOEventMonitor(gpio_settings, event_triggers, sim_mode, poll_time, backend=backend,
+                                    edge_detect=edge_detect, bouncetime_ms=bouncetime_ms, clock=clock)
+    actions = AsyncActions(action_defs, loop, required_actions=getattr(processor_class, 'required_actions', None))
+    actions.startHealthProber()
+    processor = processor_class(gpio_settings, sim_mode, data_log_uri, action_defs, monitor.backend,
+                                data_log_spill_file, clock=clock, actions=actions)
+    processor.bindEventIds(monitor.event_names)
+    attachProcessor(processor, loop)
+    monitor.addCallback(processor.eventIdCB, by_id=True, name='processor')
+    if setup is not None:
+        setup(monitor, processor)
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, monitor.stop)
+    processor.syncOutputs()
+    task = monitor.start()
+    processor.startup()
+    if started is not None:
+        started(monitor, processor)
+    await task
+    processor.stop()
+    actions.close()
+
+def runAsync(*args, **kwargs):
+    ''' runProcessor() on a new event loop '''
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        loop.run_until_complete(runProcessor(*args, **kwargs))
+    finally:
+        loop.close()
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+
+'''
+Benchmark suite for the monitor and action hot paths, in sim mode.
+
+  cycle    - monitor cycle time against trigger count and input count
+  latency  - event-to-callback latency, edge driven and polled
+  actions  - Actions.processActionAsync throughput and tail latency
+             against healthy, slow and dead stand-in targets
+  dispatch - event-to-callback latency while the event handler sends
+             actions to a hung target, with processActionAsync and
+             with the blocking processAction
+  startup  - time from launching a fresh interpreter to the garage
+             processor's first event, in sim mode
+
+Results are printed (or written with -o) as JSON, one object per
+measurement, so runs can be compared before deploying.
+
+Use to test:
+
+python benchmarks.py -b cycle,latency,actions,dispatch,startup -o bench_output.txt
+'''
+
+import os
+import sys
+import json
+import time
+import random
+import subprocess
+import argparse
+import logging
+
+from gpioEventMonitor import GPIOEventMonitor
+from gpioBackend import FakeGPIOBackend
+
+def percentiles(values, pcts=(50, 90, 99)):
+    ''' returns {"p50": .., "p90": .., "p99": .., "max": ..} of values '''
+    values = sorted(values)
+    result = {}
+    for pct in pcts:
+        idx = min(len(values) - 1, int(round(pct / 100.0 * (len(values) - 1))))
+        result["p%d" % (pct)] = values[idx] if values else 0.0
+    result["max"] = values[-1] if values else 0.0
+    return result
+
+def makeConfig(num_inputs, num_triggers, seed=1):
+    ''' synthetic gpio settings and triggers, one event per (input, level) '''
+    rnd = random.Random(seed)
+    gpio_settings = {"inputs": {}, "outputs": {}}
+    for idx in range(num_inputs):
+        gpio_settings["inputs"]["input_%d" % (idx)] = [idx, True]
+    event_triggers = []
+    for idx in range(num_triggers):
+        start = rnd.randint(0, 23)
+        end = (start + rnd.randint(1, 23)) % 24
+        name = "input_%d" % (rnd.randrange(num_inputs))
+        event_triggers.append({
+            "type": "daily",
+            "start_time": "%d:00:00" % (start),
+            "end_time": "%d:59:59" % (end),
+            "input_events": [
+                {"name": name, "value": 1, "event": "ev_%d_on" % (idx)},
+                {"name": name, "value": 0, "event": "ev_%d_off" % (idx)}]})
+    return gpio_settings, event_triggers
+
+def benchCycle(num_inputs, num_triggers, cycles):
+    gpio_settings, event_triggers = makeConfig(num_inputs, num_triggers)
+    backend = FakeGPIOBackend(randomize=True)
+    monitor = GPIOEventMonitor(gpio_settings, event_triggers, True, 0, backend=backend)
+    monitor.addCallback(lambda event: None, queue_size=0)
+    times = []
+    for idx in range(cycles):
+        start = time.time()
+        monitor.runCycle()
+        times.append((time.time() - start) * 1000000.0)
+    result = {"bench": "cycle", "inputs": num_inputs, "triggers": num_triggers, "cycles": cycles,
+              "mean_us": sum(times) / len(times)}
+    result.update(dict((k + "_us", v) for k, v in percentiles(times).items()))
+    return result
+
+def benchLatency(edge_detect, num_events, poll_time=0.05):
+    gpio_settings, event_triggers = makeConfig(1, 1)
+    event_triggers[0]["start_time"] = "0:00:00"
+    event_triggers[0]["end_time"] = "23:59:59"
+    backend = FakeGPIOBackend()
+    monitor = GPIOEventMonitor(gpio_settings, event_triggers, True, poll_time, backend=backend,
+                               edge_detect=edge_detect, bouncetime_ms=0)
+    inject_times = []
+    latencies = []
+    def eventCB(event):
+        if event != "test callback" and len(latencies) < len(inject_times):
+            latencies.append((time.time() - inject_times[len(latencies)]) * 1000.0)
+    monitor.addCallback(eventCB)
+    monitor.start()
+    time.sleep(poll_time * 2)
+    level = backend.input(0)
+    for idx in range(num_events):
+        level ^= 1
+        inject_times.append(time.time())
+        backend.injectEdge(0, level)
+        # random spacing, so polling isn't in phase with the edges
+        time.sleep(poll_time * (1.5 + random.random()))
+    time.sleep(poll_time * 2)
+    monitor.stop()
+    result = {"bench": "latency", "mode": "edge" if edge_detect else "poll", "poll_time": poll_time,
+              "events": len(latencies)}
+    result.update(dict((k + "_ms", v) for k, v in percentiles(latencies).items()))
+    return result
+
+def benchActions(mode, num_actions, timeout, delay):
+    from actions import Actions
+    from actions_stub_server import StubServer
+
+    server = StubServer(mode, delay).start()
+    action_defs = {"bench_action": {"type": "http_get", "url": server.url("bench_action"), "retrys": 1}}
+    actions = Actions(action_defs, timeout=timeout, queue_size=num_actions)
+    latencies = []
+    def done(future, submitted):
+        latencies.append((time.time() - submitted) * 1000.0)
+    start = time.time()
+    futures = []
+    for idx in range(num_actions):
+        future = actions.processActionAsync("bench_action")
+        submitted = time.time()
+        future.add_done_callback(lambda f, s=submitted: done(f, s))
+        futures.append(future)
+    ok = 0
+    for future in futures:
+        if future.result():
+            ok += 1
+    elapsed = time.time() - start
+    server.stop()
+    actions.close()
+    result = {"bench": "actions", "target": mode, "actions": num_actions, "ok": ok,
+              "throughput_per_s": num_actions / elapsed if elapsed else 0.0}
+    result.update(dict((k + "_ms", v) for k, v in percentiles(latencies).items()))
+    return result
+
+def benchDispatch(mode, num_events, interval, timeout):
+    from actions import Actions
+    from actions_stub_server import StubServer, HEALTHY, DEAD
+
+    dead = StubServer(DEAD).start()
+    healthy = StubServer(HEALTHY).start()
+    action_defs = {
+        "hung_target": {"type": "http_get", "url": dead.url("hung_target")},
+        "ok_target": {"type": "http_get", "url": healthy.url("ok_target")},
+    }
+    actions = Actions(action_defs, timeout=timeout)
+    gpio_settings, event_triggers = makeConfig(1, 1)
+    event_triggers[0]["start_time"] = "0:00:00"
+    event_triggers[0]["end_time"] = "23:59:59"
+    backend = FakeGPIOBackend()
+    monitor = GPIOEventMonitor(gpio_settings, event_triggers, True, 1.0, backend=backend,
+                               edge_detect=True, bouncetime_ms=0)
+    inject_times = []
+    latencies = []
+    def eventCB(event):
+        if event == "test callback" or len(latencies) >= len(inject_times):
+            return
+        latencies.append((time.time() - inject_times[len(latencies)]) * 1000.0)
+        for action_str in ("hung_target", "ok_target"):
+            if mode == "async":
+                actions.processActionAsync(action_str)
+            else:
+                actions.processAction(action_str)
+    monitor.addCallback(eventCB)
+    monitor.start()
+    time.sleep(0.1)
+    level = backend.input(0)
+    for idx in range(num_events):
+        level ^= 1
+        inject_times.append(time.time())
+        backend.injectEdge(0, level)
+        time.sleep(interval)
+    # give the blocking mode a chance to drain
+    deadline = time.time() + num_events * (timeout + 0.2) * actions.retrys * 2
+    while len(latencies) < num_events and time.time() < deadline:
+        time.sleep(0.05)
+    monitor.stop()
+    dead.stop()
+    healthy.stop()
+    actions.close()
+    result = {"bench": "dispatch", "mode": mode, "events": len(latencies)}
+    result.update(dict((k + "_ms", v) for k, v in percentiles(latencies).items()))
+    return result
+
+# run in a fresh interpreter by benchStartup(), started the way
+# GarageEventProcessor's main starts: syncOutputs(), the monitor, then startup()
+STARTUP_SCRIPT = '''
+import time
+started = time.time()
+import sys
+import json
+import logging
+import threading
+sys.path.insert(0, %(path)r)
+logging.basicConfig(level=logging.CRITICAL)
+from gpioEventMonitor import GPIOEventMonitor
+from GarageEventProcessor import GarageEventProcessor
+from gpioBackend import FakeGPIOBackend
+imported = time.time()
+gpio_settings = json.load(open(%(gpio)r))
+event_triggers = json.load(open(%(events)r))
+action_defs = json.load(open(%(actions)r))
+first_event = threading.Event()
+monitor = GPIOEventMonitor(gpio_settings, event_triggers, True, 0.01, backend=FakeGPIOBackend())
+processor = GarageEventProcessor(gpio_settings, True, '', action_defs, monitor.backend)
+processor.bindEventIds(monitor.event_names)
+monitor.addCallback(lambda event_id, info=None: first_event.set(), by_id=True, queue_size=0)
+monitor.addCallback(processor.eventIdCB, by_id=True, name='garage')
+processor.syncOutputs()
+monitor.start()
+processor.startup()
+first_event.wait(30)
+ready = time.time()
+print(json.dumps({"started": started, "imported": imported, "ready": ready,
+                  "modules": sorted(m for m in ("requests", "http.server", "urllib.request") if m in sys.modules)}))
+sys.stdout.flush()
+'''
+
+def benchStartup(runs, gpio_file='GPIO.json', events_file='EventTriggers.json', actions_file='actionDefs.json'):
+    path = os.path.dirname(os.path.abspath(__file__))
+    script = STARTUP_SCRIPT % {"path": path, "gpio": os.path.join(path, gpio_file),
+                               "events": os.path.join(path, events_file),
+                               "actions": os.path.join(path, actions_file)}
+    interpreter = []
+    imports = []
+    first_event = []
+    modules = []
+    for idx in range(runs):
+        launched = time.time()
+        proc = subprocess.Popen([sys.executable, '-c', script], stdout=subprocess.PIPE)
+        out = proc.communicate()[0].decode('utf-8')
+        # the last line, after the sim mode banner
+        times = json.loads(out.strip().splitlines()[-1])
+        interpreter.append((times["started"] - launched) * 1000.0)
+        imports.append((times["imported"] - times["started"]) * 1000.0)
+        first_event.append((times["ready"] - launched) * 1000.0)
+        modules = times["modules"]
+    result = {"bench": "startup", "runs": runs, "loaded_on_critical_path": modules,
+              "interpreter_ms": percentiles(interpreter)["p50"],
+              "imports_ms": percentiles(imports)["p50"]}
+    result.update(dict(("first_event_" + k + "_ms", v) for k, v in percentiles(first_event).items()))
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmarks for the event monitor and actions')
+    parser.add_argument('-b', '--benches', type=str, default='cycle,latency,actions', help='comma separated: cycle, latency, actions, dispatch, startup')
+    parser.add_argument('-c', '--cycles', type=int, default=2000, help='monitor cycles per cycle benchmark')
+    parser.add_argument('-n', '--num_events', type=int, default=50, help='events per latency benchmark')
+    parser.add_argument('-a', '--num_actions', type=int, default=50, help='actions per actions benchmark')
+    parser.add_argument('-t', '--timeout', type=float, default=0.5, help='action timeout in seconds')
+    parser.add_argument('-d', '--delay', type=float, default=0.1, help='reply delay of the slow target')
+    parser.add_argument('-i', '--interval', type=float, default=0.1, help='seconds between edges in the dispatch benchmark')
+    parser.add_argument('-r', '--runs', type=int, default=10, help='launches per startup benchmark')
+    parser.add_argument('-o', '--output', type=str, default=None, help='file to write the results to (default: stdout)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.CRITICAL)
+
+    results = []
+    benches = args.benches.split(',')
+    if 'cycle' in benches:
+        for num_inputs in (4, 16, 32):
+            for num_triggers in (10, 100, 1000):
+                results.append(benchCycle(num_inputs, num_triggers, args.cycles))
+    if 'latency' in benches:
+        results.append(benchLatency(True, args.num_events))
+        results.append(benchLatency(False, args.num_events))
+    if 'actions' in benches:
+        for mode in ('healthy', 'slow', 'dead'):
+            results.append(benchActions(mode, args.num_actions, args.timeout, args.delay))
+    if 'dispatch' in benches:
+        for mode in ('async', 'sync'):
+            results.append(benchDispatch(mode, args.num_events, args.interval, args.timeout))
+    if 'startup' in benches:
+        results.append(benchStartup(args.runs))
+
+    out = open(args.output, 'w') if args.output else sys.stdout
+    for result in results:
+        out.write(json.dumps(result, sort_keys=True) + "\n")
+    if args.output:
+        out.close()
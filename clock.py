@@ -0,0 +1,80 @@
+import time
+import heapq
+import datetime
+import threading
+
+class SystemClock(object):
+    """ the real clock: wall time, real sleeps and threading timers """
+
+    virtual = False
+    # timers run on threads of their own
+    threaded = True
+
+    def time(self):
+        return time.time()
+
+    def now(self):
+        return datetime.datetime.now()
+
+    def sleep(self, secs):
+        time.sleep(secs)
+
+    def callLater(self, delay, func):
+        ''' calls func after delay secs, returns a timer with a cancel() method '''
+        timer = threading.Timer(delay, func)
+        timer.setDaemon(1)
+        timer.start()
+        return timer
+
+class VirtualTimer(object):
+    def __init__(self, due, func):
+        self.due = due
+        self.func = func
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+class VirtualClock(object):
+    """
+        Clock for simulations and replays.
+
+        Time only moves when advance()/advanceTo() (or sleep()) is called,
+        running the timers that fall due on the way, in order, with the
+        clock set to each timer's due time.  Nothing runs in threads, so
+        runs are reproducible and take no real time.
+    """
+
+    virtual = True
+    threaded = False
+
+    def __init__(self, start_time):
+        self.current = start_time
+        self.timers = []
+        self.seq = 0
+
+    def time(self):
+        return self.current
+
+    def now(self):
+        return datetime.datetime.fromtimestamp(self.current)
+
+    def sleep(self, secs):
+        self.advance(secs)
+
+    def callLater(self, delay, func):
+        timer = VirtualTimer(self.current + delay, func)
+        self.seq += 1
+        heapq.heappush(self.timers, (timer.due, self.seq, timer))
+        return timer
+
+    def advance(self, secs):
+        self.advanceTo(self.current + secs)
+
+    def advanceTo(self, t):
+        while self.timers and self.timers[0][0] <= t:
+            due, seq, timer = heapq.heappop(self.timers)
+            if not timer.cancelled:
+                self.current = max(self.current, due)
+                timer.func()
+        self.current = max(self.current, t)
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+'''
+Collector for the data logs of many event processors (Python 3 only).
+
+Event processors started with a data log uri of the form
+collector://host:port/site_name send their data log entries here in
+batches (see CollectorSender in dataLogger.py), over a line protocol:
+
+  SITE <site name>
+  <timestamp> <entry>        (ie, 1767225600.123 &door_status=1&motion_detected=0)
+  ...
+  END                        -> answered with "OK <number of entries taken>"
+
+Any number of batches can follow on the same connection.  Each entry's
+fields are indexed per site: the latest value of every field, and the
+count of every field=value per hour, kept for retention_hours.  The
+index is served as JSON over HTTP:
+
+  /sites                                   every site, its last entry and latest field values
+  /open?field=door_status&value=1          the sites whose latest field value is 'value', and since when
+  /hourly?field=motion_detected&value=1    count of field=value per hour (&hours=24, &site=name)
+
+Use to test:
+
+python collector.py -p 7070 -q 8070
+python GarageEventProcessor.py -g GPIO.json -e EventTriggers.json -a actionDefs.json -u collector://localhost:7070/garage_1
+curl http://localhost:8070/open
+'''
+
+import json
+import time
+import asyncio
+import argparse
+import logging
+from urllib.parse import urlparse, parse_qsl
+
+logger = logging.getLogger("Collector")
+
+class SiteIndex(object):
+    """ latest field values and hourly field=value counts of one site """
+
+    def __init__(self, site):
+        self.site = site
+        # field -> [timestamp, value, timestamp of the last change]
+        self.state = {}
+        # hour start -> {"field=value": count}
+        self.buckets = {}
+        self.last_seen = 0
+        self.entries = 0
+
+    def add(self, ts, fields):
+        self.entries += 1
+        self.last_seen = max(self.last_seen, ts)
+        hour = int(ts // 3600) * 3600
+        counts = self.buckets.get(hour)
+        if counts is None:
+            counts = self.buckets[hour] = {}
+        for field, value in fields:
+            key = "%s=%s" % (field, value)
+            counts[key] = counts.get(key, 0) + 1
+            last = self.state.get(field)
+            if last is None:
+                self.state[field] = [ts, value, ts]
+            elif ts >= last[0]:
+                if value != last[1]:
+                    last[2] = ts
+                last[0] = ts
+                last[1] = value
+
+    def prune(self, oldest_hour):
+        for hour in [h for h in self.buckets if h < oldest_hour]:
+            del self.buckets[hour]
+
+class Collector(object):
+    """
+        In-memory index of the entries sent by every site, with the
+        ingest (line protocol) and query (HTTP) servers on one event loop.
+    """
+
+    def __init__(self, retention_hours=24 * 7):
+        self.retention_hours = retention_hours
+        self.sites = {}
+        self.received = 0
+        self.rejected = 0
+
+    def ingest(self, site, line):
+        ''' indexes one "<timestamp> <entry>" line, returns False if it's malformed '''
+        ts, _, entry = line.partition(' ')
+        try:
+            ts = float(ts)
+        except ValueError:
+            self.rejected += 1
+            return False
+        fields = parse_qsl(entry.strip().lstrip("&?"))
+        if not fields:
+            self.rejected += 1
+            return False
+        index = self.sites.get(site)
+        if index is None:
+            index = self.sites[site] = SiteIndex(site)
+            logger.info("New site: %s" % (site))
+        index.add(ts, fields)
+        self.received += 1
+        return True
+
+    def prune(self, now=None):
+        if now is None:
+            now = time.time()
+        oldest_hour = int(now // 3600) * 3600 - self.retention_hours * 3600
+        for index in self.sites.values():
+            index.prune(oldest_hour)
+
+    def siteSummary(self):
+        return dict((site, {"last_seen": index.last_seen, "entries": index.entries,
+                            "state": dict((field, s[1]) for field, s in index.state.items())})
+                    for site, index in self.sites.items())
+
+    def sitesWith(self, field, value):
+        ''' returns [(site, since)] of the sites whose latest 'field' is 'value' '''
+        sites = []
+        for site, index in self.sites.items():
+            state = index.state.get(field)
+            if state is not None and state[1] == value:
+                sites.append((site, state[2]))
+        return sorted(sites)
+
+    def hourly(self, field, value, hours=24, site=None, now=None):
+        ''' returns [(hour start, count of field=value)] over the last 'hours', for one site or all '''
+        if now is None:
+            now = time.time()
+        key = "%s=%s" % (field, value)
+        last_hour = int(now // 3600) * 3600
+        hour_starts = [last_hour - idx * 3600 for idx in range(hours - 1, -1, -1)]
+        if site is not None:
+            indexes = [self.sites[site]] if site in self.sites else []
+        else:
+            indexes = list(self.sites.values())
+        result = []
+        for hour in hour_starts:
+            cnt = 0
+            for index in indexes:
+                counts = index.buckets.get(hour)
+                if counts is not None:
+                    cnt += counts.get(key, 0)
+            result.append((hour, cnt))
+        return result
+
+    async def handleIngest(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        site = None
+        taken = 0
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                line = line.decode('utf-8', 'replace').rstrip('\r\n')
+                if line.startswith('SITE '):
+                    site = line[5:].strip()
+                elif line == 'END':
+                    # malformed entries are counted as taken, so a bad
+                    # one can't hold up the sender's queue forever
+                    writer.write(("OK %d\n" % (taken)).encode('ascii'))
+                    await writer.drain()
+                    taken = 0
+                elif site is None:
+                    writer.write(b"ERROR no SITE\n")
+                    break
+                elif line:
+                    if not self.ingest(site, line):
+                        logger.warning("Malformed entry from %s (%s): %s" % (site, peer, line))
+                    taken += 1
+        except (OSError, asyncio.IncompleteReadError) as e:
+            logger.warning("Connection from %s (%s) failed: %s" % (site, peer, e))
+        finally:
+            writer.close()
+
+    def query(self, path):
+        ''' returns (status, reply object) for a query path '''
+        parts = urlparse(path)
+        params = dict(parse_qsl(parts.query))
+        if parts.path == '/sites':
+            return 200, self.siteSummary()
+        if parts.path == '/open':
+            field = params.get('field', 'door_status')
+            sites = self.sitesWith(field, params.get('value', '1'))
+            return 200, {"field": field, "count": len(sites),
+                         "sites": [{"site": site, "since": since} for site, since in sites]}
+        if parts.path == '/hourly':
+            field = params.get('field', 'motion_detected')
+            value = params.get('value', '1')
+            try:
+                hours = max(1, min(int(params.get('hours', 24)), self.retention_hours))
+            except ValueError:
+                return 400, {"error": "bad hours"}
+            counts = self.hourly(field, value, hours, params.get('site'))
+            return 200, {"field": field, "value": value, "site": params.get('site'),
+                         "hours": [[hour, cnt] for hour, cnt in counts]}
+        return 404, {"error": "not found"}
+
+    async def handleQuery(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+            fields = request_line.decode('latin-1').split()
+            if len(fields) < 2 or fields[0] != 'GET':
+                status, reply = 400, {"error": "bad request"}
+            else:
+                status, reply = self.query(fields[1])
+            body = json.dumps(reply, sort_keys=True).encode('utf-8')
+            writer.write(("HTTP/1.1 %d %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\n"
+                          "Connection: close\r\n\r\n" % (status, "OK" if status == 200 else "Error", len(body))).encode('latin-1'))
+            writer.write(body)
+            await writer.drain()
+        except OSError as e:
+            logger.warning("Query failed: %s" % (e))
+        finally:
+            writer.close()
+
+    async def pruneLoop(self, interval=60.0):
+        while True:
+            await asyncio.sleep(interval)
+            self.prune()
+
+    async def serve(self, ingest_port, query_port, host=''):
+        ingest_server = await asyncio.start_server(self.handleIngest, host or None, ingest_port)
+        query_server = await asyncio.start_server(self.handleQuery, host or None, query_port)
+        logger.info("Collecting on port %d, serving queries on port %d" % (ingest_port, query_port))
+        prune_task = asyncio.ensure_future(self.pruneLoop())
+        try:
+            await asyncio.gather(ingest_server.serve_forever(), query_server.serve_forever())
+        finally:
+            prune_task.cancel()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Collects and indexes the data logs of many event processors')
+    parser.add_argument('-p', '--port', type=int, default=7070, help='port the event processors send to')
+    parser.add_argument('-q', '--query_port', type=int, default=8070, help='port serving the HTTP queries')
+    parser.add_argument('-H', '--host', type=str, default='', help='address to listen on (default: all)')
+    parser.add_argument('-r', '--retention_hours', type=int, default=24 * 7, help='hours of hourly counts to keep')
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s.%(msecs)03d (%(name)10s) [%(levelname)7s]: %(message)s',
+        datefmt='%Y-%m-%d %H:%M:%S')
+
+    collector = Collector(args.retention_hours)
+    try:
+        asyncio.run(collector.serve(args.port, args.query_port, args.host))
+    except KeyboardInterrupt:
+        pass
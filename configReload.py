@@ -0,0 +1,82 @@
+import os
+import json
+import time
+import signal
+import threading
+import logging
+
+logger = logging.getLogger("ConfigReload")
+
+class ConfigReloader(object):
+    """
+        Reloads the GPIO, trigger and action files of a running monitor
+        and processor, on SIGHUP (see installSignalHandler()) and/or when
+        the files change (see startWatching()).
+
+        All three files are loaded and compiled before anything is
+        swapped in, so a broken file is logged and the running config
+        kept.  The actions are swapped right away, the GPIO settings and
+        triggers by the monitor between two cycles.  The processor's own
+        state (door state, timers, ...) is kept.
+    """
+
+    def __init__(self, gpio_file, events_file, actions_file, monitor, actions=None, required_actions=None):
+        self.files = [gpio_file, events_file, actions_file]
+        self.monitor = monitor
+        self.actions = actions
+        self.required_actions = required_actions
+        self.mtimes = self.getMtimes()
+        self.lock = threading.Lock()
+        self.watch_thread = None
+        self.reloads = 0
+
+    def getMtimes(self):
+        mtimes = []
+        for path in self.files:
+            try:
+                mtimes.append(os.stat(path).st_mtime)
+            except OSError:
+                mtimes.append(None)
+        return mtimes
+
+    def reload(self):
+        ''' returns True if the new config was valid and handed over '''
+        with self.lock:
+            self.mtimes = self.getMtimes()
+            try:
+                gpio_settings, event_triggers, action_defs = [json.load(open(path, 'r')) for path in self.files]
+                config = self.monitor.compileConfig(gpio_settings, event_triggers)
+                compiled = None
+                if self.actions is not None:
+                    compiled = self.actions.compileActions(action_defs, self.required_actions)
+            except (IOError, OSError, ValueError, KeyError, TypeError, IndexError) as e:
+                logger.error("Config not reloaded, keeping the running one: %s" % (e))
+                return False
+            if compiled is not None:
+                self.actions.swapActions(action_defs, *compiled)
+            self.monitor.applyConfig(config)
+            self.reloads += 1
+            logger.info("Reloaded %s" % (', '.join(self.files)))
+            return True
+
+    def checkFiles(self):
+        ''' reloads if any of the files changed since the last (re)load '''
+        if self.getMtimes() != self.mtimes:
+            return self.reload()
+        return False
+
+    def installSignalHandler(self, signum=signal.SIGHUP):
+        signal.signal(signum, lambda signum, frame: self.reload())
+
+    def startWatching(self, interval=5.0):
+        self.watch_thread = threading.Thread(target=self.watch, args=(interval,), name="config-watch")
+        self.watch_thread.setDaemon(1)
+        self.watch_thread.start()
+
+    def watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.checkFiles()
+            except Exception as e:
+                logger.error("Error checking the config files: %s" % (e))
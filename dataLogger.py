@@ -0,0 +1,264 @@
+import os
+import time
+import socket
+import threading
+import logging
+from collections import deque
+try:
+    from urlparse import urlparse
+except ImportError:
+    from urllib.parse import urlparse
+
+logger = logging.getLogger("DataLog")
+
+class HttpGetSender(object):
+    """ sends each data log entry as a GET to uri_base + entry """
+
+    # entries are sent as they were logged
+    stamp = False
+
+    def __init__(self, uri_base, timeout=10):
+        self.uri_base = uri_base
+        self.timeout = timeout
+
+    def send(self, entries):
+        '''
+        sends the entries in order, stopping at the first failure.
+        Returns the number of entries sent.
+        '''
+        # imported here, as the HTTP client stack is slow to import at startup
+        try:
+            from urllib2 import urlopen
+        except ImportError:
+            from urllib.request import urlopen
+        for idx, data in enumerate(entries):
+            try:
+                rep = urlopen("%s%s" % (self.uri_base, data), timeout=self.timeout).read()
+                logger.info("Logging data: %s. reply: %s" % (data, rep))
+            except Exception as e:
+                logger.warn("Error connecting to data logger: %s" % (e))
+                return idx
+        return len(entries)
+
+class CollectorSender(object):
+    """
+        sends batches of data log entries to a collector (see
+        collector.py), over one connection kept open between batches.
+        Entries are sent as "<timestamp> <entry>" lines.
+    """
+
+    # the pipeline prefixes the entries with the time they were logged
+    stamp = True
+
+    def __init__(self, host, port, site, timeout=10):
+        self.host = host
+        self.port = port
+        self.site = site
+        self.timeout = timeout
+        self.sock = None
+        self.reader = None
+
+    def connect(self):
+        self.sock = socket.create_connection((self.host, self.port), self.timeout)
+        self.reader = self.sock.makefile('rb')
+        self.sock.sendall(("SITE %s\n" % (self.site)).encode('utf-8'))
+
+    def close(self):
+        if self.sock is not None:
+            self.reader.close()
+            self.sock.close()
+            self.sock = None
+
+    def send(self, entries):
+        '''
+        sends the entries as one batch.  Returns the number of entries
+        the collector took (0 if it couldn't be reached).
+        '''
+        try:
+            if self.sock is None:
+                self.connect()
+            self.sock.sendall(("".join("%s\n" % (data) for data in entries) + "END\n").encode('utf-8'))
+            reply = self.reader.readline().decode('utf-8').split()
+            if len(reply) != 2 or reply[0] != 'OK':
+                raise ValueError("bad reply from collector: %s" % (' '.join(reply)))
+            logger.info("Sent %s entries to collector %s:%d" % (reply[1], self.host, self.port))
+            return min(int(reply[1]), len(entries))
+        except (socket.error, ValueError) as e:
+            logger.warn("Error sending to collector: %s" % (e))
+            self.close()
+            return 0
+
+def makeSender(uri, timeout=10):
+    '''
+    returns the sender for a data log uri: a CollectorSender for
+    collector://host:port/site uris, an HttpGetSender otherwise
+    '''
+    if uri.startswith('collector://'):
+        parts = urlparse(uri)
+        site = parts.path.strip('/') or socket.gethostname()
+        return CollectorSender(parts.hostname, parts.port or 7070, site, timeout)
+    return HttpGetSender(uri, timeout)
+
+class DataLogPipeline(object):
+    """
+        Background data log pipeline.
+
+        log() only appends to a bounded in-memory queue; a worker thread
+        sends the entries in batches, once batch_size entries are queued
+        or the oldest has waited batch_time seconds.  Failed sends are
+        retried with exponential backoff (up to max_backoff seconds);
+        nothing is sent before the retry is due, however many entries
+        are logged meanwhile.
+
+        Entries are prefixed with the time they were logged if the
+        sender's 'stamp' is set, as they may be sent much later.
+
+        If a spill_file is given, entries that don't fit in the queue
+        are moved to it (oldest first) instead of being dropped, the
+        queue is saved to it on stop(), and it is sent before the queue
+        on the next start, so outages and restarts don't lose data.
+    """
+
+    def __init__(self, sender, queue_size=1000, batch_size=20, batch_time=5.0,
+                 max_backoff=300.0, spill_file=None):
+        self.sender = sender
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.batch_time = batch_time
+        self.max_backoff = max_backoff
+        self.spill_file = os.path.expanduser(spill_file) if spill_file else None
+        self.queue = deque()
+        self.first_queued_time = 0
+        self.backoff = 0
+        self.retry_at = 0
+        self.overflowed = 0
+        self.dropped = 0
+        self.sent = 0
+        self.cond = threading.Condition()
+        self.alive = False
+
+    def start(self):
+        self.alive = True
+        self.thread = threading.Thread(target=self.run, name="data-log")
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def stop(self, timeout=5.0):
+        with self.cond:
+            self.alive = False
+            self.cond.notify()
+        self.thread.join(timeout)
+        with self.cond:
+            if self.spill_file and self.queue:
+                self.spillEntries(list(self.queue))
+                self.queue.clear()
+
+    def log(self, data):
+        if self.sender.stamp:
+            data = "%0.3f %s" % (time.time(), data)
+        with self.cond:
+            if not self.queue:
+                self.first_queued_time = time.time()
+            self.queue.append(data)
+            if len(self.queue) > self.queue_size:
+                oldest = self.queue.popleft()
+                self.overflowed += 1
+                if self.spill_file:
+                    self.spillEntries([oldest])
+                else:
+                    self.dropped += 1
+            # wake the worker to start timing the batch, or to send it,
+            # unless it's backing off
+            if not self.retry_at and (len(self.queue) == 1 or len(self.queue) >= self.batch_size):
+                self.cond.notify()
+
+    def spillEntries(self, entries):
+        try:
+            with open(self.spill_file, 'a') as f:
+                for data in entries:
+                    f.write(data + '\n')
+        except (IOError, OSError) as e:
+            logger.error("Error writing data log spill file: %s" % (e))
+            self.dropped += len(entries)
+
+    def sendSpilled(self):
+        '''
+        sends the spilled entries, oldest first.  The spill file is
+        renamed while being sent, so log() can keep appending to a new
+        one.  Returns False if sending failed.
+        '''
+        sending_file = self.spill_file + '.sending'
+        with self.cond:
+            if not os.path.exists(sending_file):
+                if not os.path.exists(self.spill_file):
+                    return True
+                os.rename(self.spill_file, sending_file)
+        with open(sending_file) as f:
+            entries = [line.rstrip('\n') for line in f if line.strip()]
+        while entries:
+            batch = entries[:self.batch_size]
+            cnt = self.sender.send(batch)
+            self.sent += cnt
+            entries = entries[cnt:]
+            if cnt < len(batch):
+                tmp_file = sending_file + '.tmp'
+                with open(tmp_file, 'w') as f:
+                    for data in entries:
+                        f.write(data + '\n')
+                os.rename(tmp_file, sending_file)
+                return False
+        os.remove(sending_file)
+        return True
+
+    def nextBatch(self):
+        ''' waits for a batch to be due and returns it (empty when stopping) '''
+        with self.cond:
+            while self.alive:
+                if self.queue:
+                    wait = self.first_queued_time + self.batch_time - time.time()
+                    if len(self.queue) >= self.batch_size or wait <= 0:
+                        self.overflowed = 0
+                        return [self.queue[idx] for idx in range(min(self.batch_size, len(self.queue)))]
+                    self.cond.wait(wait)
+                else:
+                    self.cond.wait()
+            return []
+
+    def retryLater(self):
+        self.backoff = min(self.max_backoff, self.backoff * 2) if self.backoff else 1.0
+        logger.warn("Data logger unavailable, retrying in %0.1fs" % (self.backoff))
+        with self.cond:
+            self.retry_at = time.time() + self.backoff
+
+    def waitForRetry(self):
+        ''' waits for a pending retry to be due, returns False when stopping '''
+        with self.cond:
+            while self.alive and self.retry_at:
+                wait = self.retry_at - time.time()
+                if wait <= 0:
+                    self.retry_at = 0
+                    break
+                self.cond.wait(wait)
+            return self.alive
+
+    def run(self):
+        while self.waitForRetry():
+            if self.spill_file and not self.sendSpilled():
+                self.retryLater()
+                continue
+            batch = self.nextBatch()
+            if not batch:
+                continue
+            cnt = self.sender.send(batch)
+            with self.cond:
+                # the sent entries are still at the head of the queue,
+                # unless log() pushed them out meanwhile (in which case
+                # a spilled entry may be sent twice, never lost)
+                for idx in range(min(max(0, cnt - self.overflowed), len(self.queue))):
+                    self.queue.popleft()
+                self.first_queued_time = time.time()
+            self.sent += cnt
+            if cnt < len(batch):
+                self.retryLater()
+            else:
+                self.backoff = 0
@@ -0,0 +1,151 @@
+import logging
+
+logger = logging.getLogger("Coalescer")
+
+class CoalesceKey(object):
+    """ window and token bucket state shared by the events with one dedupe key """
+
+    def __init__(self, key):
+        self.key = key
+        self.window = 0
+        self.summary_event = None
+        self.rate = 0
+        self.burst = 0
+        self.tokens = 0
+        self.refill_time = 0
+        # open window
+        self.window_end = None
+        self.count = 0
+        self.suppressed = 0
+        self.rate_limited = 0
+        self.first_time = 0
+        self.last_time = 0
+
+class EventCoalescer(object):
+    """
+        Coalescing and rate limiting stage between the monitor and the
+        processors, configured per input event in the trigger file:
+
+          "coalesce":   {"window": secs, "key": name, "summary_event": name}
+          "rate_limit": {"rate": events per sec, "burst": max burst}
+
+        Events sharing a dedupe 'key' (defaults to the event name) share
+        one window and one token bucket.  The first event of a window is
+        passed on right away; the others are counted but suppressed until
+        the window closes, when 'summary_event' (if any) is sent with a
+        dict of count, suppressed, rate_limited, first_time and last_time.
+        Events over the token bucket rate are dropped.
+
+        All calls are made from the monitor thread, with the monitor's
+        event ids.
+    """
+
+    def __init__(self, event_triggers, schedule):
+        self.by_id = [None] * len(schedule.event_names)
+        self.keys = {}
+        self.open_keys = []
+        for trigger in event_triggers:
+            for input_event in trigger['input_events']:
+                if 'coalesce' in input_event or 'rate_limit' in input_event:
+                    self.configure(input_event, schedule)
+
+    def configure(self, input_event, schedule):
+        event = input_event['event']
+        coalesce = input_event.get('coalesce', {})
+        rate_limit = input_event.get('rate_limit', {})
+        name = coalesce.get('key', event)
+        key = self.keys.get(name)
+        if key is None:
+            key = self.keys[name] = CoalesceKey(name)
+        if coalesce:
+            key.window = float(coalesce['window'])
+            if 'summary_event' in coalesce:
+                key.summary_event = coalesce['summary_event']
+                key.summary_event_id = schedule.eventId(key.summary_event)
+        if rate_limit:
+            key.rate = float(rate_limit['rate'])
+            key.burst = float(rate_limit.get('burst', 1))
+            key.tokens = key.burst
+        event_id = schedule.event_ids[event]
+        while len(self.by_id) < len(schedule.event_names):
+            self.by_id.append(None)
+        self.by_id[event_id] = key
+
+    def admit(self, event_id, now):
+        ''' returns True if the event should be passed on '''
+        key = self.by_id[event_id]
+        if key is None:
+            return True
+        if key.window_end is not None:
+            key.count += 1
+            key.suppressed += 1
+            key.last_time = now
+            return False
+        if key.rate:
+            key.tokens = min(key.burst, key.tokens + (now - key.refill_time) * key.rate)
+            key.refill_time = now
+            if key.tokens < 1:
+                key.rate_limited += 1
+                return False
+            key.tokens -= 1
+        if key.window:
+            key.window_end = now + key.window
+            key.count = 1
+            key.suppressed = 0
+            key.rate_limited = 0
+            key.first_time = key.last_time = now
+            self.open_keys.append(key)
+        return True
+
+    def hasOpenWindows(self):
+        return len(self.open_keys) > 0
+
+    def closeWindows(self, now):
+        ''' closes the windows that are over, returns [(summary event, event id, info)] '''
+        summaries = []
+        for key in [k for k in self.open_keys if k.window_end <= now]:
+            self.open_keys.remove(key)
+            key.window_end = None
+            if key.summary_event is not None:
+                info = {
+                    "key": key.key,
+                    "count": key.count,
+                    "suppressed": key.suppressed,
+                    "rate_limited": key.rate_limited,
+                    "first_time": key.first_time,
+                    "last_time": key.last_time,
+                }
+                summaries.append((key.summary_event, key.summary_event_id, info))
+        return summaries
+
+    def getState(self):
+        ''' returns the open windows, to be restored with restoreState() '''
+        state = {}
+        for key in list(self.open_keys):
+            state[key.key] = {
+                "window_end": key.window_end,
+                "count": key.count,
+                "suppressed": key.suppressed,
+                "rate_limited": key.rate_limited,
+                "first_time": key.first_time,
+                "last_time": key.last_time,
+            }
+        return state
+
+    def restoreState(self, state):
+        '''
+        reopens the windows saved by getState(), for the keys still
+        configured.  Windows that are over close on the next cycle, so
+        the events counted before a restart still get their summary.
+        '''
+        for name, saved in state.items():
+            key = self.keys.get(name)
+            if key is None or not key.window or key.window_end is not None:
+                continue
+            key.window_end = saved['window_end']
+            key.count = saved['count']
+            key.suppressed = saved['suppressed']
+            key.rate_limited = saved['rate_limited']
+            key.first_time = saved['first_time']
+            key.last_time = saved['last_time']
+            self.open_keys.append(key)
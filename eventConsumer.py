@@ -0,0 +1,103 @@
+import time
+import threading
+import logging
+from collections import deque
+
+(DROP_OLDEST, COALESCE, BLOCK) = ('drop_oldest', 'coalesce', 'block')
+
+logger = logging.getLogger("EventConsumer")
+
+class EventConsumer(object):
+    """
+        Delivers events to one callback from its own bounded queue and
+        worker thread, so a slow consumer doesn't hold up the monitor or
+        the other consumers.
+
+        When the queue is full, the overflow policy decides:
+          drop_oldest - the oldest queued event is dropped
+          coalesce    - if the newest queued event is the same event, it's
+                        replaced by the new one (and its info); otherwise
+                        the oldest one is dropped.  Only back to back
+                        repeats are merged, so the order of different
+                        events is kept
+          block       - the caller waits for room in the queue
+    """
+
+    def __init__(self, callback, queue_size=100, overflow=DROP_OLDEST, name=None):
+        if overflow not in (DROP_OLDEST, COALESCE, BLOCK):
+            raise ValueError("Invalid overflow policy: %s" % (overflow))
+        self.callback = callback
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.name = name if name is not None else getattr(callback, '__name__', 'consumer')
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.alive = True
+        # metrics
+        self.delivered = 0
+        self.dropped = 0
+        self.coalesced = 0
+        self.max_depth = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.thread = threading.Thread(target=self.run, name="consumer-%s" % (self.name))
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def put(self, event, info=None):
+        with self.cond:
+            while len(self.queue) >= self.queue_size:
+                if self.overflow == BLOCK and self.alive:
+                    self.cond.wait()
+                    continue
+                if self.overflow == COALESCE and self.queue and self.queue[-1][0] == event:
+                    self.queue[-1] = (event, info, self.queue[-1][2])
+                    self.coalesced += 1
+                    return
+                self.dropEvent(self.queue.popleft()[0])
+            self.queue.append((event, info, time.time()))
+            if len(self.queue) > self.max_depth:
+                self.max_depth = len(self.queue)
+            self.cond.notify_all()
+
+    def dropEvent(self, event):
+        self.dropped += 1
+        logger.warn("%s: queue full, dropped event %s" % (self.name, event))
+
+    def stop(self):
+        with self.cond:
+            self.alive = False
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.alive and not self.queue:
+                    self.cond.wait()
+                if not self.alive:
+                    return
+                event, info, queued_time = self.queue.popleft()
+                self.cond.notify_all()
+            lag = time.time() - queued_time
+            self.last_lag = lag
+            if lag > self.max_lag:
+                self.max_lag = lag
+            try:
+                if info is None:
+                    self.callback(event)
+                else:
+                    self.callback(event, info)
+            except Exception as e:
+                logger.exception("%s: error handling event %s: %s" % (self.name, event, e))
+            self.delivered += 1
+
+    def getMetrics(self):
+        return {
+            "depth": len(self.queue),
+            "max_depth": self.max_depth,
+            "delivered": self.delivered,
+            "dropped": self.dropped,
+            "coalesced": self.coalesced,
+            "last_lag": self.last_lag,
+            "max_lag": self.max_lag,
+        }
@@ -0,0 +1,225 @@
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+import logging
+
+logger = logging.getLogger("EventJournal")
+
+# timestamp (usecs since the epoch), input bitmask, event id (+ padding)
+RECORD = struct.Struct('<QQH6x')
+RECORD_SIZE = RECORD.size
+SEGMENT_PREFIX = 'journal-'
+SEGMENT_SUFFIX = '.bin'
+EVENT_NAMES_FILE = 'events.json'
+
+def segmentPath(journal_dir, segment_no):
+    return os.path.join(journal_dir, "%s%06d%s" % (SEGMENT_PREFIX, segment_no, SEGMENT_SUFFIX))
+
+def listSegments(journal_dir):
+    ''' returns the (segment no, path) of all segments, oldest first '''
+    segments = []
+    for name in os.listdir(journal_dir):
+        if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX):
+            segments.append((int(name[len(SEGMENT_PREFIX):-len(SEGMENT_SUFFIX)]), os.path.join(journal_dir, name)))
+    return sorted(segments)
+
+class EventJournalWriter(object):
+    """
+        Append-only journal of the dispatched events, as fixed size
+        binary records (timestamp, input bitmask, event id).
+
+        Records are buffered in memory and written every flush_records
+        records or flush_interval seconds, to keep the SD card writes
+        down.  A new segment file is started every segment_records
+        records.  The journal numbers the event names itself, in
+        events.json, so records stay readable when the triggers (and so
+        the monitor's event ids) change between runs.
+    """
+
+    def __init__(self, journal_dir, event_names, segment_records=1000000,
+                 flush_records=256, flush_interval=10.0):
+        self.journal_dir = os.path.expanduser(journal_dir)
+        if not os.path.isdir(self.journal_dir):
+            os.makedirs(self.journal_dir)
+        self.event_names = event_names
+        self.segment_records = segment_records
+        self.flush_records = flush_records
+        self.flush_interval = flush_interval
+        self.buffer = bytearray()
+        self.buffered = 0
+        self.last_flush = time.time()
+        self.lock = threading.Lock()
+        self.journal_names = []
+        names_path = os.path.join(self.journal_dir, EVENT_NAMES_FILE)
+        if os.path.exists(names_path):
+            with open(names_path) as f:
+                self.journal_names = json.load(f)
+        self.saved_event_names = len(self.journal_names)
+        # monitor event id -> journal event id
+        self.id_map = []
+        self.file = None
+
+        segments = listSegments(self.journal_dir)
+        if segments:
+            self.segment_no, path = segments[-1]
+            # drop a torn record left by a crash
+            size = os.path.getsize(path)
+            self.segment_count = size // RECORD_SIZE
+            if size % RECORD_SIZE:
+                with open(path, 'r+b') as f:
+                    f.truncate(self.segment_count * RECORD_SIZE)
+        else:
+            self.segment_no = 0
+            self.segment_count = 0
+        self.openSegment()
+
+    def openSegment(self):
+        if self.file is not None:
+            self.file.close()
+        self.file = open(segmentPath(self.journal_dir, self.segment_no), 'ab')
+
+    def journalId(self, event_id):
+        if event_id >= len(self.id_map):
+            ids = dict((name, idx) for idx, name in enumerate(self.journal_names))
+            for name in self.event_names[len(self.id_map):]:
+                if name not in ids:
+                    ids[name] = len(self.journal_names)
+                    self.journal_names.append(name)
+                self.id_map.append(ids[name])
+        return self.id_map[event_id]
+
+    def record(self, event_id, input_word, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            self.buffer += RECORD.pack(int(timestamp * 1000000), input_word, self.journalId(event_id))
+            self.buffered += 1
+            if self.buffered >= self.flush_records or timestamp - self.last_flush >= self.flush_interval:
+                self.flushLocked(timestamp)
+
+    def flushIfDue(self, now=None):
+        ''' flushes the buffered records if they've waited flush_interval '''
+        if now is None:
+            now = time.time()
+        if self.buffered and now - self.last_flush >= self.flush_interval:
+            self.flush(now)
+
+    def flush(self, now=None):
+        with self.lock:
+            self.flushLocked(now if now is not None else time.time())
+
+    def flushLocked(self, now):
+        self.last_flush = now
+        if len(self.journal_names) != self.saved_event_names:
+            self.saveEventNames()
+        data = memoryview(self.buffer)
+        while data:
+            room = self.segment_records - self.segment_count
+            if room <= 0:
+                self.file.close()
+                self.segment_no += 1
+                self.segment_count = 0
+                self.openSegment()
+                continue
+            chunk = data[:room * RECORD_SIZE]
+            self.file.write(chunk)
+            self.segment_count += len(chunk) // RECORD_SIZE
+            data = data[len(chunk):]
+        self.file.flush()
+        self.buffer = bytearray()
+        self.buffered = 0
+
+    def saveEventNames(self):
+        path = os.path.join(self.journal_dir, EVENT_NAMES_FILE)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(self.journal_names, f)
+        os.rename(path + '.tmp', path)
+        self.saved_event_names = len(self.journal_names)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+class EventJournalReader(object):
+    """
+        Reads the journal segments through mmap, without copying them.
+
+        records() yields (timestamp, input bitmask, event id) tuples,
+        optionally limited to a time range and/or a set of event names.
+    """
+
+    def __init__(self, journal_dir):
+        self.journal_dir = os.path.expanduser(journal_dir)
+        path = os.path.join(self.journal_dir, EVENT_NAMES_FILE)
+        self.event_names = []
+        if os.path.exists(path):
+            with open(path) as f:
+                self.event_names = json.load(f)
+        self.event_ids = dict((name, idx) for idx, name in enumerate(self.event_names))
+
+    def records(self, since=None, until=None, events=None):
+        since_us = int(since * 1000000) if since is not None else 0
+        until_us = int(until * 1000000) if until is not None else None
+        event_ids = None
+        if events is not None:
+            event_ids = set(self.event_ids[e] for e in events if e in self.event_ids)
+        for segment_no, path in listSegments(self.journal_dir):
+            size = os.path.getsize(path) // RECORD_SIZE * RECORD_SIZE
+            if size == 0:
+                continue
+            with open(path, 'rb') as f:
+                mem = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+                try:
+                    # segments are in time order, skip a whole segment
+                    # if its last record is too old
+                    if RECORD.unpack_from(mem, size - RECORD_SIZE)[0] < since_us:
+                        continue
+                    for offset in range(0, size, RECORD_SIZE):
+                        ts, word, event_id = RECORD.unpack_from(mem, offset)
+                        if ts < since_us:
+                            continue
+                        if until_us is not None and ts > until_us:
+                            return
+                        if event_ids is None or event_id in event_ids:
+                            yield ts / 1000000.0, word, event_id
+                finally:
+                    mem.close()
+
+    def eventName(self, event_id):
+        return self.event_names[event_id]
+
+    def durations(self, start_event, end_event, since=None, until=None):
+        '''
+        returns the [(start time, duration)] of each period from a
+        start_event to the next end_event, ie, how long the door was open
+        '''
+        periods = []
+        start_id = self.event_ids.get(start_event)
+        opened = None
+        for ts, word, event_id in self.records(since, until, [start_event, end_event]):
+            if event_id == start_id:
+                if opened is None:
+                    opened = ts
+            elif opened is not None:
+                periods.append((opened, ts - opened))
+                opened = None
+        return periods
+
+if __name__ == '__main__':
+    import argparse
+    import datetime
+
+    parser = argparse.ArgumentParser(description='Queries an event journal')
+    parser.add_argument('journal_dir', help='journal directory')
+    parser.add_argument('-d', '--days', type=float, default=30, help='how many days back to look')
+    parser.add_argument('-o', '--open_event', default='Garage_open_normal', help='event starting a period')
+    parser.add_argument('-c', '--close_event', default='Garage_closed', help='event ending a period')
+    args = parser.parse_args()
+
+    reader = EventJournalReader(args.journal_dir)
+    since = time.time() - args.days * 24 * 60 * 60
+    for start, duration in reader.durations(args.open_event, args.close_event, since):
+        print("%s  open for %ds" % (datetime.datetime.fromtimestamp(start).strftime('%Y-%m-%d %H:%M:%S'), duration))
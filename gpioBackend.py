@@ -0,0 +1,229 @@
+import os
+import time
+import mmap
+import struct
+import threading
+import logging
+from random import randint, getrandbits
+
+try:
+    import RPi.GPIO as io
+except ImportError:
+    io = None
+
+(LOW, HIGH) = range(2)
+
+# BCM283x GPIO register block: GPLEV0/GPLEV1 hold the levels of pins 0-53
+GPIO_MEM_SIZE = 4096
+GPLEV0 = 0x34
+
+logger = logging.getLogger("GPIOBackend")
+
+class RPiGPIOBackend(object):
+    """
+        GPIO backend using the RPi.GPIO library (real hardware).
+
+        Pins are BCM numbered.  Edge callbacks are called from the
+        RPi.GPIO event thread as callback(pin, level).
+
+        readMask(mask) returns the levels of all pins in mask as a bitmask
+        (bit n = BCM pin n).  RPi.GPIO can only read one pin at a time,
+        see MmapGPIOBackend for a single-read version.
+    """
+
+    def __init__(self):
+        if io is None:
+            raise ImportError("RPi.GPIO is not available")
+        io.setwarnings(False)
+        io.setmode(io.BCM)
+
+    def setupInput(self, pin, pull_up):
+        if pull_up:
+            io.setup(pin, io.IN, pull_up_down=io.PUD_UP)
+        else:
+            io.setup(pin, io.IN)
+
+    def setupOutput(self, pin):
+        io.setup(pin, io.OUT)
+
+    def input(self, pin):
+        return io.input(pin)
+
+    def readMask(self, mask):
+        levels = 0
+        pin = 0
+        while mask >> pin:
+            if (mask >> pin) & 1 and io.input(pin):
+                levels |= 1 << pin
+            pin += 1
+        return levels
+
+    def output(self, pin, level):
+        io.output(pin, io.HIGH if level else io.LOW)
+
+    def addEdgeCallback(self, pin, callback, bouncetime_ms=0):
+        def edgeCB(channel):
+            callback(channel, io.input(channel))
+        if bouncetime_ms > 0:
+            io.add_event_detect(pin, io.BOTH, callback=edgeCB, bouncetime=bouncetime_ms)
+        else:
+            io.add_event_detect(pin, io.BOTH, callback=edgeCB)
+
+    def removeEdgeCallback(self, pin):
+        io.remove_event_detect(pin)
+
+def readLevelRegisters(mem, mask):
+    ''' reads the levels of the pins in mask from a GPIO register block '''
+    if mask >> 32:
+        lev0, lev1 = struct.unpack_from('<II', mem, GPLEV0)
+        return (lev0 | (lev1 << 32)) & mask
+    return struct.unpack_from('<I', mem, GPLEV0)[0] & mask
+
+class MmapGPIOBackend(RPiGPIOBackend):
+    """
+        RPi.GPIO backend with bulk input reads.
+
+        /dev/gpiomem is memory mapped, so readMask() reads the levels of
+        all the pins with one or two register reads.  Setup, outputs and
+        edge detection still go through RPi.GPIO.
+    """
+
+    def __init__(self, gpiomem='/dev/gpiomem'):
+        super(MmapGPIOBackend, self).__init__()
+        fd = os.open(gpiomem, os.O_RDONLY | os.O_SYNC)
+        try:
+            self.mem = mmap.mmap(fd, GPIO_MEM_SIZE, mmap.MAP_SHARED, mmap.PROT_READ)
+        finally:
+            os.close(fd)
+
+    def input(self, pin):
+        return 1 if readLevelRegisters(self.mem, 1 << pin) else 0
+
+    def readMask(self, mask):
+        return readLevelRegisters(self.mem, mask)
+
+class FakeGPIOBackend(object):
+    """
+        In-memory GPIO backend for running without a Pi.
+
+        Input levels are set with injectEdge(), which also fires any edge
+        callback registered for the pin (honoring the bounce time), so
+        edge and poll handling can be driven deterministically.  With
+        randomize=True input() returns random levels, like the old sim mode.
+    """
+
+    def __init__(self, randomize=False):
+        self.randomize = randomize
+        self.levels = {}
+        self.outputs = {}
+        self.callbacks = {}
+        self.last_edge_time = {}
+        self.lock = threading.Lock()
+
+    def getLevel(self, pin):
+        return self.levels.get(pin, LOW)
+
+    def setLevel(self, pin, level):
+        self.levels[pin] = level
+
+    def setupInput(self, pin, pull_up):
+        if pin not in self.levels:
+            self.setLevel(pin, HIGH if pull_up else LOW)
+
+    def setupOutput(self, pin):
+        self.outputs.setdefault(pin, LOW)
+
+    def input(self, pin):
+        if self.randomize:
+            return randint(0,1)
+        return self.getLevel(pin)
+
+    def readMask(self, mask):
+        if self.randomize:
+            return getrandbits(max(1, mask.bit_length())) & mask
+        levels = 0
+        for pin, level in self.levels.items():
+            if level:
+                levels |= 1 << pin
+        return levels & mask
+
+    def output(self, pin, level):
+        self.outputs[pin] = HIGH if level else LOW
+
+    def addEdgeCallback(self, pin, callback, bouncetime_ms=0):
+        self.callbacks[pin] = (callback, bouncetime_ms / 1000.0)
+
+    def removeEdgeCallback(self, pin):
+        self.callbacks.pop(pin, None)
+
+    def injectEdge(self, pin, level, timestamp=None):
+        '''
+        sets the level of an input pin.  Returns True if an edge
+        callback was fired, False if there was no edge, no callback
+        or the edge was swallowed by the bounce time.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            if self.getLevel(pin) == level:
+                return False
+            self.setLevel(pin, level)
+            if pin not in self.callbacks:
+                return False
+            callback, bouncetime = self.callbacks[pin]
+            last = self.last_edge_time.get(pin)
+            if last is not None and timestamp - last < bouncetime:
+                return False
+            self.last_edge_time[pin] = timestamp
+        callback(pin, level)
+        return True
+
+    def injectPulse(self, pin, level=HIGH, timestamp=None):
+        '''
+        a pulse too short to be seen by polling: the edge there fires the
+        callback, the one back doesn't (a missed edge), so the level
+        going back is only seen by the next poll
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        fired = self.injectEdge(pin, level, timestamp)
+        with self.lock:
+            self.setLevel(pin, level ^ 1)
+        return fired
+
+class FakeMmapGPIOBackend(FakeGPIOBackend):
+    """
+        Fake backend keeping the input levels in an anonymous mmap laid
+        out like the GPIO register block, so readMask() goes through the
+        same single register read as MmapGPIOBackend.
+    """
+
+    def __init__(self):
+        super(FakeMmapGPIOBackend, self).__init__()
+        self.mem = mmap.mmap(-1, GPIO_MEM_SIZE)
+
+    def getLevel(self, pin):
+        return 1 if readLevelRegisters(self.mem, 1 << pin) else 0
+
+    def setLevel(self, pin, level):
+        offset = GPLEV0 + 4 * (pin // 32)
+        reg = struct.unpack_from('<I', self.mem, offset)[0]
+        if level:
+            reg |= 1 << (pin % 32)
+        else:
+            reg &= ~(1 << (pin % 32))
+        struct.pack_into('<I', self.mem, offset, reg)
+
+    def readMask(self, mask):
+        return readLevelRegisters(self.mem, mask)
+
+def makeBackend(sim_mode, mmap_gpio=False):
+    '''
+    returns the default backend: RPi.GPIO (with bulk reads from
+    /dev/gpiomem if mmap_gpio), or random levels in sim mode
+    '''
+    if sim_mode:
+        return FakeGPIOBackend(randomize=True)
+    if mmap_gpio:
+        return MmapGPIOBackend()
+    return RPiGPIOBackend()
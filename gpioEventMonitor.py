@@ -3,78 +3,368 @@ import time
 import datetime
 import threading
 import logging
+from bisect import bisect_right
+from collections import deque
 
-try:
-    import RPi.GPIO as io
-    io.setmode(io.BCM)
-except ImportError:
-    from random import randint
+from gpioBackend import makeBackend
+from clock import SystemClock
+from eventConsumer import EventConsumer, DROP_OLDEST
+from eventCoalescer import EventCoalescer
 
 (STOPPED, RUNNING) = range(2)
 
+US_PER_DAY = 24 * 60 * 60 * 1000000
+
 logger = logging.getLogger("EventMonitor")
 
+class TriggerSchedule(object):
+    """
+        Precompiled index of the event triggers.
+
+        Every input event of a trigger is compiled into a rule over the
+        packed input word (bit n = level of BCM pin n): a (mask, expected)
+        pair, which matches when word & mask == expected.  Input events
+        give either a single 'name' and 'value', or several inputs that
+        all have to match, as an 'inputs' dict of name -> value.
+
+        The start/end times of all triggers are parsed once and turned
+        into a sorted list of time-of-day boundaries.  Between two
+        boundaries the set of active triggers can't change, so for every
+        such window a table is built up front, grouping the rules by mask:
+        [(mask, {expected: [(rule id, event, event id, repeat)]})], where
+        repeat is the optional 'repeat_interval' in seconds (0 to only fire
+        on edges).  Event names are numbered in order of appearance;
+        event_names[event id] gives the name back.  A schedule compiled
+        for reloaded triggers is given the 'previous' one, so the events
+        and rules it already knew keep their ids.
+        Matching all the rules of a window costs one lookup per distinct
+        mask.  At run time the monitor just asks for the table of the
+        current window, which is only re-selected when a boundary is crossed.
+    """
+
+    def __init__(self, event_triggers, input_pins, previous=None):
+        self.rule_ids = {}
+        self.event_ids = {}
+        self.event_names = []
+        if previous is not None:
+            self.rule_ids = dict(previous.rule_ids)
+            self.event_ids = dict(previous.event_ids)
+            self.event_names = list(previous.event_names)
+        spans = []
+        boundaries = set([0, US_PER_DAY])
+        for trigger in event_triggers:
+            start = self.parseTime(trigger['start_time'])
+            end = self.parseTime(trigger['end_time'])
+            # end time is inclusive, so the span runs up to the next usec
+            if start > end:
+                ranges = [(start, US_PER_DAY), (0, end + 1)]
+            else:
+                ranges = [(start, end + 1)]
+            for r in ranges:
+                boundaries.update(r)
+            rules = [self.compileRule(input_event, input_pins) for input_event in trigger['input_events']]
+            spans.append((ranges, rules))
+
+        self.boundaries = sorted(boundaries)
+        self.tables = []
+        for win_start in self.boundaries[:-1]:
+            by_mask = {}
+            for ranges, rules in spans:
+                if any(s <= win_start < e for s, e in ranges):
+                    for mask, expected, entry in rules:
+                        by_mask.setdefault(mask, {}).setdefault(expected, []).append(entry)
+            self.tables.append(list(by_mask.items()))
+
+        self.win_start = 0
+        self.win_end = 0
+        self.table = []
+
+    def compileRule(self, input_event, input_pins):
+        ''' returns the (mask, expected, (rule id, event, event id, repeat)) of an input event '''
+        if 'inputs' in input_event:
+            inputs = input_event['inputs']
+        else:
+            inputs = {input_event['name']: input_event['value']}
+        mask = 0
+        expected = 0
+        for name, value in inputs.items():
+            if name not in input_pins:
+                raise KeyError("Unknown input in event trigger: %s" % (name))
+            mask |= 1 << input_pins[name]
+            if value:
+                expected |= 1 << input_pins[name]
+        event = input_event['event']
+        self.eventId(event)
+        # the same condition and event keeps its id across triggers, so
+        # it doesn't fire again when one window hands over to the next
+        rule_id = self.rule_ids.setdefault((mask, expected, event), len(self.rule_ids))
+        return mask, expected, (rule_id, event, self.event_ids[event], input_event.get('repeat_interval', 0))
+
+    def eventId(self, event):
+        ''' returns the id of an event name, numbering it if it's new '''
+        if event not in self.event_ids:
+            self.event_ids[event] = len(self.event_names)
+            self.event_names.append(event)
+        return self.event_ids[event]
+
+    @staticmethod
+    def parseTime(time_str):
+        ''' converts a HH:MM:SS string into usecs since midnight '''
+        h, m, s = [int(n) for n in time_str.split(':')]
+        return ((h * 60 + m) * 60 + s) * 1000000
+
+    def activeTable(self, now=None):
+        '''
+        returns the [(mask, {expected: [(rule id, event, event id, repeat)]})] table for the
+        time window that 'now' (a datetime, defaults to the current
+        time) falls within.
+        '''
+        if now is None:
+            now = datetime.datetime.now()
+        t = ((now.hour * 60 + now.minute) * 60 + now.second) * 1000000 + now.microsecond
+        if not (self.win_start <= t < self.win_end):
+            idx = bisect_right(self.boundaries, t) - 1
+            self.win_start = self.boundaries[idx]
+            self.win_end = self.boundaries[idx + 1]
+            self.table = self.tables[idx]
+            logger.debug("switched to trigger window starting at %ds" % (self.win_start // 1000000))
+        return self.table
+
 class GPIOEventMonitor:
-    """ GPIO Event monitor object"""
+    """
+        GPIO Event monitor object
+
+        By default the inputs are polled every sleep_time seconds.  With
+        edge_detect=True, edge callbacks from the GPIO backend wake the
+        monitor immediately (debounced by bouncetime_ms), and the poll
+        is only kept as a fallback to resync the inputs when idle.
+
+        Events are only dispatched on transitions: when an input changes
+        to a trigger's value, or when the time window changes so that a
+        trigger starts matching.  A trigger with a 'repeat_interval' keeps
+        firing while it matches, at most once every repeat_interval secs.
+
+        Every callback is fed from its own queue and worker thread (see
+        EventConsumer), unless added with queue_size=0, in which case it
+        is called directly from the monitor thread.
+
+        Events configured with 'coalesce' or 'rate_limit' in the triggers
+        first go through an EventCoalescer.  Coalesced summary events are
+        sent as callback(event, info), all other events as callback(event).
+
+        If a journal (EventJournalWriter) is given, every dispatched event
+        is recorded in it along with the input bitmask.
+
+        All timing goes through 'clock' (the system clock by default), so
+        the monitor can be driven by a VirtualClock with runCycle().
 
-    def __init__(self, gpio_settings, event_triggers, sim_mode, sleep_time=1.0):
+        reload() compiles new GPIO settings and triggers in the caller's
+        thread; the monitor swaps them in before its next cycle, setting
+        up only the pins that changed.  Event ids are kept, new events
+        get new ids, and the functions added with addReloadCallback() are
+        called with the new (gpio settings, event names) first.
+    """
+
+    def __init__(self, gpio_settings, event_triggers, sim_mode, sleep_time=1.0,
+                 backend=None, edge_detect=False, bouncetime_ms=50, journal=None, clock=None):
         self.event_triggers = event_triggers
+        self.clock = clock if clock is not None else SystemClock()
+        self.journal = journal
+        self.cycle_time = None
+        self.event_counts = None
+        self.event_count_metric = None
+        self.pending_config = None
+        self.reloadCallbackList = []
+        input_pins = dict((k, v[0]) for k, v in gpio_settings['inputs'].items())
+        self.schedule = TriggerSchedule(event_triggers, input_pins)
+        self.coalescer = EventCoalescer(event_triggers, self.schedule)
         self.gpio_settings = gpio_settings
         self.eventCallbackList = []
+        self.idCallbackList = []
+        self.consumers = []
+        self.event_names = self.schedule.event_names
         self.state = STOPPED
         self.sim_mode = sim_mode
         self.sleep_time = sleep_time
-        if not sim_mode:
-            self.setupGPIO()
+        self.backend = backend if backend is not None else makeBackend(sim_mode)
+        self.edge_detect = edge_detect
+        self.bouncetime_ms = bouncetime_ms
+        self.edge_queue = deque()
+        self.edge_wakeup = threading.Event()
+        self.pin_names = {}
+        self.edge_levels = {}
+        self.input_mask = 0
+        self.input_word = 0
+        self.setupGPIO()
         self.input_states = {}
+        self.last_word = None
+        self.last_table = None
+        self.repeating = False
+        self.matched = {}
         logger.info("initialized GPIO event processor object")
 
-    def addCallback(self, callbackFuncion):
-        self.eventCallbackList.append(callbackFuncion)
+    def addCallback(self, callbackFuncion, by_id=False, queue_size=100, overflow=DROP_OLDEST, name=None):
+        '''
+        registers a function to be called with the name of every event.
+        With by_id=True it's called with the event's id instead, an index
+        into self.event_names.  queue_size and overflow set up the
+        callback's EventConsumer (queue_size=0 to call it directly).
+        '''
+        deliver = callbackFuncion
+        if queue_size > 0:
+            consumer = EventConsumer(callbackFuncion, queue_size, overflow, name)
+            self.consumers.append(consumer)
+            deliver = consumer.put
+        if by_id:
+            self.idCallbackList.append(deliver)
+            logger.info("event id callback added")
+            return
+        self.eventCallbackList.append(deliver)
         logger.info("callback added")
         callbackFuncion("test callback")
-        
+
+    def attachMetrics(self, registry):
+        ''' adds the monitor's metrics to a MetricsRegistry '''
+        self.event_count_metric = registry.counter('gpio_events_total', 'Events dispatched by the monitor',
+                                                   'event', self.event_names)
+        self.event_counts = self.event_count_metric.children
+        self.cycle_time = registry.histogram('gpio_monitor_cycle_seconds', 'Time spent in one monitor cycle').children[0]
+        registry.callbackGauge('gpio_consumer_queue_depth', 'Events waiting in each consumer queue', 'consumer',
+                               lambda: [(c.name, len(c.queue)) for c in self.consumers])
+        registry.callbackGauge('gpio_consumer_lag_seconds', 'Queueing delay of the last event of each consumer', 'consumer',
+                               lambda: [(c.name, c.last_lag) for c in self.consumers])
+        registry.callbackGauge('gpio_consumer_dropped_events', 'Events dropped by each consumer queue', 'consumer',
+                               lambda: [(c.name, c.dropped) for c in self.consumers])
+
+    def getSnapshot(self):
+        ''' returns the monitor state worth keeping across restarts (see stateSnapshot.py) '''
+        return {"coalescer": self.coalescer.getState()}
+
+    def restoreSnapshot(self, state):
+        ''' restores a getSnapshot() state, before the monitor starts '''
+        self.coalescer.restoreState(state.get('coalescer', {}))
+
+    def addReloadCallback(self, func):
+        ''' func(gpio_settings, event_names) is called from the monitor when a reloaded config is swapped in '''
+        self.reloadCallbackList.append(func)
+
+    def compileConfig(self, gpio_settings, event_triggers):
+        '''
+        validates and compiles a config, without touching the running
+        one.  Raises KeyError/ValueError/TypeError if it's invalid.
+        '''
+        input_pins = dict((k, v[0]) for k, v in gpio_settings['inputs'].items())
+        for pin in gpio_settings['outputs'].values():
+            int(pin)
+        schedule = TriggerSchedule(event_triggers, input_pins, self.schedule)
+        coalescer = EventCoalescer(event_triggers, schedule)
+        return (gpio_settings, event_triggers, schedule, coalescer)
+
+    def reload(self, gpio_settings, event_triggers):
+        ''' compiles a new config and hands it to the monitor, to swap in between cycles '''
+        self.applyConfig(self.compileConfig(gpio_settings, event_triggers))
+
+    def applyConfig(self, config):
+        ''' hands a config from compileConfig() to the monitor, to swap in between cycles '''
+        self.pending_config = config
+        self.edge_wakeup.set()
+
+    def swapConfig(self, config):
+        gpio_settings, event_triggers, schedule, coalescer = config
+        # the open coalescing windows end early, rather than being lost
+        for event, event_id, info in self.coalescer.closeWindows(float('inf')):
+            self.dispatch(event, event_id, info)
+        self.updatePins(gpio_settings)
+        if self.event_count_metric is not None:
+            for name in schedule.event_names[len(self.event_counts):]:
+                self.event_count_metric.addLabel(name)
+        for reloadCallback in self.reloadCallbackList:
+            reloadCallback(gpio_settings, schedule.event_names)
+        if self.journal is not None:
+            self.journal.event_names = schedule.event_names
+        self.event_triggers = event_triggers
+        self.schedule = schedule
+        self.coalescer = coalescer
+        self.event_names = schedule.event_names
+        self.last_table = None
+        logger.info("Swapped in the reloaded config, %d events" % (len(self.event_names)))
+
+    def updatePins(self, gpio_settings):
+        ''' sets up the inputs and outputs that were added or changed '''
+        old_inputs = self.gpio_settings['inputs']
+        new_inputs = gpio_settings['inputs']
+        old_pins = set(v[0] for v in old_inputs.values())
+        changed = set(v[0] for k, v in new_inputs.items() if old_inputs.get(k) != v)
+        removed = old_pins - set(v[0] for v in new_inputs.values())
+        if self.edge_detect and self.state == RUNNING:
+            for pin in (changed & old_pins) | removed:
+                self.backend.removeEdgeCallback(pin)
+        self.pin_names = {}
+        self.input_mask = 0
+        for key, value in new_inputs.items():
+            if value[0] in changed:
+                self.backend.setupInput(value[0], value[1])
+            self.pin_names[value[0]] = key
+            self.input_mask |= 1 << value[0]
+        for key, pin in gpio_settings['outputs'].items():
+            if self.gpio_settings['outputs'].get(key) != pin:
+                self.backend.setupOutput(pin)
+        self.input_states = dict((k, v) for k, v in self.input_states.items() if k in new_inputs)
+        if self.edge_detect and self.state == RUNNING:
+            for pin in changed:
+                self.edge_levels[pin] = self.backend.input(pin)
+                self.backend.addEdgeCallback(pin, self.edgeCB, self.bouncetime_ms)
+        self.gpio_settings = gpio_settings
+        self.updateInputs()
+
+    def getConsumerMetrics(self):
+        ''' returns the queue depth, drop and lag metrics of each queued callback '''
+        return dict((c.name, c.getMetrics()) for c in self.consumers)
+
     def getRunState(self):
         return self.state
 
     def setupGPIO(self):
         for key in self.gpio_settings['inputs']:
             input = self.gpio_settings['inputs'][key]
-            if input[1]:
-                io.setup(input[0], io.IN, pull_up_down=io.PUD_UP)
-            else:
-                io.setup(input[0], io.IN)
+            self.backend.setupInput(input[0], input[1])
+            self.pin_names[input[0]] = key
+            self.input_mask |= 1 << input[0]
         for key in self.gpio_settings['outputs']:
-            io.setup(self.gpio_settings['outputs'][key], io.OUT)
+            self.backend.setupOutput(self.gpio_settings['outputs'][key])
 
     def updateInputs(self):
-        for key in self.gpio_settings['inputs']:
-            input = self.gpio_settings['inputs'][key]
-            if not self.sim_mode:
-                self.input_states[key] = io.input(input[0])
-            else:
-                self.input_states[key] = randint(0,1)
+        # read all the inputs at once, as a bitmask of pin levels
+        self.input_word = self.backend.readMask(self.input_mask)
+        for pin, key in self.pin_names.items():
+            self.input_states[key] = (self.input_word >> pin) & 1
+
+    def addEdgeDetection(self):
+        for pin in self.pin_names:
+            self.edge_levels[pin] = self.backend.input(pin)
+            self.backend.addEdgeCallback(pin, self.edgeCB, self.bouncetime_ms)
+
+    def removeEdgeDetection(self):
+        for pin in self.pin_names:
+            self.backend.removeEdgeCallback(pin)
 
-    def withinRange(self, start_time, end_time):
+    def edgeCB(self, pin, level):
         '''
-        start_time and end_time are both strings representing 
-        a time in HH:MM:SS format, with a range of 00:00:00 to
-        23:59:59.  if start_time > end_time (ie, start at 20:00:00
-        and end at 06:00:00) it is assumed that this range spans
-        two days (start_time in one day, end_time in the next).
+        called from the backend's thread on every (debounced) edge.
+        The new level is queued for the monitor thread.  If the level
+        didn't change since the last edge, the input pulsed and was
+        back before we could read it, so queue the pulse as well.
         '''
-        st = [int(n) for n in start_time.split(':')]
-        et = [int(n) for n in end_time.split(':')]
-        current = datetime.datetime.now().time()
-        start   = datetime.time(*st)
-        end     = datetime.time(*et)
-        if start > end:
-            return (current <= end) or (current >= start)
-        else:
-            return start <= current <= end
+        if self.edge_levels.get(pin) == level:
+            self.edge_queue.append((pin, level ^ 1))
+        self.edge_levels[pin] = level
+        self.edge_queue.append((pin, level))
+        self.edge_wakeup.set()
 
     def start(self):
         self.alive = True
+        if self.edge_detect:
+            self.addEdgeDetection()
         # start processing thread
         self.processing_thread = threading.Thread(target=self.monitorEvents)
         self.processing_thread.setDaemon(1)
@@ -84,6 +374,11 @@ class GPIOEventMonitor:
     def stop(self):
         logger.info("Shutting down event processing...")
         self.alive = False
+        self.edge_wakeup.set()
+        for consumer in self.consumers:
+            consumer.stop()
+        if self.edge_detect:
+            self.removeEdgeDetection()
         self.state = STOPPED
 
     def join(self):
@@ -92,15 +387,91 @@ class GPIOEventMonitor:
     def monitorEvents(self):
         logger.info("Event processing thread started.")
         while self.alive:
+            self.runCycle()
+            if self.edge_detect:
+                self.edge_wakeup.wait(self.sleep_time)
+                self.edge_wakeup.clear()
+            else:
+                self.clock.sleep(self.sleep_time)
+        if self.journal is not None:
+            self.journal.close()
+
+    def runCycle(self):
+        ''' one monitoring cycle: process the queued edges, or poll the inputs '''
+        # read once, as metrics may be attached while the monitor runs
+        cycle_time = self.cycle_time
+        if cycle_time is not None:
+            start = time.time()
+        if self.pending_config is not None:
+            config, self.pending_config = self.pending_config, None
+            self.swapConfig(config)
+        if self.edge_queue:
+            # process the queued edges one by one, so a short
+            # pulse shows up as two separate input states
+            while self.edge_queue:
+                pin, level = self.edge_queue.popleft()
+                if pin not in self.pin_names:
+                    # queued before a reload removed the input
+                    continue
+                if level:
+                    self.input_word |= 1 << pin
+                else:
+                    self.input_word &= ~(1 << pin)
+                self.input_states[self.pin_names[pin]] = level
+                self.processInputs()
+        else:
             self.updateInputs()
-            for trigger in self.event_triggers:
-                # First see if current time falls within trigger's 
-                # start and end times...
-                if self.withinRange(trigger['start_time'], trigger['end_time']):
-                    for input_event in trigger['input_events']:
-                        if input_event['value'] == self.input_states[input_event['name']] \
-                        and len(self.eventCallbackList) > 0:
-                            for eventCallback in self.eventCallbackList:
-                                eventCallback(input_event['event'])
-            time.sleep(self.sleep_time)
-            continue
\ No newline at end of file
+            self.processInputs()
+        if self.journal is not None:
+            self.journal.flushIfDue(self.clock.time())
+        if cycle_time is not None:
+            cycle_time.observe(time.time() - start)
+
+    def dispatch(self, event, event_id, info=None):
+        event_counts = self.event_counts
+        if event_counts is not None:
+            event_counts[event_id].inc()
+        if self.journal is not None:
+            self.journal.record(event_id, self.input_word, self.clock.time())
+        if info is None:
+            for eventCallback in self.eventCallbackList:
+                eventCallback(event)
+            for eventCallback in self.idCallbackList:
+                eventCallback(event_id)
+        else:
+            for eventCallback in self.eventCallbackList:
+                eventCallback(event, info)
+            for eventCallback in self.idCallbackList:
+                eventCallback(event_id, info)
+
+    def processInputs(self):
+        if self.coalescer.hasOpenWindows():
+            for event, event_id, info in self.coalescer.closeWindows(self.clock.time()):
+                self.dispatch(event, event_id, info)
+
+        # Get the rules of the triggers active right now, grouped
+        # by the mask of inputs they look at...
+        table = self.schedule.activeTable(self.clock.now())
+        word = self.input_word
+        if table is self.last_table and word == self.last_word and not self.repeating:
+            # nothing changed since the last cycle
+            return
+        self.last_table = table
+        self.last_word = word
+
+        # self.matched maps the id of each rule matching on the last
+        # cycle to the time its event was last dispatched
+        now = self.clock.time()
+        matched = {}
+        self.repeating = False
+        for mask, by_expected in table:
+            for rule_id, event, event_id, repeat in by_expected.get(word & mask, ()):
+                last = self.matched.get(rule_id)
+                if last is None or (repeat and now - last >= repeat):
+                    last = now
+                    if self.coalescer.admit(event_id, now):
+                        self.dispatch(event, event_id)
+                matched[rule_id] = last
+                if repeat:
+                    self.repeating = True
+        self.matched = matched
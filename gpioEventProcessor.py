@@ -1,9 +1,10 @@
 import time
 import logging
-try:
-    import urllib2
-except ImportError:
-    sim_data_log = True
+
+from clock import SystemClock
+from dataLogger import DataLogPipeline, makeSender
+from gpioBackend import makeBackend
+from outputSequencer import OutputSequencer
 
 logger = logging.getLogger("EventProc")
 
@@ -11,24 +12,142 @@ class MyException(Exception):
     pass
 
 class GPIOEventProcessor(object):
-    """ Event Processor object"""
+    """
+        Event Processor object
+
+        Outputs are driven through the GPIO backend; timed output
+        patterns (beeps, flashes) are handed to self.sequencer so event
+        handlers never sleep.  Data log entries are queued on a background
+        DataLogPipeline (optionally spilling to data_log_spill_file), sent
+        to a collector (see collector.py) if data_log_uri_base is a
+        collector://host:port/site uri.
+
+        Events are dispatched through a table of handlers registered
+        per event name with registerHandler().  After bindEventIds() the
+        processor can also be given event ids (see GPIOEventMonitor's
+        addCallback), which are dispatched with a plain list index.
+
+        Timing goes through 'clock'.  With a clock that doesn't run
+        threads (VirtualClock, asyncCore's LoopClock) the sequencer thread
+        isn't started; call sequencer.runPending() to play outputs.
+        A data_logger (anything with a log(data) method) can be given
+        instead of the pipeline built from data_log_uri_base.
+    """
 
-    def __init__(self, gpio_settings, sim_mode, data_log_uri_base, signal_defs):
+    def __init__(self, gpio_settings, sim_mode, data_log_uri_base, signal_defs, backend=None,
+                 data_log_spill_file=None, clock=None, data_logger=None):
         self.gpio_settings = gpio_settings
         self.sim_mode = sim_mode
         self.data_log_uri_base = data_log_uri_base
         self.signal_defs = signal_defs
+        self.handlers = {}
+        self.handlers_by_id = []
+        self.handler_times = None
+        self.handler_times_by_id = None
+        self.event_names = []
+        self.clock = clock if clock is not None else SystemClock()
+        self.backend = backend if backend is not None else makeBackend(sim_mode)
+        self.sequencer = OutputSequencer(self.backend, self.clock.time)
+        if self.clock.threaded:
+            self.sequencer.start()
+        self.data_logger = data_logger
+        if data_logger is None and len(self.data_log_uri_base) > 0:
+            self.data_logger = DataLogPipeline(makeSender(self.data_log_uri_base),
+                                               spill_file=data_log_spill_file)
+            self.data_logger.start()
+
+    def stop(self):
+        self.sequencer.stop()
+        if isinstance(self.data_logger, DataLogPipeline):
+            self.data_logger.stop()
+
+    def syncOutputs(self):
+        '''
+        called before the monitor starts, for the actions that put the
+        outputs and devices in their starting states, so they're sent
+        ahead of any the first events send
+        '''
+        pass
+
+    def startup(self):
+        '''
+        called once the monitor is running, for the actions and outputs
+        that shouldn't hold up the first poll
+        '''
+        pass
+
+    def getSnapshot(self):
+        ''' returns the processor state worth keeping across restarts (see stateSnapshot.py) '''
+        return {}
+
+    def restoreSnapshot(self, state):
+        ''' restores a getSnapshot() state, before the monitor starts '''
+        pass
+
+    def registerHandler(self, event, handler):
+        '''
+        handler is called without arguments for every 'event', or with
+        the info dict for coalesced summary events
+        '''
+        self.handlers[event] = handler
+        if self.event_names:
+            self.bindEventIds(self.event_names)
+
+    def bindEventIds(self, event_names):
+        ''' event_names[event id] is the name of each event id '''
+        self.event_names = event_names
+        self.handlers_by_id = [self.handlers.get(name) for name in event_names]
+        if self.handler_times is not None:
+            self.handler_times_by_id = [self.handler_times.get(name) for name in event_names]
+
+    def reconfigure(self, gpio_settings, event_names):
+        ''' takes reloaded GPIO settings and event names (see GPIOEventMonitor.addReloadCallback) '''
+        self.gpio_settings = gpio_settings
+        self.bindEventIds(event_names)
+
+    def attachMetrics(self, registry):
+        ''' adds handler run time metrics to a MetricsRegistry (after registering the handlers) '''
+        metric = registry.histogram('gpio_handler_seconds', 'Run time of the event handlers',
+                                    'event', sorted(self.handlers))
+        self.handler_times = dict(zip(metric.label_values, metric.children))
+        self.handler_times_by_id = [self.handler_times.get(name) for name in self.event_names]
+
+    def eventCB(self, event, info=None):
+        handler = self.handlers.get(event)
+        if handler is None:
+            self.unhandledEvent(event)
+            return
+        handler_times = self.handler_times
+        if handler_times is not None:
+            start = time.time()
+        if info is None:
+            handler()
+        else:
+            handler(info)
+        if handler_times is not None:
+            handler_times[event].observe(time.time() - start)
+
+    def eventIdCB(self, event_id, info=None):
+        handler = self.handlers_by_id[event_id]
+        if handler is None:
+            self.unhandledEvent(self.event_names[event_id])
+            return
+        handler_times = self.handler_times_by_id
+        if handler_times is not None:
+            start = time.time()
+        if info is None:
+            handler()
+        else:
+            handler(info)
+        if handler_times is not None:
+            handler_times[event_id].observe(time.time() - start)
 
-    def eventCB(self, event):
+    def unhandledEvent(self, event):
         logger.info('Default handler for event: %s' % (event))
 
     def doLog(self, log_msg):
         logger.info(msg)
 
     def dataLog(self, data):
-        if len(self.data_log_uri_base) > 0 and not sim_data_log: 
-            try:
-                rep = urllib2.urlopen("%s%s" % (self.data_log_uri_base, data)).read()
-                logger.info("Logging data: %s. reply: %s" % ( data, rep))
-            except:
-                logger.warn("Error connecting to data logger; skipping post")
+        if self.data_logger is not None:
+            self.data_logger.log(data)
@@ -0,0 +1,193 @@
+'''
+Low overhead metrics, served in the Prometheus text format.
+
+Metrics (and one child per label value for labeled ones) are created
+up front, so updating them on the hot path is just an index and an add,
+without allocating anything per event.
+'''
+
+import threading
+import logging
+from bisect import bisect_left
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger("Metrics")
+
+# seconds
+DEFAULT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 15.0)
+
+def formatLabels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (k, str(v).replace('"', '\\"')) for k, v in labels))
+
+class Counter(object):
+    metric_type = 'counter'
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n=1):
+        self.value += n
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class Gauge(object):
+    metric_type = 'gauge'
+
+    def __init__(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class Histogram(object):
+    metric_type = 'histogram'
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def samples(self, name, labels):
+        samples = []
+        total = 0
+        for bound, cnt in zip(self.bounds, self.counts):
+            total += cnt
+            samples.append((name + '_bucket', labels + [('le', repr(float(bound)))], total))
+        samples.append((name + '_bucket', labels + [('le', '+Inf')], self.count))
+        samples.append((name + '_sum', labels, self.sum))
+        samples.append((name + '_count', labels, self.count))
+        return samples
+
+class Metric(object):
+    """
+        A named metric: either a single Counter/Gauge/Histogram, or one
+        per value of 'label' (children[idx] for label_values[idx]).
+    """
+
+    def __init__(self, name, help, metric_class, label=None, label_values=(), **kwargs):
+        self.name = name
+        self.help = help
+        self.metric_type = metric_class.metric_type
+        self.label = label
+        self.metric_class = metric_class
+        self.kwargs = kwargs
+        if label is None:
+            self.label_values = [None]
+        else:
+            self.label_values = list(label_values)
+        self.children = [metric_class(**kwargs) for v in self.label_values]
+
+    def child(self, label_value):
+        return self.children[self.label_values.index(label_value)]
+
+    def addLabel(self, label_value):
+        ''' adds a child for a new label value (not for the hot path) '''
+        self.label_values.append(label_value)
+        child = self.metric_class(**self.kwargs)
+        self.children.append(child)
+        return child
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s %s' % (self.name, self.metric_type))
+        for value, child in zip(self.label_values, self.children):
+            labels = [] if self.label is None else [(self.label, value)]
+            for name, sample_labels, sample in child.samples(self.name, labels):
+                lines.append('%s%s %s' % (name, formatLabels(sample_labels), sample))
+
+class CallbackGauge(object):
+    """ gauge read when rendered: func returns [(label value, value)] """
+
+    def __init__(self, name, help, label, func):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.func = func
+
+    def render(self, lines):
+        lines.append('# HELP %s %s' % (self.name, self.help))
+        lines.append('# TYPE %s gauge' % (self.name))
+        for label_value, value in self.func():
+            lines.append('%s%s %s' % (self.name, formatLabels([(self.label, label_value)]), value))
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, label=None, label_values=()):
+        return self.register(Metric(name, help, Counter, label, label_values))
+
+    def gauge(self, name, help, label=None, label_values=()):
+        return self.register(Metric(name, help, Gauge, label, label_values))
+
+    def histogram(self, name, help, label=None, label_values=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Metric(name, help, Histogram, label, label_values, buckets=buckets))
+
+    def callbackGauge(self, name, help, label, func):
+        return self.register(CallbackGauge(name, help, label, func))
+
+    def render(self):
+        lines = []
+        with self.lock:
+            metrics = list(self.metrics)
+        for metric in metrics:
+            try:
+                metric.render(lines)
+            except Exception as e:
+                logger.error("Error rendering metric %s: %s" % (metric.name, e))
+        return '\n'.join(lines) + '\n'
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class MetricsServer(object):
+    """ serves registry.render() at http://host:port/metrics, on its own thread """
+
+    def __init__(self, registry, port, host='127.0.0.1'):
+        self.httpd = HTTPServer((host, port), MetricsRequestHandler)
+        self.httpd.registry = registry
+        self.port = self.httpd.server_address[1]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.httpd.serve_forever, name="metrics")
+        self.thread.setDaemon(1)
+        self.thread.start()
+        logger.info("Serving metrics on port %d" % (self.port))
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -0,0 +1,114 @@
+import time
+import heapq
+import threading
+import logging
+
+from gpioBackend import LOW, HIGH
+
+logger = logging.getLogger("OutputSeq")
+
+def beep(on_time=0.4, off_time=0.4):
+    ''' one beep of a buzzer (active high) '''
+    return [(HIGH, on_time), (LOW, off_time)]
+
+def flash(hz, on_level=HIGH):
+    ''' one period of a flash at the given rate, 50% duty cycle '''
+    half = 0.5 / hz
+    return [(on_level, half), (on_level ^ 1, half)]
+
+def pulse(duration, on_level=HIGH):
+    ''' a single pulse, leaving the output off afterwards '''
+    return [(on_level, duration), (on_level ^ 1, 0)]
+
+class OutputSequencer(object):
+    """
+        Plays patterns on GPIO outputs in the background.
+
+        A pattern is a list of (level, duration) steps, played 'repeat'
+        times (0 = until replaced or stopped).  Every output plays at most
+        one pattern: playing a new one on it cancels the running one.
+        Due steps are kept in a heap, so one thread serves all outputs
+        and play() never blocks the caller.
+    """
+
+    def __init__(self, backend, clock=time.time):
+        self.backend = backend
+        self.clock = clock
+        self.heap = []
+        self.playing = {}
+        self.seq = 0
+        self.cond = threading.Condition()
+        self.alive = False
+
+    def start(self):
+        self.alive = True
+        self.thread = threading.Thread(target=self.run, name="output-sequencer")
+        self.thread.setDaemon(1)
+        self.thread.start()
+
+    def stop(self):
+        with self.cond:
+            self.alive = False
+            self.cond.notify()
+
+    def play(self, pin, steps, repeat=1):
+        with self.cond:
+            self.seq += 1
+            # playing[pin] = [generation, steps, step index, repeats left]
+            self.playing[pin] = [self.seq, steps, 0, repeat]
+            heapq.heappush(self.heap, (self.clock(), self.seq, pin))
+            self.cond.notify()
+
+    def cancel(self, pin, level=None):
+        ''' stops the pattern on pin, optionally setting the output level '''
+        with self.cond:
+            self.playing.pop(pin, None)
+            if level is not None:
+                self.backend.output(pin, level)
+
+    def isPlaying(self, pin):
+        return pin in self.playing
+
+    def runPending(self, now):
+        '''
+        plays all the steps due at 'now'.  Returns the time the next
+        step is due, or None if there's nothing left to play.  Each step
+        is output under the lock, so a cancel() can't be overwritten by
+        a step taken before it.
+        '''
+        while True:
+            with self.cond:
+                if not self.heap:
+                    return None
+                due, gen, pin = self.heap[0]
+                if due > now:
+                    return due
+                heapq.heappop(self.heap)
+                state = self.playing.get(pin)
+                if state is None or state[0] != gen:
+                    # cancelled or replaced
+                    continue
+                steps = state[1]
+                level, duration = steps[state[2]]
+                state[2] += 1
+                if state[2] == len(steps):
+                    state[2] = 0
+                    state[3] -= 1
+                    if state[3] == 0:
+                        del self.playing[pin]
+                if pin in self.playing:
+                    heapq.heappush(self.heap, (due + duration, gen, pin))
+                self.backend.output(pin, level)
+
+    def run(self):
+        while self.alive:
+            self.runPending(self.clock())
+            with self.cond:
+                if not self.alive:
+                    break
+                if self.heap:
+                    timeout = self.heap[0][0] - self.clock()
+                    if timeout > 0:
+                        self.cond.wait(timeout)
+                else:
+                    self.cond.wait()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+
+'''
+Deterministic replay of input traces through GPIOEventMonitor and
+GarageEventProcessor, on a virtual clock.
+
+A trace is a list of (timestamp, input name, level).  It can be read
+from a CSV file of "secs since start,input name,level" lines, or taken
+from the input bitmasks recorded in an event journal.  Actions and data
+log entries go to recorders instead of the network, so a run's output
+only depends on the trace and the configs.
+
+Use to test:
+
+python replay.py -g GPIO.json -e EventTriggers.json -a actionDefs.json -t trace.csv -s "2026-01-01 00:00:00"
+'''
+
+import json
+import time
+import datetime
+import argparse
+import logging
+from concurrent.futures import Future
+
+from clock import VirtualClock
+from gpioBackend import FakeGPIOBackend
+from gpioEventMonitor import GPIOEventMonitor
+from eventJournal import EventJournalReader
+
+logger = logging.getLogger("Replay")
+
+class ActionRecorder(object):
+    """ stands in for Actions, recording (time, action) instead of sending """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.actions = []
+
+    def processAction(self, action_str):
+        self.actions.append((self.clock.time(), action_str))
+        return True
+
+    def processActionAsync(self, action_str):
+        future = Future()
+        future.set_result(self.processAction(action_str))
+        return future
+
+class DataLogRecorder(object):
+    """ stands in for the data log pipeline, recording (time, entry) """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.entries = []
+
+    def log(self, data):
+        self.entries.append((self.clock.time(), data))
+
+def loadTrace(trace_file, start_time):
+    ''' reads "secs since start,input name,level" lines into a trace '''
+    trace = []
+    with open(trace_file) as f:
+        for line in f:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            offset, name, level = [field.strip() for field in line.split(',')]
+            trace.append((start_time + float(offset), name, int(level)))
+    return sorted(trace)
+
+def traceFromJournal(journal_dir, gpio_settings, since=None, until=None):
+    ''' rebuilds the input changes from the bitmasks recorded in a journal '''
+    pins = [(name, v[0]) for name, v in gpio_settings['inputs'].items()]
+    trace = []
+    last_word = None
+    for ts, word, event_id in EventJournalReader(journal_dir).records(since, until):
+        for name, pin in pins:
+            level = (word >> pin) & 1
+            if last_word is None or level != (last_word >> pin) & 1:
+                trace.append((ts, name, level))
+        last_word = word
+    return trace
+
+class ReplayHarness(object):
+    """
+        Drives a trace through a monitor and processor on a VirtualClock.
+
+        The monitor runs a cycle at every trace entry (so short pulses are
+        seen) and every poll_time seconds in between, which is when
+        repeating triggers, coalescing windows, timers and output patterns
+        get their turn.  Every dispatched event is kept in self.events.
+    """
+
+    def __init__(self, gpio_settings, event_triggers, action_defs, start_time,
+                 processor_class=None, poll_time=2.0):
+        self.clock = VirtualClock(start_time)
+        self.poll_time = poll_time
+        self.backend = FakeGPIOBackend()
+        self.monitor = GPIOEventMonitor(gpio_settings, event_triggers, True, poll_time,
+                                        backend=self.backend, clock=self.clock)
+        self.actions = ActionRecorder(self.clock)
+        self.data_log = DataLogRecorder(self.clock)
+        self.events = []
+        self.monitor.addCallback(self.recordEvent, by_id=True, queue_size=0)
+        if processor_class is None:
+            from GarageEventProcessor import GarageEventProcessor as processor_class
+        self.processor = processor_class(gpio_settings, True, '', action_defs, backend=self.backend,
+                                         clock=self.clock, data_logger=self.data_log,
+                                         actions=self.actions)
+        self.processor.bindEventIds(self.monitor.event_names)
+        self.monitor.addCallback(self.processor.eventIdCB, by_id=True, queue_size=0)
+        self.processor.syncOutputs()
+        self.processor.startup()
+        self.input_pins = dict((k, v[0]) for k, v in gpio_settings['inputs'].items())
+
+    def recordEvent(self, event_id, info=None):
+        self.events.append((self.clock.time(), self.monitor.event_names[event_id]))
+
+    def cycle(self):
+        self.monitor.runCycle()
+        self.processor.sequencer.runPending(self.clock.time())
+
+    def run(self, trace, end_time=None):
+        '''
+        replays the trace, up to end_time (defaults to the last entry).
+        Returns the number of monitor cycles run.
+        '''
+        if end_time is None:
+            end_time = trace[-1][0] if trace else self.clock.time()
+        cycles = 0
+        next_poll = self.clock.time()
+        for ts, name, level in trace:
+            while next_poll <= ts:
+                self.clock.advanceTo(next_poll)
+                self.cycle()
+                cycles += 1
+                next_poll += self.poll_time
+            self.clock.advanceTo(ts)
+            self.backend.setLevel(self.input_pins[name], level)
+            self.cycle()
+            cycles += 1
+        while next_poll <= end_time:
+            self.clock.advanceTo(next_poll)
+            self.cycle()
+            cycles += 1
+            next_poll += self.poll_time
+        self.clock.advanceTo(end_time)
+        return cycles
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replays an input trace through the garage event processor')
+    parser.add_argument('-g', '--gpio_setup', type=str, help='JSON file defining GPIO setup', required=True)
+    parser.add_argument('-e', '--events', type=str, help='JSON file defining the events to monitor', required=True)
+    parser.add_argument('-a', '--actions', type=str, help='JSON file defining the actions', required=True)
+    parser.add_argument('-t', '--trace', type=str, help='CSV trace file (secs since start,input,level)')
+    parser.add_argument('-j', '--journal_dir', type=str, help='take the trace from an event journal instead')
+    parser.add_argument('-s', '--start', type=str, default='2026-01-01 00:00:00', help='start time of a CSV trace (YYYY-MM-DD HH:MM:SS)')
+    parser.add_argument('-d', '--duration_h', type=float, default=None, help='hours to run (default: to the end of the trace)')
+    parser.add_argument('-p', '--poll_time', type=float, default=2.0, help='simulated seconds between polls')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARN)
+
+    gpio_settings = json.load(open(args.gpio_setup, 'r'))
+    event_triggers = json.load(open(args.events, 'r'))
+    action_defs = json.load(open(args.actions, 'r'))
+
+    if args.journal_dir:
+        trace = traceFromJournal(args.journal_dir, gpio_settings)
+        start_time = trace[0][0] if trace else time.time()
+    else:
+        start_time = time.mktime(datetime.datetime.strptime(args.start, '%Y-%m-%d %H:%M:%S').timetuple())
+        trace = loadTrace(args.trace, start_time) if args.trace else []
+    end_time = start_time + args.duration_h * 3600 if args.duration_h is not None else None
+
+    harness = ReplayHarness(gpio_settings, event_triggers, action_defs, start_time, poll_time=args.poll_time)
+    real_start = time.time()
+    cycles = harness.run(trace, end_time)
+    elapsed = time.time() - real_start
+
+    def stamp(ts):
+        return datetime.datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S')
+    for ts, event in harness.events:
+        print("%s  event   %s" % (stamp(ts), event))
+    for ts, action_str in harness.actions.actions:
+        print("%s  action  %s" % (stamp(ts), action_str))
+    for ts, data in harness.data_log.entries:
+        print("%s  datalog %s" % (stamp(ts), data))
+    print("%d cycles, %d events, %d actions, %d data log entries in %0.2fs" % (
+        cycles, len(harness.events), len(harness.actions.actions), len(harness.data_log.entries), elapsed))
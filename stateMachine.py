@@ -0,0 +1,329 @@
+import threading
+import logging
+from collections import deque
+
+from clock import SystemClock
+
+logger = logging.getLogger("StateMachine")
+
+class StateMachineDef(object):
+    """
+        One compiled machine definition, shared by all the machines
+        built from it:
+
+          "door": {
+            "initial": "unknown",
+            "states": {
+              "unknown": {},
+              "closed":  {"entry": [...], "exit": [...]},
+              "open":    {"entry": [...], "timeout": {"after": 10800, "to": "open_long", "actions": [...]}},
+              ...
+            },
+            "transitions": [
+              {"from": ["unknown", "closed"], "event": "opened", "to": "open", "guard": "...", "actions": [...]},
+              {"from": "*", "event": "pir", "actions": [...]},
+              ...
+            ]
+          }
+
+        States and (local) event names are numbered, and the transitions
+        compiled into a table indexed by state * n_events + event, of
+        the candidate transitions (guard, target state, actions) in the
+        order they're listed.  A transition without "to" only runs its
+        actions; one with "to" (even to its own state) exits and enters.
+
+        Guards and actions are kept as strings here, each machine binds
+        them with its params (see StateMachineEngine).
+    """
+
+    def __init__(self, name, definition):
+        self.name = name
+        self.state_names = sorted(definition['states'])
+        self.state_ids = dict((state, idx) for idx, state in enumerate(self.state_names))
+        self.initial = self.stateId(definition['initial'])
+        transitions = definition.get('transitions', [])
+        self.event_names = sorted(set(t['event'] for t in transitions))
+        self.event_ids = dict((event, idx) for idx, event in enumerate(self.event_names))
+        self.n_events = n_events = len(self.event_names)
+        self.entry = []
+        self.exit = []
+        self.timeouts = []
+        for state in self.state_names:
+            settings = definition['states'][state] or {}
+            self.entry.append(tuple(settings.get('entry', [])))
+            self.exit.append(tuple(settings.get('exit', [])))
+            timeout = settings.get('timeout')
+            if timeout is not None:
+                timeout = (float(timeout['after']), self.stateId(timeout['to']), tuple(timeout.get('actions', [])))
+            self.timeouts.append(timeout)
+        self.table = [None] * (len(self.state_names) * n_events)
+        for transition in transitions:
+            from_states = transition.get('from', '*')
+            if from_states == '*':
+                from_states = self.state_names
+            elif not isinstance(from_states, list):
+                from_states = [from_states]
+            target = transition.get('to')
+            candidate = (transition.get('guard'), None if target is None else self.stateId(target),
+                         tuple(transition.get('actions', [])))
+            event_id = self.event_ids[transition['event']]
+            for state in from_states:
+                idx = self.stateId(state) * n_events + event_id
+                self.table[idx] = (self.table[idx] or ()) + (candidate,)
+
+    def stateId(self, state):
+        if state not in self.state_ids:
+            raise ValueError("State machine '%s' has no state '%s'" % (self.name, state))
+        return self.state_ids[state]
+
+class StateMachine(object):
+    """ one running machine: its definition, bound guards and actions, and its state """
+
+    __slots__ = ('name', 'definition', 'params', 'table', 'entry', 'exit', 'timeouts',
+                 'state', 'entered', 'timer', 'seq')
+
+    def __init__(self, name, definition, params):
+        self.name = name
+        self.definition = definition
+        self.params = params
+        self.state = definition.initial
+        self.entered = 0
+        self.timer = None
+        self.seq = 0
+
+    def stateName(self):
+        return self.definition.state_names[self.state]
+
+class StateMachineEngine(object):
+    """
+        Runs many independent state machines, defined in JSON:
+
+          {
+            "definitions": {"door": {...}, ...},       (see StateMachineDef)
+            "machines": {
+              "garage_door": {
+                "definition": "door",
+                "events": {"opened": ["Garage_open_normal", "Garage_open_alert"], "closed": "Garage_closed"},
+                "params": {"tower": "sig_tower"}
+              },
+              ...
+            }
+          }
+
+        Each machine maps its definition's local events to the events
+        of the monitor, so one definition serves any number of doors or
+        zones.  Guard and action strings are %-formatted with the
+        machine's params and compiled once, by compileAction(string) and
+        compileGuard(string), into functions taking the machine.  Equal
+        strings share one compiled function, so a machine only costs its
+        state and its bound tables.  The built-in guard
+        "in:<machine>.<state>" is true while another machine is in that
+        state, and a guard starting with "!" is negated.  The built-in
+        action "fire:<event>" fires an event through the machines, so
+        machines can drive each other.  Events are run to completion:
+        one fired by an action is queued, and run once the transition
+        (or timeout, or start()) that fired it is complete, so no
+        machine is ever entered halfway through one of its transitions.
+
+        fire(event) runs a monitor event through every machine bound to
+        it: a table lookup, the guards of the candidates, and the exit,
+        transition and entry actions of the first one that passes.  A
+        state's timeout (on the clock's timers) takes its transition
+        when the machine has stayed in the state for "after" seconds.
+
+        Machines start in their initial state without running its entry
+        actions.  Events and timeouts may come from different threads,
+        transitions are serialized by one lock.
+    """
+
+    def __init__(self, config, compileAction, compileGuard, clock=None):
+        self.clock = clock if clock is not None else SystemClock()
+        self.compileAction = compileAction
+        self.compileGuard = compileGuard
+        self.compiled_actions = {}
+        self.compiled_guards = {}
+        self.guarded_states = []
+        self.lock = threading.RLock()
+        # events fired by actions, waiting for the running transition
+        self.pending = deque()
+        self.dispatching = False
+        self.definitions = dict((name, StateMachineDef(name, definition))
+                                for name, definition in config['definitions'].items())
+        self.machines = {}
+        self.routes = {}
+        for name in sorted(config['machines']):
+            self.addMachine(name, config['machines'][name])
+        for name, state in self.guarded_states:
+            if name not in self.machines:
+                raise ValueError("Guard on an undefined machine '%s'" % (name))
+            self.machines[name].definition.stateId(state)
+
+    def addMachine(self, name, settings):
+        definition = self.definitions.get(settings['definition'])
+        if definition is None:
+            raise ValueError("Machine '%s' uses an undefined definition '%s'" % (name, settings['definition']))
+        params = dict(settings.get('params', {}))
+        params.setdefault('machine', name)
+        machine = StateMachine(name, definition, params)
+        machine.table = [None if candidates is None else
+                         tuple((self.bindGuard(guard, params), target, self.bindActions(actions, params))
+                               for guard, target, actions in candidates)
+                         for candidates in definition.table]
+        machine.entry = [self.bindActions(actions, params) for actions in definition.entry]
+        machine.exit = [self.bindActions(actions, params) for actions in definition.exit]
+        machine.timeouts = [None if timeout is None else (timeout[0], timeout[1], self.bindActions(timeout[2], params))
+                            for timeout in definition.timeouts]
+        for local_event, events in settings.get('events', {}).items():
+            if local_event not in definition.event_ids:
+                raise ValueError("Machine '%s' binds an unknown event '%s'" % (name, local_event))
+            if not isinstance(events, list):
+                events = [events]
+            for event in events:
+                self.routes.setdefault(event, []).append((machine, definition.event_ids[local_event]))
+        self.machines[name] = machine
+
+    def bindActions(self, actions, params):
+        bound = []
+        for action in actions:
+            action = action % params
+            func = self.compiled_actions.get(action)
+            if func is None:
+                func = self.compiled_actions[action] = self.makeAction(action)
+            bound.append(func)
+        return tuple(bound)
+
+    def makeAction(self, action):
+        if action.startswith('fire:'):
+            event = action[5:]
+            return lambda machine: self.fire(event)
+        return self.compileAction(action)
+
+    def bindGuard(self, guard, params):
+        if guard is None:
+            return None
+        guard = guard % params
+        func = self.compiled_guards.get(guard)
+        if func is None:
+            func = self.compiled_guards[guard] = self.makeGuard(guard)
+        return func
+
+    def makeGuard(self, guard):
+        if guard.startswith('!'):
+            func = self.makeGuard(guard[1:])
+            return lambda machine: not func(machine)
+        if guard.startswith('in:'):
+            name, _, state = guard[3:].partition('.')
+            # checked once all the machines are added
+            self.guarded_states.append((name, state))
+            return lambda machine: self.machines[name].stateName() == state
+        return self.compileGuard(guard)
+
+    def events(self):
+        ''' the events some machine is bound to '''
+        return sorted(self.routes)
+
+    def start(self, rerun_entry=False):
+        '''
+        arms the timeouts of the machines' current states, counting from
+        when they were entered.  With rerun_entry (after restoring a
+        snapshot) the entry actions of the current states are run again.
+        '''
+        with self.lock:
+            self.runToCompletion(self.startMachines, rerun_entry)
+
+    def startMachines(self, rerun_entry):
+        now = self.clock.time()
+        for name in sorted(self.machines):
+            machine = self.machines[name]
+            if machine.entered == 0:
+                machine.entered = now
+            if rerun_entry:
+                self.runActions(machine, machine.entry[machine.state])
+            self.armTimeout(machine)
+
+    def fire(self, event):
+        if event not in self.routes:
+            return
+        with self.lock:
+            if self.dispatching:
+                # fired by an action: runs once the current step is done
+                self.pending.append(event)
+                return
+            self.runToCompletion(self.dispatch, event)
+
+    def runToCompletion(self, func, *args):
+        ''' runs func(*args), then the events its actions fired, in order '''
+        self.dispatching = True
+        try:
+            func(*args)
+            while self.pending:
+                self.dispatch(self.pending.popleft())
+        finally:
+            self.dispatching = False
+            self.pending.clear()
+
+    def dispatch(self, event):
+        for machine, event_id in self.routes[event]:
+            candidates = machine.table[machine.state * machine.definition.n_events + event_id]
+            if candidates is None:
+                continue
+            for guard, target, actions in candidates:
+                if guard is None or guard(machine):
+                    self.transition(machine, target, actions)
+                    break
+
+    def transition(self, machine, target, actions):
+        if target is None:
+            self.runActions(machine, actions)
+            return
+        logger.info("%s: %s -> %s" % (machine.name, machine.stateName(), machine.definition.state_names[target]))
+        if machine.timer is not None:
+            machine.timer.cancel()
+            machine.timer = None
+        self.runActions(machine, machine.exit[machine.state])
+        self.runActions(machine, actions)
+        machine.state = target
+        machine.entered = self.clock.time()
+        machine.seq += 1
+        self.runActions(machine, machine.entry[target])
+        self.armTimeout(machine)
+
+    def armTimeout(self, machine):
+        timeout = machine.timeouts[machine.state]
+        if timeout is None:
+            return
+        seq = machine.seq
+        delay = max(0, timeout[0] + machine.entered - self.clock.time())
+        machine.timer = self.clock.callLater(delay, lambda: self.timedOut(machine, seq))
+
+    def timedOut(self, machine, seq):
+        with self.lock:
+            # a transition since the timer was armed makes it stale
+            if machine.seq != seq:
+                return
+            machine.timer = None
+            after, target, actions = machine.timeouts[machine.state]
+            self.runToCompletion(self.transition, machine, target, actions)
+
+    def runActions(self, machine, actions):
+        for action in actions:
+            try:
+                action(machine)
+            except Exception as e:
+                logger.error("%s: action failed: %s" % (machine.name, e))
+
+    def getSnapshot(self):
+        ''' returns {machine name: [state, entered time]} (see stateSnapshot.py) '''
+        with self.lock:
+            return dict((name, [machine.stateName(), machine.entered])
+                        for name, machine in self.machines.items())
+
+    def restoreSnapshot(self, state):
+        ''' restores a getSnapshot() state before start(), for the machines and states still defined '''
+        with self.lock:
+            for name, (state_name, entered) in state.items():
+                machine = self.machines.get(name)
+                if machine is None or state_name not in machine.definition.state_ids:
+                    continue
+                machine.state = machine.definition.state_ids[state_name]
+                machine.entered = entered
@@ -0,0 +1,103 @@
+import os
+import json
+import atexit
+import logging
+
+from clock import SystemClock
+
+logger = logging.getLogger("Snapshot")
+
+class StateSnapshot(object):
+    """
+        Periodic, crash-safe snapshots of the state of a monitor and
+        processor (or anything with getSnapshot()/restoreSnapshot()), so
+        a restart carries on where the last run left off.
+
+        Each part added with add() is saved under its name in one JSON
+        file, every 'interval' seconds and at exit.  The file is written
+        to a temporary file, synced and renamed over the old one, so a
+        crash or power cut mid-write leaves the previous snapshot intact.
+
+        load() restores the parts before the monitor starts.  Snapshots
+        older than max_age seconds are ignored, as the state they hold
+        is too stale to carry on from.
+    """
+
+    def __init__(self, path, clock=None, interval=30.0, max_age=24 * 60 * 60):
+        self.path = os.path.expanduser(path)
+        self.clock = clock if clock is not None else SystemClock()
+        self.interval = interval
+        self.max_age = max_age
+        self.parts = []
+        self.timer = None
+        self.alive = False
+
+    def add(self, name, part):
+        self.parts.append((name, part))
+
+    def load(self):
+        ''' restores the parts from the snapshot file, returns False if there was none to restore '''
+        try:
+            with open(self.path, 'r') as f:
+                state = json.load(f)
+        except (IOError, OSError, ValueError) as e:
+            if os.path.exists(self.path):
+                logger.error("Error reading state snapshot %s: %s" % (self.path, e))
+            return False
+        age = self.clock.time() - state.get('time', 0)
+        if self.max_age is not None and age > self.max_age:
+            logger.warn("Ignoring state snapshot %s: %ds old" % (self.path, age))
+            return False
+        for name, part in self.parts:
+            if name in state:
+                part.restoreSnapshot(state[name])
+        logger.info("Restored state snapshot from %ds ago" % (age))
+        return True
+
+    def save(self):
+        state = {"time": self.clock.time()}
+        for name, part in self.parts:
+            state[name] = part.getSnapshot()
+        tmp_file = self.path + '.tmp'
+        try:
+            with open(tmp_file, 'w') as f:
+                json.dump(state, f, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.rename(tmp_file, self.path)
+            self.syncDir()
+        except (IOError, OSError) as e:
+            logger.error("Error writing state snapshot %s: %s" % (self.path, e))
+
+    def syncDir(self):
+        # makes the rename itself durable
+        try:
+            fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def start(self):
+        ''' saves every 'interval' seconds on the clock's timers, and at exit '''
+        self.alive = True
+        self.timer = self.clock.callLater(self.interval, self.periodicSave)
+        atexit.register(self.stop)
+
+    def stop(self):
+        if not self.alive:
+            return
+        self.alive = False
+        if self.timer is not None:
+            self.timer.cancel()
+        self.save()
+
+    def periodicSave(self):
+        if not self.alive:
+            return
+        self.save()
+        self.timer = self.clock.callLater(self.interval, self.periodicSave)
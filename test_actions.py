@@ -0,0 +1,66 @@
+import asyncio
+import logging
+import unittest
+
+from actions import Actions, OPEN
+from actions_stub_server import StubServer, DEAD
+from asyncCore import AsyncActions
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+def actionDefs(server, deferrable=True):
+    return {"tower_off": {"type": "http_get", "url": server.url("tower_off"),
+                          "timeout": 0.1, "retry_delay": 0, "deferrable": deferrable}}
+
+class DeadTargetMixin(object):
+    ''' the same checks for the threaded and the asyncio actions, against a target that never replies '''
+
+    def setUp(self):
+        self.server = StubServer(DEAD).start()
+        self.addCleanup(self.server.stop)
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def test_deferred_when_its_own_retries_open_the_breaker(self):
+        # the cold start case: the first action to hit the outage
+        actions, ok = self.send(actionDefs(self.server), failure_threshold=3)
+        self.assertFalse(ok)
+        self.assertEqual(self.server.request_cnt, 3)
+        self.assertEqual(actions.breakers[self.host()].state, OPEN)
+        self.assertEqual(list(actions.deferred[self.host()]), ['tower_off'])
+
+    def test_deferred_when_the_breaker_opens_between_retries(self):
+        actions, ok = self.send(actionDefs(self.server), failure_threshold=2)
+        self.assertFalse(ok)
+        self.assertEqual(self.server.request_cnt, 2)
+        self.assertEqual(list(actions.deferred[self.host()]), ['tower_off'])
+
+    def test_not_deferrable_gives_up(self):
+        actions, ok = self.send(actionDefs(self.server, deferrable=False), failure_threshold=3)
+        self.assertFalse(ok)
+        self.assertNotIn(self.host(), actions.deferred)
+
+    def host(self):
+        return self.server.url().split('/')[2]
+
+@unittest.skipIf(requests is None, "needs requests")
+class ActionsDeferTest(DeadTargetMixin, unittest.TestCase):
+
+    def send(self, action_defs, **kwargs):
+        actions = Actions(action_defs, **kwargs)
+        self.addCleanup(actions.close)
+        return actions, actions.processAction('tower_off')
+
+class AsyncActionsDeferTest(DeadTargetMixin, unittest.TestCase):
+
+    def send(self, action_defs, **kwargs):
+        loop = asyncio.new_event_loop()
+        self.addCleanup(loop.close)
+        actions = AsyncActions(action_defs, loop, **kwargs)
+        return actions, loop.run_until_complete(actions.processActionAsync('tower_off'))
+
+if __name__ == '__main__':
+    unittest.main()
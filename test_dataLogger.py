@@ -0,0 +1,75 @@
+import time
+import threading
+import unittest
+
+from dataLogger import DataLogPipeline
+
+class RecordingSender(object):
+    """ stands in for a data log sender, failing every send while 'dead' is set """
+
+    stamp = False
+
+    def __init__(self, dead=False):
+        self.dead = dead
+        self.attempts = 0
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send(self, entries):
+        with self.lock:
+            self.attempts += 1
+            if self.dead:
+                return 0
+            self.sent.extend(entries)
+            return len(entries)
+
+def waitFor(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class DataLogPipelineTest(unittest.TestCase):
+
+    def test_partial_batch_sent_after_batch_time(self):
+        sender = RecordingSender()
+        pipeline = DataLogPipeline(sender, batch_size=20, batch_time=0.1)
+        pipeline.start()
+        try:
+            pipeline.log("&door_status=1")
+            self.assertTrue(waitFor(lambda: sender.sent == ["&door_status=1"]))
+        finally:
+            pipeline.stop()
+
+    def test_full_batch_sent_right_away(self):
+        sender = RecordingSender()
+        pipeline = DataLogPipeline(sender, batch_size=5, batch_time=60.0)
+        pipeline.start()
+        try:
+            for idx in range(5):
+                pipeline.log("&n=%d" % (idx))
+            self.assertTrue(waitFor(lambda: len(sender.sent) == 5, timeout=1.0))
+        finally:
+            pipeline.stop()
+
+    def test_dead_sender_backs_off_while_logging(self):
+        sender = RecordingSender(dead=True)
+        pipeline = DataLogPipeline(sender, batch_size=2, batch_time=0.05)
+        pipeline.start()
+        try:
+            # keeps the queue over batch_size, which used to cut the backoff short
+            end = time.time() + 1.5
+            while time.time() < end:
+                pipeline.log("&door_status=1")
+                time.sleep(0.005)
+            # the first send, then one retry after the 1s backoff
+            self.assertLessEqual(sender.attempts, 2)
+            self.assertGreater(pipeline.backoff, 0)
+            sender.dead = False
+            self.assertTrue(waitFor(lambda: len(sender.sent) > 0, timeout=3.0))
+            self.assertEqual(pipeline.backoff, 0)
+        finally:
+            pipeline.stop()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+import time
+import datetime
+import unittest
+
+from gpioEventMonitor import GPIOEventMonitor
+from gpioBackend import FakeGPIOBackend
+from clock import VirtualClock
+
+DOOR_PIN = 18
+
+GPIO_SETTINGS = {"inputs": {"garage_door": [DOOR_PIN, False]}, "outputs": {}}
+
+TRIGGERS = [{"type": "daily", "start_time": "0:00:00", "end_time": "23:59:59",
+             "input_events": [{"name": "garage_door", "value": 1, "event": "open"},
+                              {"name": "garage_door", "value": 0, "event": "closed"}]}]
+
+class EdgeDetectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.start = time.mktime(datetime.datetime(2026, 1, 1, 12, 0, 0).timetuple())
+        self.clock = VirtualClock(self.start)
+        self.backend = FakeGPIOBackend()
+        self.monitor = GPIOEventMonitor(GPIO_SETTINGS, TRIGGERS, True, 2.0, backend=self.backend,
+                                        edge_detect=True, bouncetime_ms=50, clock=self.clock)
+        self.events = []
+        self.monitor.addCallback(self.record, by_id=True, queue_size=0)
+        # the edge callbacks, without the monitor thread: cycles are run by hand
+        self.monitor.addEdgeDetection()
+        self.monitor.runCycle()
+        self.assertEqual(self.events, ['closed'])
+        del self.events[:]
+
+    def record(self, event_id, info=None):
+        self.events.append(self.monitor.event_names[event_id])
+
+    def test_edge_is_processed_on_the_next_cycle(self):
+        self.assertTrue(self.backend.injectEdge(DOOR_PIN, 1, timestamp=1.0))
+        self.monitor.runCycle()
+        self.assertEqual(self.events, ['open'])
+
+    def test_pulse_shorter_than_the_poll_time(self):
+        # both edges come in before the monitor gets to run a cycle
+        self.assertTrue(self.backend.injectEdge(DOOR_PIN, 1, timestamp=1.0))
+        self.assertTrue(self.backend.injectEdge(DOOR_PIN, 0, timestamp=1.1))
+        self.monitor.runCycle()
+        self.assertEqual(self.events, ['open', 'closed'])
+
+    def test_pulse_back_before_the_level_was_read(self):
+        # the callback of the second edge reads the level the first one
+        # already reported, so the pulse is rebuilt from the repeated level
+        self.monitor.edgeCB(DOOR_PIN, 1)
+        self.monitor.edgeCB(DOOR_PIN, 1)
+        self.monitor.runCycle()
+        self.assertEqual(self.events, ['open', 'closed', 'open'])
+
+    def test_bounce_is_swallowed(self):
+        self.assertTrue(self.backend.injectEdge(DOOR_PIN, 1, timestamp=1.0))
+        self.assertFalse(self.backend.injectEdge(DOOR_PIN, 0, timestamp=1.01))
+        self.assertFalse(self.backend.injectEdge(DOOR_PIN, 1, timestamp=1.02))
+        self.monitor.runCycle()
+        self.assertEqual(self.events, ['open'])
+
+    def test_fallback_poll_picks_up_a_missed_edge(self):
+        # injectPulse only fires the rising edge's callback, the level
+        # going back is left for the poll to find
+        self.assertTrue(self.backend.injectPulse(DOOR_PIN, 1, timestamp=1.0))
+        self.monitor.runCycle()
+        self.assertEqual(self.events, ['open'])
+        # the next cycle, without queued edges, polls the inputs
+        self.monitor.runCycle()
+        self.assertEqual(self.events, ['open', 'closed'])
+        # and an edge swallowed by the bounce time is picked up the same way
+        self.assertTrue(self.backend.injectEdge(DOOR_PIN, 1, timestamp=2.0))
+        self.assertFalse(self.backend.injectEdge(DOOR_PIN, 0, timestamp=2.01))
+        self.monitor.runCycle()
+        self.monitor.runCycle()
+        self.assertEqual(self.events, ['open', 'closed', 'open', 'closed'])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+import time
+import datetime
+import unittest
+
+from gpioEventMonitor import GPIOEventMonitor
+from gpioBackend import FakeGPIOBackend
+from clock import VirtualClock
+
+GPIO_SETTINGS = {"inputs": {"garage_PIR": [17, False]}, "outputs": {}}
+
+def makeTriggers(coalesce=None, rate_limit=None):
+    input_event = {"name": "garage_PIR", "value": 1, "event": "motion_detected"}
+    if coalesce is not None:
+        input_event["coalesce"] = coalesce
+    if rate_limit is not None:
+        input_event["rate_limit"] = rate_limit
+    return [{"type": "daily", "start_time": "0:00:00", "end_time": "23:59:59",
+             "input_events": [input_event, {"name": "garage_PIR", "value": 0, "event": "no_motion"}]}]
+
+class EventCoalescerTest(unittest.TestCase):
+
+    def makeMonitor(self, triggers):
+        self.start = time.mktime(datetime.datetime(2026, 1, 1, 12, 0, 0).timetuple())
+        self.clock = VirtualClock(self.start)
+        self.backend = FakeGPIOBackend()
+        self.monitor = GPIOEventMonitor(GPIO_SETTINGS, triggers, True, 1.0, backend=self.backend, clock=self.clock)
+        self.events = []
+        self.monitor.addCallback(self.record, by_id=True, queue_size=0)
+        self.monitor.runCycle()
+
+    def record(self, event_id, info=None):
+        event = self.monitor.event_names[event_id]
+        if event != 'no_motion':
+            self.events.append((self.clock.time() - self.start, event, info))
+
+    def pulse(self, t):
+        ''' a motion pulse at start + t secs '''
+        for level, dt in ((1, 0), (0, 0.5)):
+            self.clock.advanceTo(self.start + t + dt)
+            self.backend.setLevel(17, level)
+            self.monitor.runCycle()
+
+    def cycleAt(self, t):
+        self.clock.advanceTo(self.start + t)
+        self.monitor.runCycle()
+
+    def test_window_passes_first_and_summarizes(self):
+        self.makeMonitor(makeTriggers(coalesce={"window": 10, "summary_event": "motion_summary"}))
+        for t in (1, 3, 5):
+            self.pulse(t)
+        self.cycleAt(10.9)
+        self.assertEqual([e[:2] for e in self.events], [(1, 'motion_detected')])
+        self.cycleAt(11)
+        summary = self.events[-1]
+        self.assertEqual(summary[:2], (11, 'motion_summary'))
+        self.assertEqual((summary[2]['count'], summary[2]['suppressed']), (3, 2))
+        self.assertEqual((summary[2]['first_time'], summary[2]['last_time']), (self.start + 1, self.start + 5))
+        # a new burst opens a new window
+        self.pulse(20)
+        self.assertEqual(self.events[-1][:2], (20, 'motion_detected'))
+
+    def test_rate_limit(self):
+        self.makeMonitor(makeTriggers(rate_limit={"rate": 0.5, "burst": 2}))
+        for t in (1, 2, 3, 4, 8):
+            self.pulse(t)
+        # the burst of 2 (refilling by 0.5 a sec meanwhile) is used up
+        # by 3, leaving half a token at 4
+        self.assertEqual([e[0] for e in self.events], [1, 2, 3, 8])
+
+    def test_state_survives_a_restart(self):
+        triggers = makeTriggers(coalesce={"window": 10, "summary_event": "motion_summary"})
+        self.makeMonitor(triggers)
+        self.pulse(1)
+        self.pulse(2)
+        state = self.monitor.getSnapshot()
+        self.makeMonitor(triggers)
+        self.monitor.restoreSnapshot(state)
+        self.cycleAt(11)
+        self.assertEqual(self.events[-1][1], 'motion_summary')
+        self.assertEqual(self.events[-1][2]['count'], 2)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import time
+import threading
+import unittest
+
+from eventConsumer import EventConsumer, DROP_OLDEST, COALESCE, BLOCK
+
+class BusyHandler(object):
+    """ callback that records the events, and holds on to the first one until released """
+
+    def __init__(self):
+        self.events = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self, event, info=None):
+        if not self.started.is_set():
+            self.started.set()
+            self.release.wait(5)
+        self.events.append((event, info))
+
+def waitFor(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+class EventConsumerTest(unittest.TestCase):
+
+    def busyConsumer(self, queue_size, overflow):
+        handler = BusyHandler()
+        consumer = EventConsumer(handler, queue_size, overflow, name='test')
+        self.addCleanup(consumer.stop)
+        self.addCleanup(handler.release.set)
+        consumer.put('first')
+        self.assertTrue(handler.started.wait(2))
+        return handler, consumer
+
+    def delivered(self, handler, consumer, count):
+        handler.release.set()
+        self.assertTrue(waitFor(lambda: len(handler.events) == count))
+        return [event for event, info in handler.events]
+
+    def test_coalesce_keeps_order_below_capacity(self):
+        handler, consumer = self.busyConsumer(10, COALESCE)
+        for event in ['open', 'closed', 'open']:
+            consumer.put(event)
+        self.assertEqual(self.delivered(handler, consumer, 4), ['first', 'open', 'closed', 'open'])
+        self.assertEqual(consumer.coalesced, 0)
+
+    def test_coalesce_merges_repeats_on_overflow(self):
+        handler, consumer = self.busyConsumer(2, COALESCE)
+        consumer.put('closed')
+        consumer.put('motion_summary', {'count': 1})
+        consumer.put('motion_summary', {'count': 7})
+        self.assertEqual(self.delivered(handler, consumer, 3), ['first', 'closed', 'motion_summary'])
+        # the newest info is the one delivered
+        self.assertEqual(handler.events[-1][1], {'count': 7})
+        self.assertEqual(consumer.coalesced, 1)
+        self.assertEqual(consumer.dropped, 0)
+
+    def test_coalesce_drops_oldest_when_not_a_repeat(self):
+        handler, consumer = self.busyConsumer(2, COALESCE)
+        for event in ['open', 'closed', 'open']:
+            consumer.put(event)
+        self.assertEqual(self.delivered(handler, consumer, 3), ['first', 'closed', 'open'])
+        self.assertEqual(consumer.dropped, 1)
+
+    def test_drop_oldest(self):
+        handler, consumer = self.busyConsumer(2, DROP_OLDEST)
+        for event in ['a', 'b', 'c']:
+            consumer.put(event)
+        self.assertEqual(self.delivered(handler, consumer, 3), ['first', 'b', 'c'])
+        self.assertEqual(consumer.dropped, 1)
+
+    def test_block_waits_for_room(self):
+        handler, consumer = self.busyConsumer(1, BLOCK)
+        consumer.put('a')
+        putter = threading.Thread(target=consumer.put, args=('b',))
+        putter.start()
+        putter.join(0.2)
+        # still waiting for the busy handler
+        self.assertTrue(putter.is_alive())
+        self.assertEqual(self.delivered(handler, consumer, 3), ['first', 'a', 'b'])
+        putter.join(2)
+        self.assertEqual(consumer.dropped, 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import mmap
+import struct
+import unittest
+
+from gpioBackend import (FakeGPIOBackend, FakeMmapGPIOBackend, MmapGPIOBackend, readLevelRegisters,
+                         GPIO_MEM_SIZE, GPLEV0, HIGH, LOW)
+
+class ReadMaskTest(unittest.TestCase):
+
+    def registers(self, lev0, lev1):
+        mem = mmap.mmap(-1, GPIO_MEM_SIZE)
+        struct.pack_into('<II', mem, GPLEV0, lev0, lev1)
+        return mem
+
+    def test_level_registers(self):
+        mem = self.registers(0x80000011, 0x00200001)
+        self.assertEqual(readLevelRegisters(mem, (1 << 0) | (1 << 4) | (1 << 5)), 0x11)
+        # pins 32-53 come from GPLEV1
+        self.assertEqual(readLevelRegisters(mem, (1 << 31) | (1 << 32) | (1 << 53)),
+                         (1 << 31) | (1 << 32) | (1 << 53))
+        self.assertEqual(readLevelRegisters(mem, 1 << 33), 0)
+
+    def test_mmap_backend_decodes_the_registers(self):
+        # without RPi.GPIO: only the register block is needed by readMask()
+        backend = MmapGPIOBackend.__new__(MmapGPIOBackend)
+        backend.mem = self.registers(1 << 17, 1 << (40 - 32))
+        self.assertEqual(backend.readMask((1 << 17) | (1 << 18) | (1 << 40)), (1 << 17) | (1 << 40))
+        self.assertEqual(backend.input(17), 1)
+        self.assertEqual(backend.input(18), 0)
+
+    def test_fake_backends_agree(self):
+        pins = {4: HIGH, 17: LOW, 27: HIGH, 31: HIGH, 32: HIGH, 45: LOW, 53: HIGH}
+        mask = sum(1 << pin for pin in pins) | (1 << 5)
+        fake = FakeGPIOBackend()
+        fake_mmap = FakeMmapGPIOBackend()
+        for backend in (fake, fake_mmap):
+            for pin, level in pins.items():
+                backend.setupInput(pin, False)
+                backend.setLevel(pin, level)
+        expected = sum(1 << pin for pin, level in pins.items() if level)
+        self.assertEqual(fake.readMask(mask), expected)
+        self.assertEqual(fake_mmap.readMask(mask), expected)
+        fake_mmap.injectEdge(31, LOW)
+        self.assertEqual(fake_mmap.readMask(mask), expected & ~(1 << 31))
+        self.assertEqual([fake_mmap.input(pin) for pin in (31, 32)], [LOW, HIGH])
+
+if __name__ == '__main__':
+    unittest.main()
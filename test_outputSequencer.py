@@ -0,0 +1,46 @@
+import threading
+import unittest
+
+from outputSequencer import OutputSequencer, beep, pulse
+from gpioBackend import FakeGPIOBackend, LOW, HIGH
+
+HORN_PIN = 22
+
+class OutputSequencerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 100.0
+        self.backend = FakeGPIOBackend()
+        self.sequencer = OutputSequencer(self.backend, clock=lambda: self.now)
+
+    def test_pattern_steps(self):
+        self.sequencer.play(HORN_PIN, beep(0.4, 0.4), 2)
+        levels = []
+        due = self.now
+        while due is not None:
+            due = self.sequencer.runPending(due)
+            levels.append(self.backend.outputs[HORN_PIN])
+        self.assertEqual(levels, [HIGH, LOW, HIGH, LOW])
+        self.assertFalse(self.sequencer.isPlaying(HORN_PIN))
+
+    def test_cancel_during_a_step_wins(self):
+        # the horn (active low) is switched on for good while the last
+        # step of a pulse is being output
+        self.sequencer.play(HORN_PIN, pulse(0.2, LOW))
+        self.sequencer.runPending(self.now)
+        output = self.backend.output
+        cancellers = []
+        def racingOutput(pin, level):
+            if level == HIGH:
+                cancellers.append(threading.Thread(target=self.sequencer.cancel, args=(HORN_PIN, LOW)))
+                cancellers[0].start()
+                # gives the cancel a chance to get in before the step
+                cancellers[0].join(0.2)
+            output(pin, level)
+        self.backend.output = racingOutput
+        self.sequencer.runPending(self.now + 0.2)
+        cancellers[0].join()
+        self.assertEqual(self.backend.outputs[HORN_PIN], LOW)
+
+if __name__ == '__main__':
+    unittest.main()
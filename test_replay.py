@@ -0,0 +1,55 @@
+import os
+import copy
+import json
+import time
+import datetime
+import unittest
+
+from replay import ReplayHarness
+
+def loadConfigs():
+    path = os.path.dirname(os.path.abspath(__file__))
+    return [json.load(open(os.path.join(path, name), 'r'))
+            for name in ('GPIO.json', 'EventTriggers_full.json', 'actionDefs.json')]
+
+def withoutCoalesce(event_triggers):
+    event_triggers = copy.deepcopy(event_triggers)
+    for trigger in event_triggers:
+        for input_event in trigger['input_events']:
+            input_event.pop('coalesce', None)
+    return event_triggers
+
+class ReplayHarnessTest(unittest.TestCase):
+
+    def test_events_only_come_from_the_trace(self):
+        gpio_settings, event_triggers, action_defs = loadConfigs()
+        start = time.mktime(datetime.datetime(2026, 1, 1, 12, 0, 0).timetuple())
+        harness = ReplayHarness(gpio_settings, event_triggers, action_defs, start)
+        self.assertEqual(harness.events, [])
+        harness.run([(start + 5, 'garage_door', 0)], start + 10)
+        self.assertNotIn('test callback', [event for ts, event in harness.events])
+        self.assertIn((start + 5, 'Garage_closed'), harness.events)
+
+class MotionLogTest(unittest.TestCase):
+
+    def setUp(self):
+        self.start = time.mktime(datetime.datetime(2026, 1, 1, 12, 0, 0).timetuple())
+        # three motion pulses close together, then one more
+        self.trace = sorted([(self.start + t, 'garage_PIR', 1) for t in (5, 7, 9, 30)] +
+                            [(self.start + t + 1, 'garage_PIR', 0) for t in (5, 7, 9, 30)])
+
+    def motionLog(self, event_triggers):
+        gpio_settings, _, action_defs = loadConfigs()
+        harness = ReplayHarness(gpio_settings, event_triggers, action_defs, self.start)
+        harness.run(self.trace, self.start + 60)
+        return [(ts - self.start, data) for ts, data in harness.data_log.entries if 'motion_detected=1' in data]
+
+    def test_coalesced_by_the_monitor(self):
+        event_triggers = loadConfigs()[1]
+        self.assertEqual([ts for ts, data in self.motionLog(event_triggers)], [16, 40])
+
+    def test_counted_by_the_processor_without_coalesce(self):
+        self.assertEqual([ts for ts, data in self.motionLog(withoutCoalesce(loadConfigs()[1]))], [15, 40])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import unittest
+
+from stateMachine import StateMachineEngine
+from clock import VirtualClock
+
+# a --poke--> b fires "poke" again from a's exit and b's entry; run to
+# completion, b's entry sees b entered, and the second poke takes b --poke--> c
+DEFINITIONS = {
+    "relay": {
+        "initial": "a",
+        "states": {
+            "a": {"exit": ["log:exit a", "fire:poke"]},
+            "b": {"entry": ["log:enter b", "fire:poke"], "exit": ["log:exit b"]},
+            "c": {"entry": ["log:enter c"], "timeout": {"after": 10, "to": "a", "actions": ["fire:poke"]}},
+        },
+        "transitions": [
+            {"from": "a", "event": "poke", "to": "b", "actions": ["log:a->b", "fire:poke"]},
+            {"from": "b", "event": "poke", "to": "c", "actions": ["log:b->c"]},
+            {"from": "c", "event": "poke", "actions": ["log:poked c"]},
+        ]
+    }
+}
+
+class StateMachineEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock(1000.0)
+        self.log = []
+        config = {"definitions": DEFINITIONS,
+                  "machines": {"relay": {"definition": "relay", "events": {"poke": "poke"}}}}
+        self.engine = StateMachineEngine(config, self.compileAction, self.compileGuard, self.clock)
+        self.machine = self.engine.machines['relay']
+        self.engine.start()
+
+    def compileAction(self, action):
+        text = action[4:]
+        return lambda machine: self.log.append((text, machine.stateName()))
+
+    def compileGuard(self, guard):
+        raise ValueError(guard)
+
+    def test_fired_events_wait_for_the_transition(self):
+        self.engine.fire('poke')
+        self.assertEqual(self.log, [
+            ('exit a', 'a'), ('a->b', 'a'), ('enter b', 'b'),
+            # then the three pokes fired on the way, in order
+            ('exit b', 'b'), ('b->c', 'b'), ('enter c', 'c'),
+            ('poked c', 'c'), ('poked c', 'c')])
+        self.assertEqual(self.machine.stateName(), 'c')
+
+    def test_timeout_runs_to_completion(self):
+        self.engine.fire('poke')
+        del self.log[:]
+        self.clock.advance(10)
+        # c --timeout--> a, and the poke fired on the way takes a --poke--> b
+        self.assertEqual(self.log[:3], [('exit a', 'a'), ('a->b', 'a'), ('enter b', 'b')])
+        self.assertEqual(self.machine.stateName(), 'c')
+        self.assertFalse(self.engine.pending)
+
+if __name__ == '__main__':
+    unittest.main()
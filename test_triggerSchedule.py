@@ -0,0 +1,86 @@
+import time
+import datetime
+import unittest
+
+from gpioEventMonitor import GPIOEventMonitor, TriggerSchedule
+from gpioBackend import FakeGPIOBackend
+from clock import VirtualClock
+
+GPIO_SETTINGS = {"inputs": {"garage_door": [18, True]}, "outputs": {}}
+
+TRIGGERS = [
+    {"type": "daily", "start_time": "6:00:00", "end_time": "21:59:59",
+     "input_events": [{"name": "garage_door", "value": 1, "event": "open_day"},
+                      {"name": "garage_door", "value": 0, "event": "closed"}]},
+    {"type": "daily", "start_time": "22:00:00", "end_time": "5:59:59",
+     "input_events": [{"name": "garage_door", "value": 1, "event": "open_night", "repeat_interval": 30},
+                      {"name": "garage_door", "value": 0, "event": "closed"}]},
+]
+
+def localTime(hour, minute=0, second=0):
+    return time.mktime(datetime.datetime(2026, 1, 1, hour, minute, second).timetuple())
+
+def activeEvents(schedule, now):
+    return sorted(entry[1] for mask, by_expected in schedule.activeTable(now)
+                  for entries in by_expected.values() for entry in entries)
+
+class TriggerScheduleTest(unittest.TestCase):
+
+    def test_windows(self):
+        schedule = TriggerSchedule(TRIGGERS, {"garage_door": 18})
+        self.assertEqual(activeEvents(schedule, datetime.datetime(2026, 1, 1, 12, 0)), ['closed', 'open_day'])
+        self.assertEqual(activeEvents(schedule, datetime.datetime(2026, 1, 1, 23, 0)), ['closed', 'open_night'])
+        # the night trigger wraps around midnight
+        self.assertEqual(activeEvents(schedule, datetime.datetime(2026, 1, 1, 3, 0)), ['closed', 'open_night'])
+        # end times are inclusive, to the second
+        self.assertEqual(activeEvents(schedule, datetime.datetime(2026, 1, 1, 21, 59, 59)), ['closed', 'open_day'])
+        self.assertEqual(activeEvents(schedule, datetime.datetime(2026, 1, 1, 22, 0, 0)), ['closed', 'open_night'])
+
+    def test_same_condition_keeps_its_rule_across_windows(self):
+        schedule = TriggerSchedule(TRIGGERS, {"garage_door": 18})
+        rule_ids = set()
+        for now in (datetime.datetime(2026, 1, 1, 12, 0), datetime.datetime(2026, 1, 1, 23, 0)):
+            for mask, by_expected in schedule.activeTable(now):
+                for entry in by_expected[0]:
+                    rule_ids.add(entry[0])
+        self.assertEqual(len(rule_ids), 1)
+
+    def test_unknown_input(self):
+        triggers = [{"type": "daily", "start_time": "0:00:00", "end_time": "23:59:59",
+                     "input_events": [{"name": "nope", "value": 1, "event": "x"}]}]
+        self.assertRaises(KeyError, TriggerSchedule, triggers, {"garage_door": 18})
+
+class MonitorWindowTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = VirtualClock(localTime(21, 59, 0))
+        self.backend = FakeGPIOBackend()
+        self.monitor = GPIOEventMonitor(GPIO_SETTINGS, TRIGGERS, True, 1.0, backend=self.backend, clock=self.clock)
+        self.events = []
+        self.monitor.addCallback(self.record, by_id=True, queue_size=0)
+
+    def record(self, event_id, info=None):
+        self.events.append((self.clock.time(), self.monitor.event_names[event_id]))
+
+    def cycleAt(self, t):
+        self.clock.advanceTo(t)
+        self.monitor.runCycle()
+
+    def test_window_switch_fires_the_new_trigger(self):
+        self.backend.setLevel(18, 1)
+        self.cycleAt(localTime(21, 59, 0))
+        self.cycleAt(localTime(21, 59, 30))
+        self.assertEqual([e for t, e in self.events], ['open_day'])
+        self.cycleAt(localTime(22, 0, 0))
+        self.cycleAt(localTime(22, 0, 10))
+        self.cycleAt(localTime(22, 0, 30))
+        self.assertEqual(self.events[1:], [(localTime(22, 0, 0), 'open_night'), (localTime(22, 0, 30), 'open_night')])
+
+    def test_closed_fires_once_across_windows(self):
+        self.backend.setLevel(18, 0)
+        for t in (localTime(21, 59, 0), localTime(21, 59, 59), localTime(22, 0, 0), localTime(22, 0, 5)):
+            self.cycleAt(t)
+        self.assertEqual([e for t, e in self.events], ['closed'])
+
+if __name__ == '__main__':
+    unittest.main()